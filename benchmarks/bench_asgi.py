@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""Benchmark of fast requests served alongside slow schedd queries.
+
+Runs a mix of clients against the restd in-process: some query the jobs
+of a schedd that takes --slow-latency seconds to answer, the others make
+status and config requests that need no schedd.  The same workload is
+run against:
+
+- "wsgi-sync": the Flask app on --sync-workers threads, each handling one
+  request at a time like `gunicorn -w4` sync workers;
+- "asgi": condor_restd.asgi, which runs schedd queries and other requests
+  on separate bounded thread pools.
+
+The daemons are simulated with the fakes in fakecondor.py.
+
+    python benchmarks/bench_asgi.py [--duration S] [--slow-clients N] [--fast-clients N]
+
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import condor_restd
+from condor_restd import asgi
+
+import fakecondor
+
+SLOW_PATH = "/v1/jobs/slow.example.net"
+FAST_PATHS = [
+    ("/v1/status", b"query=startd&constraint=Cpus%3E2&projection=name,cpus"),
+    ("/v1/config/FULL_HOSTNAME", b""),
+    ("/v1/jobs/fast.example.net/1", b"projection=owner"),
+]
+
+
+def _scope(path, query_string):
+    return {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "root_path": "",
+        "query_string": query_string,
+        "headers": [(b"host", b"localhost"), (b"accept", b"application/json")],
+        "server": ("localhost", 9680),
+        "client": ("127.0.0.1", 50000),
+    }
+
+
+async def asgi_request(app, path, query_string):
+    received = False
+
+    async def receive():
+        nonlocal received
+        if received:
+            await asyncio.sleep(3600)
+        received = True
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    status = []
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    await app(_scope(path, query_string), receive, send)
+    return status[0]
+
+
+def sync_request(path, query_string):
+    environ = asgi.build_environ(_scope(path, query_string), b"")
+    status = []
+
+    def start_response(s, headers, exc_info=None):
+        status.append(int(s.split()[0]))
+
+    result = condor_restd.app(environ, start_response)
+    try:
+        for _ in result:
+            pass
+    finally:
+        getattr(result, "close", lambda: None)()
+    return status[0]
+
+
+async def run_workload(do_request, args):
+    deadline = time.monotonic() + args.duration
+    fast_latencies = []
+    slow_done = [0]
+    errors = [0]
+
+    async def slow_client():
+        while time.monotonic() < deadline:
+            if await do_request(SLOW_PATH, b"projection=owner") != 200:
+                errors[0] += 1
+            slow_done[0] += 1
+
+    async def fast_client(n):
+        i = n
+        while time.monotonic() < deadline:
+            path, qs = FAST_PATHS[i % len(FAST_PATHS)]
+            i += 1
+            start = time.monotonic()
+            if await do_request(path, qs) != 200:
+                errors[0] += 1
+            fast_latencies.append(time.monotonic() - start)
+
+    started = time.monotonic()
+    await asyncio.gather(
+        *([slow_client() for _ in range(args.slow_clients)]
+          + [fast_client(n) for n in range(args.fast_clients)])
+    )
+    elapsed = time.monotonic() - started
+    fast_latencies.sort()
+    return elapsed, fast_latencies, slow_done[0], errors[0]
+
+
+def _percentile(values, fraction):
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(name, elapsed, fast_latencies, slow_done, errors):
+    print(
+        "%-10s fast: %7.1f req/s  p50 %7.1f ms  p99 %7.1f ms   slow: %5.1f req/s   errors: %d"
+        % (
+            name,
+            len(fast_latencies) / elapsed,
+            _percentile(fast_latencies, 0.5) * 1000,
+            _percentile(fast_latencies, 0.99) * 1000,
+            slow_done / elapsed,
+            errors,
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds per run")
+    parser.add_argument("--slow-clients", type=int, default=8)
+    parser.add_argument("--fast-clients", type=int, default=8)
+    parser.add_argument("--slow-latency", type=float, default=1.0,
+                        help="seconds the slow schedd takes per query")
+    parser.add_argument("--sync-workers", type=int, default=4)
+    parser.add_argument("--upstream-threads", type=int, default=32)
+    parser.add_argument("--collector-threads", type=int, default=8)
+    parser.add_argument("--local-threads", type=int, default=8)
+    parser.add_argument("--jobs", type=int, default=200, help="jobs per schedd")
+    parser.add_argument("--machines", type=int, default=200)
+    args = parser.parse_args()
+
+    pool = fakecondor.FakePool(
+        num_jobs=args.jobs,
+        num_machines=args.machines,
+        schedd_names=("fast.example.net", "slow.example.net"),
+        schedd_latency={"slow.example.net": args.slow_latency},
+    )
+    fakecondor.install(pool)
+
+    print(
+        "%d slow clients (%.1fs per schedd query), %d fast clients, %.0fs per run"
+        % (args.slow_clients, args.slow_latency, args.fast_clients, args.duration)
+    )
+
+    sync_pool = ThreadPoolExecutor(max_workers=args.sync_workers)
+
+    async def do_sync(path, qs):
+        return await asyncio.get_running_loop().run_in_executor(
+            sync_pool, sync_request, path, qs
+        )
+
+    report("wsgi-sync", *asyncio.run(run_workload(do_sync, args)))
+    sync_pool.shutdown()
+
+    app = asgi.WSGIToASGI(
+        condor_restd.app,
+        upstream_threads=args.upstream_threads,
+        local_threads=args.local_threads,
+        collector_threads=args.collector_threads,
+    )
+
+    async def do_asgi(path, qs):
+        return await asgi_request(app, path, qs)
+
+    report("asgi", *asyncio.run(run_workload(do_asgi, args)))
+    app.shutdown()
+
+
+if __name__ == "__main__":
+    main()
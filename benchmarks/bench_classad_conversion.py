@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""Micro-benchmark for converting classads to plain dicts.
+
+Compares utils.classad_to_dict() (printJson() parsed by a decoder that
+lowercases keys as it builds each object) with
+utils.classad_to_dict_via_json() (printJson() + json.loads() +
+deep_lcasekeys()) and with walking the ad via items(), on synthetic
+job-like ads, and checks that both restd converters give the same output.
+
+    python benchmarks/bench_classad_conversion.py [--ads N] [--attrs N] [--repeat N]
+
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+try:
+    import classad2 as classad
+except ImportError:
+    import classad
+
+from condor_restd import utils
+
+
+def make_ad(rng, num_attrs):
+    """Return a synthetic classad with about `num_attrs` attributes with
+    roughly the mix of value types found in job ads.
+
+    """
+    ad = classad.ClassAd()
+    ad["ClusterId"] = rng.randint(1, 10 ** 6)
+    ad["ProcId"] = rng.randint(0, 1000)
+    ad["Owner"] = "user%d" % rng.randint(0, 100)
+    ad["Cmd"] = "/home/user/bin/analysis.sh"
+    ad["Requirements"] = classad.ExprTree(
+        '(TARGET.Arch == "X86_64") && (TARGET.OpSys == "LINUX") '
+        "&& (TARGET.Disk >= RequestDisk) && (TARGET.Memory >= RequestMemory)"
+    )
+    ad["Environment"] = ""
+    ad["TransferInput"] = ["input%d.dat" % i for i in range(3)]
+    for i in range(num_attrs - len(ad)):
+        kind = i % 6
+        name = "Attr%03d" % i
+        if kind == 0:
+            ad[name] = rng.randint(0, 10 ** 9)
+        elif kind == 1:
+            ad[name] = "value %d" % rng.randint(0, 10 ** 6)
+        elif kind == 2:
+            ad[name] = rng.random() * 10 ** rng.randint(-3, 6)
+        elif kind == 3:
+            ad[name] = bool(rng.randint(0, 1))
+        elif kind == 4:
+            ad[name] = classad.ExprTree("RequestCpus * %d" % rng.randint(1, 8))
+        else:
+            ad[name] = classad.ExprTree("undefined")
+    return ad
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ads", type=int, default=2000, help="number of ads")
+    parser.add_argument("--attrs", type=int, default=150, help="attributes per ad")
+    parser.add_argument("--repeat", type=int, default=5, help="timing repetitions")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    ads = [make_ad(rng, args.attrs) for _ in range(args.ads)]
+
+    for ad in ads:
+        if json.dumps(utils.classad_to_dict(ad)) != json.dumps(
+            utils.classad_to_dict_via_json(ad)
+        ):
+            sys.exit("Output mismatch for %s" % ad)
+
+    results = {}
+    for name, func in [
+        ("printJson+json.loads+deep_lcasekeys", utils.classad_to_dict_via_json),
+        ("classad_to_dict", utils.classad_to_dict),
+        # Lower bound for any converter that walks the ad in Python
+        ("items() only (no conversion)", lambda ad: list(ad.items())),
+    ]:
+        best = min(
+            timeit.repeat(
+                lambda: [func(ad) for ad in ads], number=1, repeat=args.repeat
+            )
+        )
+        results[name] = best
+        print(
+            "%-40s %8.3f s  %8.1f us/ad"
+            % (name, best, best / len(ads) * 1e6)
+        )
+    print(
+        "speedup: %.2fx"
+        % (
+            results["printJson+json.loads+deep_lcasekeys"]
+            / results["classad_to_dict"]
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
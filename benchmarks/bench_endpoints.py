@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""Benchmark of every endpoint at several pool sizes.
+
+For each size, a fake pool with that many job ads (in the queue and in
+the history) and startd ads is set up with the fakes in fakecondor.py,
+and each endpoint is requested through the Flask test client.  For each
+endpoint this reports the median and worst latency, the throughput in
+requests and ads per second, the response size, and the peak memory
+allocated by Python while handling one request (from tracemalloc, so
+memory held by the bindings' C++ classads is not included; the process's
+peak RSS is printed at the end).
+
+    python benchmarks/bench_endpoints.py [--sizes 1000,10000,100000] [--repeat N]
+        [--only SUBSTRING] [--latency S] [--json FILE]
+
+Building the 100000-ad pool takes a minute or two and a few GB of memory.
+
+"""
+import argparse
+import gzip
+import json
+import os
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import condor_restd
+from condor_restd import utils
+
+import fakecondor
+
+SCHEDD = "schedd.example.net"
+OTHER_SCHEDD = "schedd2.example.net"
+
+# (name, path, headers)
+ENDPOINTS = [
+    ("jobs", "/v1/jobs/%s" % SCHEDD, {}),
+    ("jobs projection", "/v1/jobs/%s?projection=owner,jobstatus,requestcpus" % SCHEDD, {}),
+    ("jobs constraint", "/v1/jobs/%s?constraint=JobStatus%%3D%%3D2&projection=owner" % SCHEDD, {}),
+    ("jobs stream", "/v1/jobs/%s?stream=true" % SCHEDD, {}),
+    ("jobs page", "/v1/jobs/%s?page_size=500&projection=owner" % SCHEDD, {}),
+    ("jobs one", "/v1/jobs/%s/1/0" % SCHEDD, {}),
+    ("jobs attribute", "/v1/jobs/%s/1/0/owner" % SCHEDD, {}),
+    ("jobs ALL", "/v1/jobs/ALL?projection=owner", {}),
+    ("jobs ndjson", "/v1/jobs/%s?projection=owner,jobstatus" % SCHEDD, {"Accept": "application/x-ndjson"}),
+    ("jobs csv", "/v1/jobs/%s?projection=owner,jobstatus" % SCHEDD, {"Accept": "text/csv"}),
+    ("jobs gzip", "/v1/jobs/%s" % SCHEDD, {"Accept-Encoding": "gzip"}),
+    ("history", "/v1/history/%s?projection=owner,remotewallclocktime" % SCHEDD, {}),
+    ("grouped_jobs", "/v1/grouped_jobs/%s/owner?projection=jobstatus" % SCHEDD, {}),
+    (
+        "grouped_jobs aggregate",
+        "/v1/grouped_jobs/%s/owner?aggregate=count,sum:requestcpus,avg:requestmemory" % SCHEDD,
+        {},
+    ),
+    ("grouped_history", "/v1/grouped_history/%s/owner?projection=jobstatus" % SCHEDD, {}),
+    ("status", "/v1/status", {}),
+    ("status projection", "/v1/status?query=startd&projection=name,cpus,state", {}),
+    ("status name", "/v1/status/slot1@host0.example.net", {}),
+    ("grouped_status", "/v1/grouped_status/state?query=startd&projection=cpus", {}),
+    ("config", "/v1/config", {}),
+    ("config attribute", "/v1/config/FULL_HOSTNAME", {}),
+    ("metrics", "/metrics", {}),
+]
+
+
+def count_ads(body, content_type):
+    """Return the number of jobs or ads in a response body."""
+    if content_type.startswith("application/x-ndjson") or content_type.startswith("text/csv"):
+        return max(body.count(b"\n") - (1 if content_type.startswith("text/csv") else 0), 0)
+    if not content_type.startswith("application/json"):
+        return 0
+    data = json.loads(body)
+    if isinstance(data, dict) and set(data) == {"jobs", "errors"}:
+        return len(data["jobs"])
+    if isinstance(data, list):
+        return len(data)
+    if isinstance(data, dict) and data and all(isinstance(v, list) for v in data.values()):
+        return sum(len(v) for v in data.values())
+    return 1
+
+
+def request(client, path, headers):
+    resp = client.get(path, headers=headers)
+    # Read the whole body, so streamed responses are fully produced
+    body = resp.get_data()
+    if resp.status_code != 200:
+        raise RuntimeError("%s: %d %s" % (path, resp.status_code, body[:200]))
+    return resp, body
+
+
+def run_endpoint(client, name, path, headers, repeat):
+    resp, body = request(client, path, headers)  # warm up
+    if resp.headers.get("Content-Encoding") == "gzip":
+        num_ads = count_ads(gzip.decompress(body), resp.content_type)
+    else:
+        num_ads = count_ads(body, resp.content_type)
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        request(client, path, headers)
+        latencies.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        request(client, path, headers)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    median = statistics.median(latencies)
+    return dict(
+        endpoint=name,
+        path=path,
+        median_ms=median * 1000,
+        max_ms=max(latencies) * 1000,
+        requests_per_s=len(latencies) / sum(latencies),
+        ads_per_s=num_ads / median if num_ads else 0.0,
+        ads=num_ads,
+        response_bytes=len(body),
+        peak_mb=peak / 2.0 ** 20,
+    )
+
+
+def print_table(size, results):
+    print()
+    print("== %d ads ==" % size)
+    print(
+        "%-24s %10s %10s %9s %11s %8s %11s %9s"
+        % ("endpoint", "median ms", "max ms", "req/s", "ads/s", "ads", "bytes", "peak MB")
+    )
+    for r in results:
+        print(
+            "%-24s %10.2f %10.2f %9.1f %11.0f %8d %11d %9.1f"
+            % (
+                r["endpoint"],
+                r["median_ms"],
+                r["max_ms"],
+                r["requests_per_s"],
+                r["ads_per_s"],
+                r["ads"],
+                r["response_bytes"],
+                r["peak_mb"],
+            )
+        )
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma-separated numbers of ads")
+    parser.add_argument("--repeat", type=int, default=0, help="timed requests per endpoint (default: scaled to the size)")
+    parser.add_argument("--only", default="", help="only run endpoints whose name contains this")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds each fake daemon call sleeps")
+    parser.add_argument("--job-attrs", type=int, default=120, help="attributes per job ad")
+    parser.add_argument("--machine-attrs", type=int, default=180, help="attributes per startd ad")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    client = condor_restd.app.test_client()
+    all_results = {}
+    for size in [int(s) for s in args.sizes.split(",") if s.strip()]:
+        start = time.perf_counter()
+        pool = fakecondor.FakePool(
+            num_jobs=size,
+            num_machines=size,
+            schedd_names=(SCHEDD, OTHER_SCHEDD),
+            default_schedd_latency=args.latency,
+            collector_latency=args.latency,
+            job_attrs=args.job_attrs,
+            machine_attrs=args.machine_attrs,
+        )
+        fakecondor.install(pool)
+        utils.location_cache.clear()
+        print("Built a pool of %d ads in %.1fs" % (size, time.perf_counter() - start))
+        repeat = args.repeat or max(3, 100000 // (size * 10) * 10)
+        results = []
+        for name, path, headers in ENDPOINTS:
+            if args.only and args.only not in name:
+                continue
+            results.append(run_endpoint(client, name, path, headers, repeat))
+        print_table(size, results)
+        all_results[size] = results
+        del pool
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print()
+    print("Peak RSS: %.0f MB" % (maxrss / 1024.0))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(all_results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""Stand-in for the daemon side of the HTCondor Python bindings, for
+benchmarking the restd without a pool.
+
+install() replaces Schedd and Collector in the bindings (and in the
+restd modules that imported them by name) with fakes that answer from
+synthetic job and machine ads, optionally sleeping first to simulate a
+slow daemon.  The ads are real classads, so conversion, constraint
+evaluation and serialization cost the same as with a real pool.
+
+"""
+from __future__ import absolute_import
+
+import sys
+import time
+
+try:
+    import htcondor2 as htcondor
+    import classad2 as classad
+except ImportError:
+    import htcondor
+    import classad
+
+
+def _pad(ad, index, num_attrs, prefix):
+    """Add filler attributes to `ad` until it has `num_attrs`, with
+    roughly the mix of value types found in real ads.
+
+    """
+    i = 0
+    while len(ad) < num_attrs:
+        kind = i % 5
+        if kind == 0:
+            value = index * 31 + i
+        elif kind == 1:
+            value = (index % 1000) / 7.0 + i
+        elif kind == 2:
+            value = "%s value %d for ad %d" % (prefix, i, index)
+        elif kind == 3:
+            value = bool((index + i) % 2)
+        else:
+            value = classad.ExprTree("%sAttr%03d + %d" % (prefix, i - 4, index % 10))
+        ad["%sAttr%03d" % (prefix, i)] = value
+        i += 1
+    return ad
+
+
+def make_job_ad(index, procs_per_cluster=10, num_attrs=None):
+    ad = classad.ClassAd()
+    cluster, proc = divmod(index, procs_per_cluster)
+    ad["ClusterId"] = cluster + 1
+    ad["ProcId"] = proc
+    ad["Owner"] = "user%d" % (index % 17)
+    ad["Cmd"] = "/home/user%d/bin/analysis.sh" % (index % 17)
+    ad["Args"] = "--input input%d.dat --seed %d" % (index, index * 7919 % 1000)
+    ad["JobStatus"] = 1 + index % 4
+    ad["RequestCpus"] = 1 + index % 4
+    ad["RequestMemory"] = 1024 * (1 + index % 8)
+    ad["RequestDisk"] = 1048576
+    ad["QDate"] = 1700000000 + index
+    ad["EnteredCurrentStatus"] = 1700000000 + index * 3
+    ad["RemoteWallClockTime"] = float(index % 3600)
+    ad["Iwd"] = "/home/user%d/run%d" % (index % 17, cluster)
+    ad["Requirements"] = classad.ExprTree(
+        '(TARGET.Arch == "X86_64") && (TARGET.OpSys == "LINUX") '
+        "&& (TARGET.Disk >= RequestDisk) && (TARGET.Memory >= RequestMemory)"
+    )
+    ad["TransferInput"] = "input%d.dat,common.tar.gz" % index
+    if num_attrs:
+        _pad(ad, index, num_attrs, "Job")
+    return ad
+
+
+def make_machine_ad(index, num_attrs=None):
+    ad = classad.ClassAd()
+    ad["MyType"] = "Machine"
+    ad["Name"] = "slot%d@host%d.example.net" % (index % 8 + 1, index // 8)
+    ad["Machine"] = "host%d.example.net" % (index // 8)
+    ad["State"] = ("Unclaimed", "Claimed", "Owner")[index % 3]
+    ad["Activity"] = ("Idle", "Busy")[index % 2]
+    ad["Cpus"] = 1 + index % 4
+    ad["Memory"] = 2048 * (1 + index % 4)
+    ad["Disk"] = 10 ** 7
+    ad["Arch"] = "X86_64"
+    ad["OpSys"] = "LINUX"
+    ad["LoadAvg"] = (index % 100) / 100.0
+    ad["MyAddress"] = "<10.0.%d.%d:9618>" % (index // 256 % 256, index % 256)
+    ad["Start"] = classad.ExprTree("KeyboardIdle > 15 * 60")
+    if num_attrs:
+        _pad(ad, index, num_attrs, "Machine")
+    return ad
+
+
+def make_schedd_ad(name):
+    ad = classad.ClassAd()
+    ad["MyType"] = "Scheduler"
+    ad["Name"] = name
+    ad["Machine"] = name
+    ad["MyAddress"] = "<10.1.0.1:9618?alias=%s>" % name
+    ad["CondorVersion"] = "$CondorVersion: 25.0.0 $"
+    return ad
+
+
+def _select(ads, constraint, projection, limit):
+    if constraint and str(constraint).strip().lower() != "true":
+        expr = classad.ExprTree(str(constraint))
+        ads = [ad for ad in ads if expr.eval(ad) is True]
+    if limit is not None and limit >= 0:
+        ads = ads[:limit]
+    if not projection:
+        return list(ads)
+    out = []
+    for ad in ads:
+        projected = classad.ClassAd()
+        for attr in projection:
+            if attr in ad:
+                projected[attr] = ad.lookup(attr)
+        out.append(projected)
+    return out
+
+
+class FakePool(object):
+    """The ads served by the fake daemons, and how long each call
+    sleeps.  `schedd_latency` maps a schedd name to seconds of delay
+    (schedds not listed use `default_schedd_latency`).  `job_attrs` and
+    `machine_attrs` pad the ads to that many attributes; real job ads
+    have 100-200 and startd ads 150-300.
+
+    """
+
+    def __init__(
+        self,
+        num_jobs=1000,
+        num_machines=1000,
+        schedd_names=("schedd.example.net",),
+        schedd_latency=None,
+        default_schedd_latency=0.0,
+        collector_latency=0.0,
+        job_attrs=None,
+        machine_attrs=None,
+    ):
+        self.jobs = [make_job_ad(i, num_attrs=job_attrs) for i in range(num_jobs)]
+        self.history = list(reversed(self.jobs))
+        self.machines = [
+            make_machine_ad(i, num_attrs=machine_attrs) for i in range(num_machines)
+        ]
+        self.schedds = dict((name, make_schedd_ad(name)) for name in schedd_names)
+        self.schedd_latency = dict(schedd_latency or {})
+        self.default_schedd_latency = default_schedd_latency
+        self.collector_latency = collector_latency
+        self.calls = 0
+
+    def sleep_for_schedd(self, name):
+        self.calls += 1
+        delay = self.schedd_latency.get(name, self.default_schedd_latency)
+        if delay:
+            time.sleep(delay)
+
+    def sleep_for_collector(self):
+        self.calls += 1
+        if self.collector_latency:
+            time.sleep(self.collector_latency)
+
+
+def _make_classes(pool):
+    class FakeSchedd(object):
+        def __init__(self, location=None):
+            self.name = location["Name"] if location is not None else sorted(pool.schedds)[0]
+
+        def query(self, constraint="true", projection=(), limit=-1, **kwargs):
+            pool.sleep_for_schedd(self.name)
+            return _select(pool.jobs, constraint, projection, limit)
+
+        def xquery(self, constraint="true", projection=(), limit=-1, **kwargs):
+            return iter(self.query(constraint, projection, limit))
+
+        def history(self, constraint=None, projection=(), match=-1, since=None):
+            pool.sleep_for_schedd(self.name)
+            return _select(pool.history, constraint, projection, match)
+
+    class FakeCollector(object):
+        def __init__(self, pool_name=None):
+            pass
+
+        def locate(self, daemon_type, name=None):
+            pool.sleep_for_collector()
+            if name is None:
+                name = sorted(pool.schedds)[0]
+            if name not in pool.schedds:
+                raise _not_found("Unable to locate daemon %s" % name)
+            return pool.schedds[name]
+
+        def locateAll(self, daemon_type):
+            pool.sleep_for_collector()
+            return list(pool.schedds.values())
+
+        def query(self, ad_type=None, constraint="true", projection=(), **kwargs):
+            pool.sleep_for_collector()
+            ads = pool.machines + list(pool.schedds.values())
+            return _select(ads, constraint, projection, -1)
+
+    return FakeSchedd, FakeCollector
+
+
+def _not_found(message):
+    exc_type = getattr(htcondor, "HTCondorException", RuntimeError)
+    return exc_type(message)
+
+
+def install(pool):
+    # type: (FakePool) -> None
+    """Make the bindings (and the restd) use the fake daemons of `pool`.
+    Import condor_restd before calling this.
+
+    """
+    fake_schedd, fake_collector = _make_classes(pool)
+    htcondor.Schedd = fake_schedd
+    htcondor.Collector = fake_collector
+    for module_name in ("condor_restd.status", "condor_restd.snapshot"):
+        module = sys.modules.get(module_name)
+        if module is not None and hasattr(module, "Collector"):
+            module.Collector = fake_collector
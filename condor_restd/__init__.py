@@ -26,14 +26,18 @@ except ImportError:
 from flask import Flask, make_response
 from flask_restful import Resource, Api
 
+from . import admission, compression, jobqueue, metrics, representations, resultcache
+from .batch import V1BatchResource
 from .config import V1ConfigResource
 from .jobs import (
+    add_resume_link,
     V1GroupedJobsResource,
     V1GroupedHistoryResource,
     V1JobsResource,
     V1HistoryResource,
 )
 from .status import V1StatusResource, V1GroupedStatusResource
+from .watch import V1JobsWatchResource
 
 
 app = Flask(__name__)
@@ -48,10 +52,28 @@ app.logger.info("Using HTCondor Python bindings version %d", BINDINGS_VERSION)
 
 @api.representation("application/json")
 def output_json(data, code, headers=None):
-    resp = make_response(json.dumps(data) + "\n", code)
-    resp.headers.extend(headers or {})
-    resp.headers["Access-Control-Allow-Origin"] = "*"
-    return resp
+    if code == 304:
+        # The resource found that the client's copy is current
+        resp = make_response("", code)
+    else:
+        with metrics.timed("serialize"):
+            body = json.dumps(data) + "\n"
+        resp = make_response(body, code)
+    return representations.finish(resp, headers)
+
+
+representations.register(api)
+
+
+# Register the metrics hooks first: after_request handlers run in reverse
+# order, so the response bytes are counted after compression.
+metrics.install(app)
+app.before_request(admission.check_rate_limit)
+app.after_request(jobqueue.add_age_header)
+app.after_request(compression.compress_response)
+# After compression, so responses are cached before being compressed
+resultcache.install(app)
+app.after_request(add_resume_link)
 
 
 class RootResource(Resource):
@@ -69,6 +91,7 @@ api.add_resource(
     "/v1/jobs/<schedd>/<int:clusterid>/<int:procid>",
     "/v1/jobs/<schedd>/<int:clusterid>/<int:procid>/<attribute>",
 )
+api.add_resource(V1JobsWatchResource, "/v1/jobs/<schedd>/<int:clusterid>/watch")
 api.add_resource(
     V1HistoryResource,
     "/v1/history/<schedd>",
@@ -93,3 +116,4 @@ api.add_resource(
     "/v1/grouped_status/<groupby>/<name>",
 )
 api.add_resource(V1ConfigResource, "/v1/config", "/v1/config/<attribute>")
+api.add_resource(V1BatchResource, "/v1/batch")
@@ -0,0 +1,246 @@
+"""Admission control: limits on the load the restd puts on the daemons
+it queries, and on how fast each client can send requests.
+
+Queries to each daemon (each schedd, and the collector) are limited to
+RESTD_UPSTREAM_CONCURRENCY at a time per restd process.  Further queries
+wait, up to RESTD_UPSTREAM_QUEUE_TIMEOUT seconds, in a queue of at most
+RESTD_UPSTREAM_QUEUE_SIZE; cheap queries (with a projection, or for one
+cluster or daemon) are admitted before expensive ones (dumps of the
+whole queue or pool) that have been waiting.  A query that can't get
+into the queue, or waits too long, gets a 503 with a Retry-After header,
+so an overloaded schedd sheds load quickly instead of every worker
+piling up behind it.
+
+Separately, if RESTD_RATE_LIMIT is set, each client (by address) can
+make that many requests per second on average, in bursts of up to
+RESTD_RATE_LIMIT_BURST; further requests get a 429.  Requests that never
+query a daemon (metrics, and the restd's own config unless refreshed)
+are not counted, and a batch request counts once, however many requests
+it has.
+
+"""
+from __future__ import absolute_import
+
+import collections
+import contextlib
+import heapq
+import itertools
+import math
+import threading
+import time
+
+try:
+    from typing import Dict, Iterator, List, Optional, Tuple
+except ImportError:
+    pass
+
+from flask import request
+from werkzeug.exceptions import ServiceUnavailable, TooManyRequests
+
+from . import metrics, utils
+
+
+# Priorities of queries waiting for a daemon; lower goes first
+CHEAP = 0
+EXPENSIVE = 1
+
+# Seconds clients are told to wait before retrying when a daemon's queue
+# is full
+RETRY_AFTER = 5
+
+# Paths whose requests are not rate limited
+RATE_LIMIT_EXEMPT = ("/metrics",)
+
+# Requests for the config are not rate limited either, unless they are
+# for another daemon's config or refresh the restd's own
+CONFIG_PATH = "/v1/config"
+
+# WSGI environ key marking the sub-requests of a batch request, which
+# are not rate limited themselves
+BATCH_ENVIRON_KEY = "restd.batch_subrequest"
+
+# Forget the rate limit state of this many least recently seen clients
+MAX_CLIENTS = 10000
+
+
+def concurrency():
+    # type: () -> int
+    return int(utils.param_float("RESTD_UPSTREAM_CONCURRENCY", 8))
+
+
+def queue_size():
+    # type: () -> int
+    return max(0, int(utils.param_float("RESTD_UPSTREAM_QUEUE_SIZE", 32)))
+
+
+def queue_timeout():
+    # type: () -> float
+    return utils.param_float("RESTD_UPSTREAM_QUEUE_TIMEOUT", 10)
+
+
+def _reject(exc_class, retry_after, message):
+    exc = exc_class(retry_after=max(1, int(math.ceil(retry_after))))
+    exc.data = {"message": message}
+    raise exc
+
+
+class UpstreamLimiter(object):
+    """A limit on the number of concurrent queries to one daemon, with a
+    bounded queue of waiting queries, admitted in order of priority.
+
+    """
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.active = 0
+        self._cond = threading.Condition()
+        # (priority, sequence number) of each waiting query; the heap
+        # order is the admission order
+        self._waiting = []  # type: List[Tuple[int, int]]
+        self._sequence = itertools.count()
+
+    def _set_depth(self):
+        metrics.registry.set(
+            "restd_admission_queue_depth", {"upstream": self.upstream}, len(self._waiting)
+        )
+
+    def _rejected(self, reason):
+        metrics.registry.inc(
+            "restd_admission_rejections_total", {"upstream": self.upstream, "reason": reason}
+        )
+
+    def acquire(self, priority, limit, max_waiting, timeout):
+        # type: (int, int, int, float) -> None
+        """Wait for a slot.  Aborts with a 503 if the queue is full or
+        the slot doesn't come within `timeout` seconds.
+
+        """
+        with self._cond:
+            if self.active < limit and not self._waiting:
+                self.active += 1
+                return
+            if len(self._waiting) >= max_waiting:
+                self._rejected("queue_full")
+                _reject(ServiceUnavailable, RETRY_AFTER, "Too many queries waiting for %s" % self.upstream)
+            entry = (priority, next(self._sequence))
+            heapq.heappush(self._waiting, entry)
+            self._set_depth()
+            deadline = time.monotonic() + timeout
+            try:
+                while not (self.active < limit and self._waiting[0] == entry):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._waiting.remove(entry)
+                        heapq.heapify(self._waiting)
+                        # The next in line may be able to go now
+                        self._cond.notify_all()
+                        self._rejected("timeout")
+                        _reject(
+                            ServiceUnavailable,
+                            RETRY_AFTER,
+                            "Timed out waiting to query %s" % self.upstream,
+                        )
+                    self._cond.wait(remaining)
+                heapq.heappop(self._waiting)
+                self.active += 1
+                # Others may be able to go too if the limit was raised
+                self._cond.notify_all()
+            finally:
+                self._set_depth()
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+
+_limiters = {}  # type: Dict[str, UpstreamLimiter]
+_limiters_lock = threading.Lock()
+
+
+def _limiter(upstream):
+    # type: (str) -> UpstreamLimiter
+    with _limiters_lock:
+        limiter = _limiters.get(upstream)
+        if limiter is None:
+            limiter = _limiters[upstream] = UpstreamLimiter(upstream)
+        return limiter
+
+
+@contextlib.contextmanager
+def admitted(upstream, expensive=False):
+    # type: (str, bool) -> Iterator[None]
+    """Context manager holding a slot for querying `upstream` (e.g.
+    "schedd:<name>" or "collector") for the duration of its block.
+    Aborts with a 503 if no slot is available in time.  Does nothing if
+    RESTD_UPSTREAM_CONCURRENCY is not positive.
+
+    """
+    limit = concurrency()
+    if limit <= 0:
+        yield
+        return
+    limiter = _limiter(upstream)
+    with metrics.timed("admission"):
+        limiter.acquire(EXPENSIVE if expensive else CHEAP, limit, queue_size(), queue_timeout())
+    try:
+        yield
+    finally:
+        limiter.release()
+
+
+class TokenBuckets(object):
+    """A token bucket for each client, refilled at `rate` tokens per
+    second up to `burst`.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # client -> (tokens, time of last update)
+        self._buckets = collections.OrderedDict()  # type: collections.OrderedDict
+
+    def take(self, client, rate, burst):
+        # type: (str, float, float) -> float
+        """Take a token from `client`'s bucket.  Return 0 if there was one,
+        otherwise the seconds until there will be.
+
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(client, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[client] = (tokens, now)
+            while len(self._buckets) > MAX_CLIENTS:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+rate_limits = TokenBuckets()
+
+
+def check_rate_limit():
+    """before_request hook: abort with a 429 if the client has used up
+    its rate limit.
+
+    """
+    rate = utils.param_float("RESTD_RATE_LIMIT", 0)
+    if rate <= 0 or request.environ.get(BATCH_ENVIRON_KEY):
+        return
+    if request.path == "/" or request.path.startswith(RATE_LIMIT_EXEMPT):
+        return
+    if request.path.startswith(CONFIG_PATH) and not request.args.get("daemon"):
+        if request.args.get("refresh", "false").lower() in ("false", "0", ""):
+            return
+    burst = max(1.0, utils.param_float("RESTD_RATE_LIMIT_BURST", max(rate, 1)))
+    wait = rate_limits.take(request.remote_addr or "", rate, burst)
+    if wait > 0:
+        metrics.registry.inc(
+            "restd_admission_rejections_total", {"upstream": "", "reason": "rate_limit"}
+        )
+        _reject(TooManyRequests, wait, "Rate limit exceeded")
@@ -0,0 +1,156 @@
+"""Server-side aggregation of grouped query results.
+
+An aggregation spec is a comma-separated list of terms like
+`count,sum:requestcpus,max:qdate,histogram:jobstatus`; each ad is folded
+into per-group accumulators as it is read, so only one accumulator per
+group and term is kept in memory.
+
+"""
+from __future__ import absolute_import
+
+import json
+
+try:
+    from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+except ImportError:
+    pass
+
+from . import utils
+
+
+# Functions that take an attribute; "count" takes none.
+ATTRIBUTE_FUNCTIONS = ("sum", "min", "max", "avg", "histogram")
+
+
+def parse_aggregate(spec):
+    # type: (str) -> List[Tuple[str, Optional[str]]]
+    """Return the (function, lowercased attribute) pairs of an
+    aggregation spec; the attribute is None for "count".  Raises
+    ValueError if the spec is invalid.
+
+    """
+    terms = []
+    for term in utils.str_to_list(spec.lower()):
+        func, _, attr = term.partition(":")
+        if func == "count":
+            if attr:
+                raise ValueError("count does not take an attribute: %s" % term)
+            terms.append((func, None))
+        elif func in ATTRIBUTE_FUNCTIONS:
+            if not utils.validate_attribute(attr):
+                raise ValueError("invalid attribute in %s" % term)
+            terms.append((func, attr))
+        else:
+            raise ValueError("unknown function %r" % func)
+    if not terms:
+        raise ValueError("no aggregation terms")
+    return terms
+
+
+def required_attributes(terms):
+    # type: (List[Tuple[str, Optional[str]]]) -> Set[str]
+    """Return the attributes needed to compute the given terms."""
+    return set(attr for _, attr in terms if attr)
+
+
+def _is_number(value):
+    # type: (Any) -> bool
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _histogram_key(value):
+    # type: (Any) -> Any
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, sort_keys=True)
+    return value
+
+
+class _Plan(object):
+    """The attributes to fold for each kind of accumulator, so that e.g.
+    "sum:x,avg:x" only sums x once per ad.
+
+    """
+
+    def __init__(self, terms):
+        # type: (List[Tuple[str, Optional[str]]]) -> None
+        self.terms = terms
+        self.sum_attrs = sorted(set(a for f, a in terms if f in ("sum", "avg")))
+        self.min_attrs = sorted(set(a for f, a in terms if f == "min"))
+        self.max_attrs = sorted(set(a for f, a in terms if f == "max"))
+        self.histogram_attrs = sorted(set(a for f, a in terms if f == "histogram"))
+
+
+class _Accumulator(object):
+    """The running values of the aggregation terms for one group."""
+
+    __slots__ = ("count", "sums", "counts", "mins", "maxes", "histograms")
+
+    def __init__(self):
+        self.count = 0
+        self.sums = {}  # type: Dict[str, float]
+        self.counts = {}  # type: Dict[str, int]
+        self.mins = {}  # type: Dict[str, Any]
+        self.maxes = {}  # type: Dict[str, Any]
+        self.histograms = {}  # type: Dict[str, Dict[Any, int]]
+
+    def add(self, ad, plan):
+        # type: (Dict, _Plan) -> None
+        self.count += 1
+        for attr in plan.sum_attrs:
+            value = ad.get(attr)
+            if _is_number(value):
+                self.sums[attr] = self.sums.get(attr, 0) + value
+                self.counts[attr] = self.counts.get(attr, 0) + 1
+        for attr in plan.min_attrs:
+            value = ad.get(attr)
+            if _is_number(value) and (attr not in self.mins or value < self.mins[attr]):
+                self.mins[attr] = value
+        for attr in plan.max_attrs:
+            value = ad.get(attr)
+            if _is_number(value) and (attr not in self.maxes or value > self.maxes[attr]):
+                self.maxes[attr] = value
+        for attr in plan.histogram_attrs:
+            histogram = self.histograms.setdefault(attr, {})
+            key = _histogram_key(ad.get(attr))
+            histogram[key] = histogram.get(key, 0) + 1
+
+    def result(self, plan):
+        # type: (_Plan) -> Dict[str, Any]
+        out = {}  # type: Dict[str, Any]
+        for func, attr in plan.terms:
+            if func == "count":
+                out["count"] = self.count
+                continue
+            key = "%s:%s" % (func, attr)
+            if func == "sum":
+                out[key] = self.sums.get(attr, 0)
+            elif func == "avg":
+                n = self.counts.get(attr, 0)
+                out[key] = float(self.sums[attr]) / n if n else None
+            elif func == "min":
+                out[key] = self.mins.get(attr)
+            elif func == "max":
+                out[key] = self.maxes.get(attr)
+            elif func == "histogram":
+                out[key] = self.histograms.get(attr, {})
+        return out
+
+
+def aggregate(ads, groupby, terms):
+    # type: (Iterable[Dict], str, List[Tuple[str, Optional[str]]]) -> Dict[Any, Dict[str, Any]]
+    """Fold `ads` into one set of aggregates per value of `groupby`.  Ads
+    where `groupby` is undefined are skipped, as in grouped results.
+
+    """
+    plan = _Plan(terms)
+    groups = {}  # type: Dict[Any, _Accumulator]
+    for ad in ads:
+        key = ad.get(groupby)
+        if key is None:
+            continue
+        key = _histogram_key(key)
+        acc = groups.get(key)
+        if acc is None:
+            acc = groups[key] = _Accumulator()
+        acc.add(ad, plan)
+    return dict((key, acc.result(plan)) for key, acc in groups.items())
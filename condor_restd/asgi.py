@@ -0,0 +1,266 @@
+"""ASGI entry point for the restd, for use with an ASGI server such as
+uvicorn:
+
+    uvicorn --workers 4 --port 9680 condor_restd.asgi:app
+
+The Flask app itself is unchanged; each request is run on a thread from
+a bounded pool while the event loop keeps accepting connections.  The
+jobs and history endpoints, which talk to a schedd and can block for a
+long time, get their own pool, and so do the status endpoints, which
+talk to the collector; a few slow schedds can't use up the threads
+needed to answer status queries, and neither can a slow collector those
+needed to answer config and other quick requests.  `watch` streams,
+which each hold a thread for as long as they are open, have a pool of
+their own too.
+
+Requires Python 3.7+.
+
+"""
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+except ImportError:
+    pass
+
+from . import app as flask_app
+from . import utils
+
+
+# Paths whose requests query a schedd and are run on the upstream pool.
+UPSTREAM_PREFIXES = (
+    "/v1/jobs/",
+    "/v1/history/",
+    "/v1/grouped_jobs/",
+    "/v1/grouped_history/",
+    "/v1/batch",
+)
+
+# Suffix of the paths of watch streams, which are run on the watch pool.
+WATCH_SUFFIX = "/watch"
+
+# Paths whose requests query the collector and are run on the collector
+# pool.
+COLLECTOR_PREFIXES = (
+    "/v1/status",
+    "/v1/grouped_status/",
+)
+
+_END = object()
+
+
+def _next_chunk(iterator):
+    # type: (Iterator[bytes]) -> Any
+    return next(iterator, _END)
+
+
+class WSGIToASGI(object):
+    """Serve a WSGI app over ASGI, calling it (and reading its response
+    body) on threads from one of four bounded pools: `watch_pool` for
+    watch streams, `upstream_pool` for requests whose path starts with
+    one of `upstream_prefixes`, `collector_pool` for those starting with
+    one of `collector_prefixes`, and `local_pool` for everything else.
+
+    """
+
+    def __init__(
+        self,
+        wsgi_app,
+        upstream_threads,
+        local_threads,
+        collector_threads=8,
+        watch_threads=16,
+        upstream_prefixes=UPSTREAM_PREFIXES,
+        collector_prefixes=COLLECTOR_PREFIXES,
+    ):
+        self.wsgi_app = wsgi_app
+        self.upstream_prefixes = tuple(upstream_prefixes)
+        self.collector_prefixes = tuple(collector_prefixes)
+        self.upstream_pool = ThreadPoolExecutor(
+            max_workers=upstream_threads, thread_name_prefix="restd-upstream"
+        )
+        self.collector_pool = ThreadPoolExecutor(
+            max_workers=collector_threads, thread_name_prefix="restd-collector"
+        )
+        self.local_pool = ThreadPoolExecutor(
+            max_workers=local_threads, thread_name_prefix="restd-local"
+        )
+        self.watch_pool = ThreadPoolExecutor(
+            max_workers=watch_threads, thread_name_prefix="restd-watch"
+        )
+
+    def pool_for(self, path):
+        # type: (str) -> ThreadPoolExecutor
+        if path.startswith("/v1/jobs/") and path.endswith(WATCH_SUFFIX):
+            return self.watch_pool
+        if path.startswith(self.upstream_prefixes):
+            return self.upstream_pool
+        if path.startswith(self.collector_prefixes):
+            return self.collector_pool
+        return self.local_pool
+
+    def shutdown(self):
+        self.upstream_pool.shutdown(wait=False)
+        self.collector_pool.shutdown(wait=False)
+        self.local_pool.shutdown(wait=False)
+        self.watch_pool.shutdown(wait=False)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError("Unsupported ASGI scope type %r" % scope["type"])
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        body = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body.append(message.get("body", b""))
+            more_body = message.get("more_body", False)
+        environ = build_environ(scope, b"".join(body))
+
+        loop = asyncio.get_running_loop()
+        pool = self.pool_for(scope["path"])
+        status, headers, chunks, iterator, close = await loop.run_in_executor(
+            pool, self._start, environ
+        )
+        try:
+            await send(
+                {"type": "http.response.start", "status": status, "headers": headers}
+            )
+            for chunk in chunks:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            while iterator is not None:
+                chunk = await loop.run_in_executor(pool, _next_chunk, iterator)
+                if chunk is _END:
+                    break
+                if chunk:
+                    await send(
+                        {"type": "http.response.body", "body": chunk, "more_body": True}
+                    )
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            if close is not None:
+                await loop.run_in_executor(pool, close)
+
+    def _start(self, environ):
+        # type: (Dict) -> Tuple[int, List[Tuple[bytes, bytes]], List[bytes], Optional[Iterator[bytes]], Optional[Callable]]
+        """Call the WSGI app and read the start of its response.  If the
+        response has a Content-Length (i.e. the body is already in memory),
+        read all of it; otherwise read up to the first non-empty chunk and
+        return an iterator for the rest, which the caller reads on the
+        pool as well so a streamed query doesn't block the event loop.
+
+        """
+        started = []  # type: List[Any]
+
+        def start_response(status, response_headers, exc_info=None):
+            if exc_info and started:
+                try:
+                    raise exc_info[1].with_traceback(exc_info[2])
+                finally:
+                    exc_info = None
+            started[:] = [status, response_headers]
+
+        result = self.wsgi_app(environ, start_response)
+        close = getattr(result, "close", None)
+        iterator = iter(result)
+        chunks = []  # type: List[bytes]
+        try:
+            if not started:
+                # start_response may be deferred until the first chunk
+                chunk = _next_chunk(iterator)
+                if chunk is not _END:
+                    chunks.append(chunk)
+                else:
+                    iterator = None
+            status, response_headers = started
+            if iterator is not None and any(
+                name.lower() == "content-length" for name, _ in response_headers
+            ):
+                chunks.extend(iterator)
+                iterator = None
+            elif iterator is not None and not any(chunks):
+                chunk = _next_chunk(iterator)
+                if chunk is not _END:
+                    chunks.append(chunk)
+                else:
+                    iterator = None
+        except BaseException:
+            if close is not None:
+                close()
+            raise
+
+        headers = [
+            (name.lower().encode("latin-1"), value.encode("latin-1"))
+            for name, value in response_headers
+        ]
+        return int(status.split(" ", 1)[0]), headers, chunks, iterator, close
+
+
+def build_environ(scope, body):
+    # type: (Dict, bytes) -> Dict[str, Any]
+    """Return the WSGI environ for the ASGI HTTP request `scope` with the
+    given request body.
+
+    """
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }  # type: Dict[str, Any]
+    for raw_name, raw_value in scope.get("headers", []):
+        name = raw_name.decode("latin-1").upper().replace("-", "_")
+        value = raw_value.decode("latin-1")
+        if name == "CONTENT_TYPE":
+            key = "CONTENT_TYPE"
+        elif name == "CONTENT_LENGTH":
+            key = "CONTENT_LENGTH"
+        else:
+            key = "HTTP_" + name
+        if key in environ:
+            value = environ[key] + "," + value
+        environ[key] = value
+    return environ
+
+
+app = WSGIToASGI(
+    flask_app,
+    upstream_threads=max(1, int(utils.param_float("RESTD_ASGI_UPSTREAM_THREADS", 32))),
+    local_threads=max(1, int(utils.param_float("RESTD_ASGI_LOCAL_THREADS", 8))),
+    collector_threads=max(1, int(utils.param_float("RESTD_ASGI_COLLECTOR_THREADS", 8))),
+    watch_threads=max(1, int(utils.param_float("RESTD_WATCH_MAX_STREAMS", 16))),
+)
@@ -0,0 +1,165 @@
+"""The batch endpoint: several GET requests to the other endpoints in one
+round-trip.
+
+Each sub-request is handled exactly as if it had been sent on its own
+(with `Accept: application/json`), on a bounded pool of threads, and its
+JSON body is copied into the batch response as-is.  Identical
+sub-requests are only run once, and the sub-requests share the daemon
+objects they create.
+
+"""
+from __future__ import absolute_import
+
+import json
+
+try:
+    from typing import Dict, List, Optional, Tuple
+except ImportError:
+    pass
+
+from flask import Response, current_app, request
+from flask_restful import Resource, abort
+import six
+from six.moves.urllib.parse import parse_qsl, urlencode, urlsplit
+
+from . import admission, fanout, representations, utils
+
+
+# Paths that can be requested in a batch
+ALLOWED_PREFIXES = (
+    "/v1/jobs/",
+    "/v1/history/",
+    "/v1/grouped_jobs/",
+    "/v1/grouped_history/",
+    "/v1/status",
+    "/v1/grouped_status/",
+    "/v1/config",
+)
+
+# Headers of a sub-response that are passed on in the batch response
+PASSED_HEADERS = ("Link", "Age")
+
+
+def max_requests():
+    # type: () -> int
+    return max(1, int(utils.param_float("RESTD_BATCH_MAX_REQUESTS", 100)))
+
+
+def parallelism():
+    # type: () -> int
+    return max(1, int(utils.param_float("RESTD_BATCH_PARALLELISM", 8)))
+
+
+def normalize_path(path):
+    # type: (str) -> Optional[str]
+    """Return `path` with its query arguments sorted, so requests for the
+    same thing compare equal, or None if it isn't an allowed path.
+
+    """
+    parts = urlsplit(path)
+    if parts.scheme or parts.netloc or not parts.path.startswith(ALLOWED_PREFIXES):
+        return None
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return parts.path + ("?" + query if query else "")
+
+
+def _parse_body():
+    # type: () -> List[Tuple[str, str]]
+    """Return the (id, path) of each sub-request in the request body,
+    which is either a list of sub-requests or an object with the list in
+    `requests`.  A sub-request is an object with a `path` and an optional
+    `id` (by default its position in the list).
+
+    Aborts with a 400 if the body is invalid.
+
+    """
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        body = body.get("requests")
+    if not isinstance(body, list):
+        abort(400, message="Expected a list of requests")
+    if len(body) > max_requests():
+        abort(400, message="Too many requests in batch (at most %d)" % max_requests())
+    items = []
+    for i, item in enumerate(body):
+        if not isinstance(item, dict) or not isinstance(item.get("path"), six.string_types):
+            abort(400, message="Request %d has no path" % i)
+        item_id = item.get("id", str(i))
+        if not isinstance(item_id, six.string_types):
+            item_id = json.dumps(item_id)
+        if item_id in (existing for existing, _ in items):
+            abort(400, message="Duplicate request id: %s" % item_id)
+        items.append((item_id, item["path"]))
+    return items
+
+
+def _run(path, url_root, remote_addr):
+    # type: (str, str, Optional[str]) -> Tuple[int, str, Dict[str, str]]
+    """Handle a GET of `path` from the client at `remote_addr`, and return
+    the status code, JSON body, and passed-on headers of the response.
+
+    """
+    app = current_app._get_current_object()
+    # A new app context, so the sub-request has its own `g` (and metrics).
+    # The batch request was already charged to the client's rate limit.
+    environ = {"REMOTE_ADDR": remote_addr or "", admission.BATCH_ENVIRON_KEY: True}
+    with app.app_context(), app.test_request_context(
+        path,
+        base_url=url_root,
+        headers={"Accept": "application/json"},
+        environ_base=environ,
+    ):
+        resp = app.full_dispatch_request()
+        body = resp.get_data(as_text=True).strip()
+        if not resp.is_json or not body:
+            body = json.dumps(body or None)
+    headers = dict(
+        (name, resp.headers[name]) for name in PASSED_HEADERS if name in resp.headers
+    )
+    return resp.status_code, body, headers
+
+
+class V1BatchResource(Resource):
+    """Endpoint for running several requests at once; implements the
+    /v1/batch endpoint.
+
+    """
+
+    def post(self):
+        items = _parse_body()
+        results = {}  # type: Dict[str, Tuple[int, str, Dict[str, str]]]
+        paths = []  # type: List[str]
+        for _, path in items:
+            key = normalize_path(path)
+            if key is None:
+                results[path] = (
+                    404,
+                    json.dumps({"message": "Not a batchable path: %s" % path}),
+                    {},
+                )
+            elif key not in paths:
+                paths.append(key)
+
+        url_root = request.url_root
+        remote_addr = request.remote_addr
+        token = utils.shared_daemons.set({})
+        try:
+            for key, result, err in fanout.fan_out(
+                paths, lambda key: _run(key, url_root, remote_addr), max_workers=parallelism()
+            ):
+                if err is not None:
+                    code = 504 if isinstance(err, TimeoutError) else 500
+                    result = (code, json.dumps({"message": fanout.error_message(err)}), {})
+                results[key] = result
+        finally:
+            utils.shared_daemons.reset(token)
+
+        pieces = []
+        for item_id, path in items:
+            code, body, headers = results.get(normalize_path(path) or path)
+            piece = '%s: {"status": %d, ' % (json.dumps(item_id), code)
+            if headers:
+                piece += '"headers": %s, ' % json.dumps(headers)
+            pieces.append(piece + '"body": %s}' % body)
+        resp = Response("{%s}\n" % ", ".join(pieces), mimetype="application/json")
+        return representations.finish(resp)
@@ -0,0 +1,274 @@
+"""Compression of responses, negotiated with the Accept-Encoding header.
+
+gzip is always available; zstd and brotli are offered if the
+`zstandard` and `brotli` (or `brotlicffi`) modules are installed.
+Buffered responses smaller than RESTD_COMPRESSION_MIN_SIZE bytes
+(default 1024) are sent as is.  Streamed responses are compressed chunk
+by chunk, flushing after each chunk so the client can decode what it has
+received so far.
+
+RESTD_COMPRESSION_LEVEL sets the compression level for all encodings
+(clamped to each encoding's range); if unset, each encoding's default is
+used, and 0 disables compression.
+
+The compression ratio and CPU time of a buffered response are reported
+in its Server-Timing header; totals for all responses, including
+streamed ones, are available from stats().
+
+"""
+from __future__ import absolute_import
+
+import re
+import threading
+import time
+import zlib
+
+try:
+    from typing import Any, Dict, Iterable, Iterator, List, Optional
+except ImportError:
+    pass
+
+from flask import Response, request
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+from . import utils
+
+
+_ETAG_SUFFIX_RE = re.compile(r"-(gzip|br|zstd)$")
+
+
+class _GzipEncoder(object):
+    name = "gzip"
+    min_level, max_level, default_level = 1, 9, 6
+
+    def __init__(self, level):
+        self._obj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._obj.compress(data)
+
+    def flush(self):
+        return self._obj.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._obj.flush(zlib.Z_FINISH)
+
+
+class _ZstdEncoder(object):
+    name = "zstd"
+    min_level, max_level, default_level = 1, 19, 3
+
+    def __init__(self, level):
+        self._obj = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._obj.compress(data)
+
+    def flush(self):
+        return self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._obj.flush()
+
+
+class _BrotliEncoder(object):
+    name = "br"
+    min_level, max_level, default_level = 0, 11, 5
+
+    def __init__(self, level):
+        self._obj = brotli.Compressor(quality=level)
+        # brotli calls it process(), brotlicffi calls it compress()
+        self._process = getattr(self._obj, "process", None) or self._obj.compress
+
+    def compress(self, data):
+        return self._process(data)
+
+    def flush(self):
+        return self._obj.flush()
+
+    def finish(self):
+        return self._obj.finish()
+
+
+# In order of preference when the client accepts several equally
+ENCODERS = [
+    encoder
+    for encoder, available in [
+        (_ZstdEncoder, zstandard is not None),
+        (_BrotliEncoder, brotli is not None),
+        (_GzipEncoder, True),
+    ]
+    if available
+]
+
+
+def min_size():
+    # type: () -> float
+    return utils.param_float("RESTD_COMPRESSION_MIN_SIZE", 1024)
+
+
+def _level(encoder_class):
+    # type: (Any) -> int
+    level = utils.param_float("RESTD_COMPRESSION_LEVEL", -1)
+    if level < 0:
+        return encoder_class.default_level
+    return int(min(max(level, encoder_class.min_level), encoder_class.max_level))
+
+
+def enabled():
+    # type: () -> bool
+    return utils.param_float("RESTD_COMPRESSION_LEVEL", -1) != 0
+
+
+def negotiate():
+    # type: () -> Optional[Any]
+    """Return the encoder class for the encoding the client prefers, or
+    None if it accepts none of them (or only "identity").
+
+    """
+    name = request.accept_encodings.best_match([e.name for e in ENCODERS])
+    for encoder_class in ENCODERS:
+        if encoder_class.name == name:
+            return encoder_class
+    return None
+
+
+def strip_etag_suffix(etag):
+    # type: (str) -> str
+    """Return `etag` without the suffix added for a compressed response."""
+    return _ETAG_SUFFIX_RE.sub("", etag)
+
+
+class _Stats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {}  # type: Dict[str, List[float]]
+
+    def add(self, encoding, bytes_in, bytes_out, cpu_seconds):
+        with self._lock:
+            totals = self._totals.setdefault(encoding, [0, 0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += bytes_in
+            totals[2] += bytes_out
+            totals[3] += cpu_seconds
+
+    def get(self):
+        # type: () -> Dict[str, Dict[str, float]]
+        with self._lock:
+            return dict(
+                (
+                    encoding,
+                    dict(
+                        responses=t[0], bytes_in=t[1], bytes_out=t[2], cpu_seconds=t[3]
+                    ),
+                )
+                for encoding, t in self._totals.items()
+            )
+
+
+_stats = _Stats()
+
+
+def stats():
+    # type: () -> Dict[str, Dict[str, float]]
+    """Return the number of compressed responses, the bytes before and
+    after compression, and the CPU time spent, by encoding.
+
+    """
+    return _stats.get()
+
+
+def _compress_stream(chunks, encoder):
+    # type: (Iterable[bytes], Any) -> Iterator[bytes]
+    bytes_in = bytes_out = 0
+    cpu = 0.0
+    try:
+        for chunk in chunks:
+            if not chunk:
+                continue
+            start = time.thread_time()
+            out = encoder.compress(chunk) + encoder.flush()
+            cpu += time.thread_time() - start
+            bytes_in += len(chunk)
+            bytes_out += len(out)
+            yield out
+        start = time.thread_time()
+        out = encoder.finish()
+        cpu += time.thread_time() - start
+        bytes_out += len(out)
+        yield out
+    finally:
+        _stats.add(encoder.name, bytes_in, bytes_out, cpu)
+
+
+def compress_response(resp):
+    # type: (Response) -> Response
+    """Compress `resp` with the encoding negotiated with the client, if
+    it is worth compressing.  Meant to be registered as an
+    after_request handler.
+
+    """
+    if not enabled():
+        return resp
+    resp.vary.add("Accept-Encoding")
+    if (
+        request.method == "HEAD"
+        or "Content-Encoding" in resp.headers
+        or resp.status_code < 200
+        or resp.status_code == 204
+    ):
+        return resp
+    encoder_class = negotiate()
+    if encoder_class is None:
+        return resp
+
+    if resp.status_code == 304:
+        _add_etag_suffix(resp, encoder_class.name)
+        return resp
+
+    encoder = encoder_class(_level(encoder_class))
+    if resp.is_streamed:
+        resp.response = _compress_stream(resp.iter_encoded(), encoder)
+        resp.headers.pop("Content-Length", None)
+    else:
+        body = resp.get_data()
+        if len(body) < min_size():
+            return resp
+        start = time.thread_time()
+        compressed = encoder.compress(body) + encoder.finish()
+        cpu = time.thread_time() - start
+        if len(compressed) >= len(body):
+            return resp
+        resp.set_data(compressed)
+        _stats.add(encoder.name, len(body), len(compressed), cpu)
+        resp.headers.add(
+            "Server-Timing",
+            'compress;dur=%.3f;desc="%s %.1fx"'
+            % (cpu * 1000, encoder.name, float(len(body)) / max(len(compressed), 1)),
+        )
+    resp.headers["Content-Encoding"] = encoder.name
+    _add_etag_suffix(resp, encoder.name)
+    return resp
+
+
+def _add_etag_suffix(resp, encoding):
+    # type: (Response, str) -> None
+    """Make the ETag of a compressed response differ from the ETag of the
+    uncompressed one, as the bodies differ.
+
+    """
+    etag, weak = resp.get_etag()
+    if etag:
+        resp.set_etag("%s-%s" % (etag, encoding), weak)
@@ -0,0 +1,83 @@
+"""Conditional GET support: ETags, If-None-Match, and Cache-Control.
+
+Every successful JSON response gets a strong ETag.  By default this is a
+hash of the serialized body, which saves sending the body to a client
+that already has it.  Resources that can fingerprint their data more
+cheaply than running the query (e.g. status responses served from a
+pool snapshot) set the ETag themselves with make_etag(), and check
+not_modified() first, so an unchanged result isn't even computed.
+
+If RESTD_CACHE_MAX_AGE is set to a positive number of seconds, responses
+also get a `Cache-Control: max-age` header.
+
+"""
+from __future__ import absolute_import
+
+import hashlib
+
+try:
+    from typing import Any
+except ImportError:
+    pass
+
+from flask import Response, request
+
+from . import compression, utils
+
+
+def cache_max_age():
+    # type: () -> int
+    return max(0, int(utils.param_float("RESTD_CACHE_MAX_AGE", 0)))
+
+
+def make_etag(*parts):
+    # type: (*Any) -> str
+    """Return an (unquoted) ETag value made from hashing `parts`."""
+    digest = hashlib.sha1()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = str(part).encode("utf-8")
+        digest.update(part)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def not_modified(etag):
+    # type: (str) -> bool
+    """Return True if the request has an If-None-Match header matching
+    `etag`, i.e. the client already has the current representation.
+    The client may have gotten the ETag with a compressed response, in
+    which case it has an encoding suffix.
+
+    """
+    if request.method not in ("GET", "HEAD"):
+        return False
+    if_none_match = request.if_none_match
+    if if_none_match.star_tag:
+        return True
+    return any(
+        compression.strip_etag_suffix(client_etag) == etag
+        for client_etag in if_none_match.as_set()
+    )
+
+
+def finish_response(resp):
+    # type: (Response) -> Response
+    """Add the ETag (if the resource didn't set one) and Cache-Control
+    headers to a successful response, and turn it into a 304 Not
+    Modified if the request's If-None-Match matches.
+
+    """
+    if resp.status_code != 304 and not 200 <= resp.status_code < 300:
+        return resp
+    if "ETag" not in resp.headers:
+        if resp.status_code == 304:
+            return resp
+        resp.set_etag(make_etag(resp.get_data()))
+    max_age = cache_max_age()
+    if max_age:
+        resp.cache_control.max_age = max_age
+    if resp.status_code != 304 and not_modified(resp.get_etag()[0]):
+        resp.status_code = 304
+        resp.set_data(b"")
+    return resp
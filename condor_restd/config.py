@@ -1,17 +1,163 @@
 from __future__ import absolute_import
 
-from flask_restful import Resource, reqparse, abort
+import logging
+import threading
+import time
+
+try:
+    from typing import Dict, Optional, Set, Tuple
+except ImportError:
+    pass
+
+from flask_restful import Resource, inputs, reqparse, abort
 import six
 
 try:
-    from htcondor2 import DaemonTypes, Collector, RemoteParam
-    import htcondor2 as htcondor
+    from classad2 import ClassAd
+    from htcondor2 import DaemonTypes, RemoteParam
 except ImportError:
-    from htcondor import DaemonTypes, Collector, RemoteParam
-    import htcondor
+    from classad import ClassAd
+    from htcondor import DaemonTypes, RemoteParam
+
+from .errors import BAD_ATTRIBUTE, FAIL_QUERY, NO_ATTRIBUTE, DaemonNotFound
+from . import metrics, utils
+
+
+logger = logging.getLogger(__name__)
+
+
+def _remote_lookup(param, attribute):
+    # type: (RemoteParam, str) -> str
+    """Return the value of `attribute` (case-insensitive) from a daemon's
+    config, fetching only that value.  Raises KeyError if it's undefined.
+
+    """
+    # The names are fetched when the RemoteParam is created; iterating
+    # over them doesn't talk to the daemon, but getting a value does.
+    l_attribute = attribute.lower()
+    for key in param:
+        if key.lower() == l_attribute:
+            return param[key]
+    raise KeyError(attribute)
+
+
+class RemoteConfigCache(object):
+    """The config tables (with lowercased names) of running daemons, keyed
+    by daemon address, so browsing a daemon's config doesn't mean
+    fetching every value from it on every request.
+
+    Tables are kept for RESTD_REMOTE_CONFIG_CACHE_TTL seconds (default
+    60; 0 disables the cache).  A table that is used when it is more than
+    half that age is refreshed in a background thread, so tables that are
+    in use are usually served without waiting for the daemon.
+
+    """
+
+    MAX_ENTRIES = 256
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # address -> (time fetched, table)
+        self._entries = {}  # type: Dict[str, Tuple[float, Dict[str, str]]]
+        self._refreshing = set()  # type: Set[str]
+        self.hits = 0
+        self.misses = 0
+        self.background_refreshes = 0
+
+    @staticmethod
+    def ttl():
+        # type: () -> float
+        return utils.param_float("RESTD_REMOTE_CONFIG_CACHE_TTL", 60)
+
+    @staticmethod
+    def _fetch(location):
+        # type: (ClassAd) -> Dict[str, str]
+        return utils.deep_lcasekeys(RemoteParam(location))
 
-from .errors import BAD_ATTRIBUTE, FAIL_QUERY, NO_ATTRIBUTE
-from . import utils
+    def _store(self, address, table):
+        with self._lock:
+            if address not in self._entries and len(self._entries) >= self.MAX_ENTRIES:
+                self._entries.clear()
+            self._entries[address] = (time.monotonic(), table)
+
+    def _refresh(self, address, location):
+        try:
+            self._store(address, self._fetch(location))
+        except utils.CONDOR_ERRORS as err:
+            logger.warning("Failed to refresh the config of %s: %s", address, err)
+        finally:
+            with self._lock:
+                self._refreshing.discard(address)
+
+    def _cached(self, address, ttl):
+        # type: (str, float) -> Optional[Tuple[float, Dict[str, str]]]
+        with self._lock:
+            entry = self._entries.get(address)
+            if entry is None or time.monotonic() - entry[0] >= ttl:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry
+
+    def table(self, location):
+        # type: (ClassAd) -> Dict[str, str]
+        """Return the whole config of the daemon at `location`.  Errors
+        talking to the daemon are passed through.  The returned dict must
+        not be modified.
+
+        """
+        ttl = self.ttl()
+        if ttl <= 0:
+            return self._fetch(location)
+        address = str(location["MyAddress"])
+        entry = self._cached(address, ttl)
+        if entry is None:
+            table = self._fetch(location)
+            self._store(address, table)
+            return table
+        fetched, table = entry
+        if time.monotonic() - fetched > ttl / 2:
+            with self._lock:
+                start = address not in self._refreshing
+                self._refreshing.add(address)
+            if start:
+                self.background_refreshes += 1
+                thread = threading.Thread(
+                    target=self._refresh,
+                    args=(address, location),
+                    name="remote-config-%s" % address,
+                )
+                thread.daemon = True
+                thread.start()
+        return table
+
+    def lookup(self, location, attribute):
+        # type: (ClassAd, str) -> str
+        """Return the value of `attribute` (case-insensitive) from the
+        config of the daemon at `location`, from the cached table if there
+        is one, otherwise fetching just that value.  Raises KeyError if
+        it's undefined; errors talking to the daemon are passed through.
+
+        """
+        ttl = self.ttl()
+        if ttl > 0:
+            entry = self._cached(str(location["MyAddress"]), ttl)
+            if entry is not None:
+                return entry[1][attribute.lower()]
+        return _remote_lookup(RemoteParam(location), attribute)
+
+    def stats(self):
+        # type: () -> Dict[str, int]
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                background_refreshes=self.background_refreshes,
+                entries=len(self._entries),
+            )
+
+
+remote_config_cache = RemoteConfigCache()
 
 
 class V1ConfigResource(Resource):
@@ -32,33 +178,40 @@ class V1ConfigResource(Resource):
         """GET handler"""
         parser = reqparse.RequestParser(trim=True)
         parser.add_argument("daemon", location="args", choices=list(self.DAEMON_TYPES_MAP.keys()))
+        parser.add_argument("refresh", location="args", type=inputs.boolean, default=False)
         args = parser.parse_args()
 
-        param = None
+        if attribute:
+            if not utils.validate_attribute(attribute):
+                abort(400, message="%s: %s" % (BAD_ATTRIBUTE, attribute))
+            attribute = six.ensure_str(attribute)
+
         if args.daemon:
+            daemon_type = self.DAEMON_TYPES_MAP[args.daemon]
             daemon_ad = None
             try:
-                daemon_ad = Collector().locate(self.DAEMON_TYPES_MAP[args.daemon])
-            except (IOError, RuntimeError) as err:
+                with metrics.timed("locate"):
+                    daemon_ad = utils.location_cache.locate(daemon_type)
+            except (DaemonNotFound,) + utils.CONDOR_ERRORS as err:
+                metrics.upstream_error("collector")
                 abort(503, message=FAIL_QUERY % {"service": "collector", "err": err})
             try:
-                param = RemoteParam(daemon_ad)
-            except (IOError, RuntimeError) as err:
+                with metrics.timed("query"):
+                    if attribute:
+                        return remote_config_cache.lookup(daemon_ad, attribute)
+                    return dict(remote_config_cache.table(daemon_ad))
+            except KeyError:
+                abort(404, message="%s: %s" % (NO_ATTRIBUTE, attribute))
+            except utils.CONDOR_ERRORS as err:
+                utils.location_cache.invalidate(daemon_type)
+                metrics.upstream_error(args.daemon)
                 abort(503, message=FAIL_QUERY % {"service": args.daemon, "err": err})
-        else:
-            htcondor.reload_config()
-            param = htcondor.param
-
-        param_lower = utils.deep_lcasekeys(param)
-
-        if attribute:
-            if not utils.validate_attribute(attribute):
-                abort(400, message="%s: %s" % (BAD_ATTRIBUTE, attribute))
 
+        param_lower = utils.param_table.table(refresh=args.refresh)
         if attribute:
             try:
-                return param_lower[six.ensure_str(attribute).lower()]
+                return param_lower[attribute.lower()]
             except KeyError:
                 abort(404, message="%s: %s" % (NO_ATTRIBUTE, attribute))
 
-        return param_lower
+        return dict(param_lower)
@@ -0,0 +1,158 @@
+"""Delta queries of the jobs in a queue: the jobs added or changed since
+an earlier response, and the jobs that have left the queue, so clients
+keeping a copy of the queue don't have to download all of it each time.
+
+For each query (schedd, constraint and projection) used with `since`,
+the restd keeps a fingerprint of each job and the version of the query
+in which the job last changed, plus the IDs of the jobs that left the
+queue recently (at most RESTD_DELTA_MAX_REMOVED of them).  Attributes
+updated on a timer (VOLATILE_ATTRS, e.g. ServerTime) are left out of the
+fingerprint, so they don't make every job look changed.  Each response
+gets a token with the current version; a later response for that token
+only has the jobs whose version is newer.  The schedd is still queried
+for all the jobs every time; only the response shrinks.
+
+A token can only be used with the restd process that issued it, and
+only as long as the removals since it are remembered; otherwise (or if
+no token is given) the response has all the jobs and `full` is true,
+and the client should replace its copy.
+
+"""
+from __future__ import absolute_import
+
+import collections
+import hashlib
+import json
+import os
+import threading
+
+try:
+    from typing import Deque, Dict, List, Optional, Tuple
+except ImportError:
+    pass
+
+from . import utils
+
+
+# Attributes (lowercased) that the schedd and shadow update on a timer
+# rather than when something happens to the job; changes to only these
+# don't make a job changed.  A changed job is sent with their current
+# values.
+VOLATILE_ATTRS = frozenset(
+    [
+        "servertime",
+        "currenttime",
+        "lastjobleaserenewal",
+        "lastremotestatusupdate",
+        "updateshistory",
+        "updateslost",
+        "updatessequenced",
+        "updatestotal",
+    ]
+)
+
+
+def max_queries():
+    # type: () -> int
+    return max(1, int(utils.param_float("RESTD_DELTA_MAX_QUERIES", 16)))
+
+
+def max_removed():
+    # type: () -> int
+    return max(1, int(utils.param_float("RESTD_DELTA_MAX_REMOVED", 100000)))
+
+
+def _fingerprint(ad_dict):
+    # type: (Dict) -> bytes
+    stable = dict(
+        (name, value) for name, value in ad_dict.items() if name not in VOLATILE_ATTRS
+    )
+    return hashlib.md5(
+        json.dumps(stable, sort_keys=True, default=str).encode("utf-8")
+    ).digest()
+
+
+class DeltaTracker(object):
+    """The versions of the jobs returned by one query."""
+
+    def __init__(self):
+        # Identifies this tracker, so tokens from another process (or an
+        # evicted tracker) aren't mistaken for ours
+        self.instance = os.urandom(6).hex()
+        self.version = 0
+        # (ClusterId, ProcId) -> (fingerprint, version it last changed in)
+        self._jobs = {}  # type: Dict[Tuple[int, int], Tuple[bytes, int]]
+        # (version, (ClusterId, ProcId)) of the jobs that left, oldest first
+        self._removed = collections.deque()  # type: Deque[Tuple[int, Tuple[int, int]]]
+        # Tokens older than this can't be answered with a delta; removals
+        # before it have been forgotten
+        self._oldest = 0
+        self._lock = threading.Lock()
+
+    def update(self, ad_dicts, since):
+        # type: (List[Dict], Optional[int]) -> Tuple[List[Dict], List[Tuple[int, int]], int, bool]
+        """Record the current jobs of the query (each with `clusterid` and
+        `procid`), and return the jobs that changed after version `since`,
+        the IDs of the jobs that left after it, the new version, and
+        whether the result is full (all the jobs) because `since` is None
+        or too old.
+
+        """
+        with self._lock:
+            version = self.version + 1
+            changed = False
+            seen = set()
+            for ad in ad_dicts:
+                key = (ad["clusterid"], ad["procid"])
+                seen.add(key)
+                fingerprint = _fingerprint(ad)
+                previous = self._jobs.get(key)
+                if previous is None or previous[0] != fingerprint:
+                    self._jobs[key] = (fingerprint, version)
+                    changed = True
+            for key in [key for key in self._jobs if key not in seen]:
+                del self._jobs[key]
+                self._removed.append((version, key))
+                changed = True
+            limit = max_removed()
+            while len(self._removed) > limit:
+                self._oldest = self._removed.popleft()[0]
+            if changed:
+                self.version = version
+
+            if since is None or since < self._oldest or since > self.version:
+                return ad_dicts, [], self.version, True
+            jobs = self._jobs
+            # A job that left and came back is in the queue, not removed
+            removed = []  # type: List[Tuple[int, int]]
+            removed_keys = set()
+            for key_version, key in self._removed:
+                if key_version > since and key not in jobs and key not in removed_keys:
+                    removed.append(key)
+                    removed_keys.add(key)
+            return (
+                [ad for ad in ad_dicts if jobs[(ad["clusterid"], ad["procid"])][1] > since],
+                removed,
+                self.version,
+                False,
+            )
+
+
+_trackers = collections.OrderedDict()  # type: collections.OrderedDict
+_trackers_lock = threading.Lock()
+
+
+def get_tracker(key):
+    # type: (Tuple) -> DeltaTracker
+    """Return the tracker for a query, creating it if necessary.  Only
+    the RESTD_DELTA_MAX_QUERIES most recently used are kept.
+
+    """
+    with _trackers_lock:
+        tracker = _trackers.pop(key, None)
+        if tracker is None:
+            tracker = DeltaTracker()
+        _trackers[key] = tracker
+        while len(_trackers) > max_queries():
+            _trackers.popitem(last=False)
+        return tracker
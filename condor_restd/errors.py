@@ -3,7 +3,9 @@ NO_CLASSADS = "No matching classads"
 NO_ATTRIBUTE = "Undefined attribute"
 BAD_ATTRIBUTE = "Invalid attribute"
 BAD_PROJECTION = "Invalid attribute(s) in projection"
+BAD_PROFILE = "Unknown projection profile"
 BAD_GROUPBY = "Invalid attribute for grouping"
+BAD_AGGREGATE = "Invalid aggregate"
 FAIL_QUERY = "Error querying %(service)s: %(err)s"
 
 
@@ -0,0 +1,111 @@
+"""Running the same query against several daemons at once.
+
+The number of daemons queried at a time is limited by
+RESTD_FANOUT_PARALLELISM (default 8), and each query is given up on
+after RESTD_FANOUT_TIMEOUT seconds (default 30).  The bindings can't
+cancel a query, so a timed-out query keeps its thread until it finishes
+but its result is discarded.
+
+"""
+from __future__ import absolute_import
+
+import contextvars
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+try:
+    from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+except ImportError:
+    pass
+
+from werkzeug.exceptions import HTTPException
+
+from . import utils
+
+
+def parallelism():
+    # type: () -> int
+    return max(1, int(utils.param_float("RESTD_FANOUT_PARALLELISM", 8)))
+
+
+def timeout():
+    # type: () -> float
+    return utils.param_float("RESTD_FANOUT_TIMEOUT", 30)
+
+
+def error_message(err):
+    # type: (BaseException) -> str
+    """Return the message to report for a failed query: the message of an
+    abort() if it was one, otherwise the exception text.
+
+    """
+    if isinstance(err, HTTPException):
+        data = getattr(err, "data", None) or {}
+        return str(data.get("message") or err.description or err)
+    return str(err)
+
+
+def fan_out(names, func, max_workers=None, per_call_timeout=None):
+    # type: (List[str], Callable[[str], Any], Optional[int], Optional[float]) -> Iterator[Tuple[str, Any, Optional[BaseException]]]
+    """Call `func(name)` for each of `names` on a pool of at most
+    `max_workers` threads, and yield (name, result, None) or
+    (name, None, error) as each call finishes, in the order they finish.
+    A call that has been running for more than `per_call_timeout` seconds
+    is reported as a TimeoutError.  The defaults come from the config.
+
+    The calls run in copies of the caller's context, so they see the
+    current request (and add their timings to its metrics).
+
+    """
+    if not names:
+        return
+    if max_workers is None:
+        max_workers = parallelism()
+    if per_call_timeout is None:
+        per_call_timeout = timeout()
+
+    started = {}  # type: Dict[str, float]
+
+    def run(name):
+        started[name] = time.monotonic()
+        return func(name)
+
+    executor = ThreadPoolExecutor(
+        max_workers=min(max_workers, len(names)), thread_name_prefix="restd-fanout"
+    )
+    futures = dict(
+        (executor.submit(contextvars.copy_context().run, run, name), name)
+        for name in names
+    )
+    pending = set(futures)
+    try:
+        while pending:
+            deadlines = [
+                started[futures[f]] + per_call_timeout
+                for f in pending
+                if futures[f] in started
+            ]
+            wait_for = per_call_timeout
+            if deadlines:
+                wait_for = max(0, min(deadlines) - time.monotonic())
+            done, pending = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = futures[future]
+                try:
+                    result = future.result()
+                except Exception as err:
+                    yield name, None, err
+                else:
+                    yield name, result, None
+            now = time.monotonic()
+            for future in list(pending):
+                name = futures[future]
+                if name in started and now - started[name] >= per_call_timeout:
+                    pending.discard(future)
+                    yield name, None, TimeoutError(
+                        "No response after %g seconds" % per_call_timeout
+                    )
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
@@ -0,0 +1,480 @@
+"""Lookups of single jobs and clusters in the local schedd's history
+files, read directly instead of through the schedd, which would scan
+the whole history backwards.
+
+Enabled by setting RESTD_HISTORY_INDEX_DIR to a directory writable by
+the restd.  The history files (HISTORY and its rotations, which must be
+readable by the restd) are memory-mapped, and for each file an index of
+where the records of each cluster are is saved in that directory.  The
+index of the current history file is extended as jobs are added to it;
+rotated files never change, so their indexes are only built once.
+
+A history file is a sequence of job ads in the old classad syntax, each
+followed by a banner line such as
+
+    *** ProcId = 0 ClusterId = 123 Owner = "alice" CompletionDate = 1700000000
+
+The index is sparse: consecutive records of the same cluster are stored
+as a single byte range, and records are only parsed when looked up.
+
+Queries that aren't for one cluster can be answered by scanning the
+records newest first, as the schedd would, but within a budget: at most
+RESTD_HISTORY_SCAN_LIMIT records and RESTD_HISTORY_SCAN_TIME seconds.
+Scans are only used when something bounds them (a budget, or a `since`
+where the scan stops); otherwise the schedd is queried.
+When the budget runs out, or enough jobs have been found, the scan stops
+and returns the position it got to, from which a later scan can
+continue.
+
+"""
+from __future__ import absolute_import
+
+import bisect
+import errno
+import json
+import logging
+import mmap
+import os
+import re
+import tempfile
+import threading
+import time
+
+try:
+    from typing import Dict, Iterator, List, Optional, Tuple
+except ImportError:
+    pass
+
+try:
+    import classad2 as classad
+except ImportError:
+    import classad
+
+from flask import g, has_request_context
+
+from . import utils
+
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+
+_BANNER_RE = re.compile(br"^\*\*\*[^\n]*\n", re.MULTILINE)
+_CLUSTER_RE = re.compile(br"\bClusterId\s*=\s*(\d+)")
+_PROC_RE = re.compile(br"\bProcId\s*=\s*(\d+)")
+_ROTATION_SUFFIX_RE = re.compile(r"^\.\d{8}T\d{6}$")
+
+if hasattr(classad, "ParserType"):
+    _OLD_PARSER = classad.ParserType.Old
+else:
+    _OLD_PARSER = classad.Parser.Old
+
+
+def index_dir():
+    # type: () -> str
+    return str(utils.param_table.get("RESTD_HISTORY_INDEX_DIR", "") or "")
+
+
+def scan_limit():
+    # type: () -> int
+    return int(utils.param_float("RESTD_HISTORY_SCAN_LIMIT", 0))
+
+
+def scan_time():
+    # type: () -> float
+    return utils.param_float("RESTD_HISTORY_SCAN_TIME", 0)
+
+
+def scan_bounded():
+    # type: () -> bool
+    """Return True if scans have a budget.  Without one, a scan for an
+    arbitrary constraint can read the whole history in Python, which is
+    slower than the schedd's own scan.
+
+    """
+    return scan_limit() > 0 or scan_time() > 0
+
+
+def _banner_ids(banner):
+    # type: (bytes) -> Tuple[Optional[int], Optional[int]]
+    cluster = _CLUSTER_RE.search(banner)
+    proc = _PROC_RE.search(banner)
+    return (
+        int(cluster.group(1)) if cluster else None,
+        int(proc.group(1)) if proc else None,
+    )
+
+
+def _mapped(path, file_id=None):
+    # type: (str, Optional[Tuple[int, int]]) -> Optional[mmap.mmap]
+    """Return a read-only memory map of the file at `path`, or None if
+    it is empty, gone, or (if `file_id` is given) no longer that file.
+
+    """
+    try:
+        f = open(path, "rb")
+    except (IOError, OSError) as err:
+        if err.errno == errno.ENOENT:
+            return None  # Rotated away since the last refresh
+        raise
+    with f:
+        st = os.fstat(f.fileno())
+        if st.st_size == 0 or (file_id is not None and (st.st_dev, st.st_ino) != file_id):
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class HistoryFileIndex(object):
+    """The byte ranges of the records of each cluster in one history
+    file, identified by its device and inode so it stays valid when the
+    file is renamed by rotation.
+
+    """
+
+    def __init__(self, file_id):
+        # type: (Tuple[int, int]) -> None
+        self.file_id = file_id
+        # Bytes of the file indexed so far (the end of the last record)
+        self.size = 0
+        # cluster -> [[start, end], ...], in file order
+        self.clusters = {}  # type: Dict[int, List[List[int]]]
+        # The ranges of all the clusters (the same lists), in file order
+        self.ranges = []  # type: List[List[int]]
+        # The cluster and range of the last record, to extend the range
+        # if the next record is of the same cluster
+        self._last = None  # type: Optional[Tuple[int, List[int]]]
+
+    def filename(self):
+        # type: () -> str
+        return "history-%d-%d.json" % self.file_id
+
+    def extend(self, data):
+        # type: (mmap.mmap) -> bool
+        """Index the records after the part already indexed.  Return True
+        if anything was added.
+
+        """
+        start = self.size
+        for match in _BANNER_RE.finditer(data, start):
+            cluster, _ = _banner_ids(match.group(0))
+            end = match.end()
+            if cluster is not None:
+                if self._last is not None and self._last[0] == cluster and self._last[1][1] == start:
+                    self._last[1][1] = end
+                else:
+                    byte_range = [start, end]
+                    self.clusters.setdefault(cluster, []).append(byte_range)
+                    self.ranges.append(byte_range)
+                    self._last = (cluster, byte_range)
+            start = end
+        added = start != self.size
+        self.size = start
+        return added
+
+    def save(self, directory):
+        # type: (str) -> None
+        data = dict(
+            version=INDEX_VERSION,
+            size=self.size,
+            clusters=dict((str(k), v) for k, v in self.clusters.items()),
+        )
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".history-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f, separators=(",", ":"))
+            os.rename(tmp_path, os.path.join(directory, self.filename()))
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, directory, file_id):
+        # type: (str, Tuple[int, int]) -> Optional[HistoryFileIndex]
+        """Return the saved index of a file, or None if there isn't a
+        usable one.
+
+        """
+        index = cls(file_id)
+        try:
+            with open(os.path.join(directory, index.filename())) as f:
+                data = json.load(f)
+            if data.get("version") != INDEX_VERSION:
+                return None
+            index.size = int(data["size"])
+            index.clusters = dict((int(k), v) for k, v in data["clusters"].items())
+            index.ranges = sorted(
+                byte_range for ranges in index.clusters.values() for byte_range in ranges
+            )
+        except (IOError, OSError, KeyError, TypeError, ValueError):
+            return None
+        return index
+
+    def records(self, data, cluster, proc=None, size=None):
+        # type: (mmap.mmap, int, Optional[int], Optional[int]) -> Iterator[bytes]
+        """Yield the text of the records of `cluster` (and `proc`, if
+        given) in the first `size` bytes (by default, the indexed part),
+        last first.
+
+        """
+        if size is None:
+            size = self.size
+        for start, end in reversed(self.clusters.get(cluster, [])):
+            if start >= size:
+                continue  # Indexed after `size` was taken
+            chunk = data[start : min(end, size)]
+            records = []
+            record_start = 0
+            for match in _BANNER_RE.finditer(chunk):
+                record_cluster, record_proc = _banner_ids(match.group(0))
+                if record_cluster == cluster and (proc is None or record_proc == proc):
+                    records.append(chunk[record_start : match.start()])
+                record_start = match.end()
+            for record in reversed(records):
+                yield record
+
+    def all_records(self, data, before=None):
+        # type: (mmap.mmap, Optional[int]) -> Iterator[Tuple[int, bytes]]
+        """Yield the (end offset, text) of every record ending at or before
+        offset `before` (or the end of the indexed part), last first.
+
+        """
+        # The ranges starting before `before`
+        count = len(self.ranges) if before is None else bisect.bisect_left(self.ranges, [before])
+        for i in range(count - 1, -1, -1):
+            start, end = self.ranges[i]
+            chunk = data[start:end]
+            records = []
+            record_start = 0
+            for match in _BANNER_RE.finditer(chunk):
+                if before is None or start + match.end() <= before:
+                    records.append((start + match.end(), chunk[record_start : match.start()]))
+                record_start = match.end()
+            for record in reversed(records):
+                yield record
+
+
+class HistoryIndex(object):
+    """The indexes of the history file at `path` and its rotations."""
+
+    def __init__(self, path, directory):
+        self.path = path
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._indexes = {}  # type: Dict[Tuple[int, int], HistoryFileIndex]
+        # (path, file id) of the history files as of the last refresh,
+        # newest first
+        self._files = []  # type: List[Tuple[str, Tuple[int, int]]]
+
+    def _paths(self):
+        # type: () -> List[str]
+        """Return the paths of the history files, oldest first."""
+        history_dir, base = os.path.split(self.path)
+        rotated = sorted(
+            os.path.join(history_dir, name)
+            for name in os.listdir(history_dir or ".")
+            if name.startswith(base) and _ROTATION_SUFFIX_RE.match(name[len(base) :])
+        )
+        if os.path.exists(self.path):
+            rotated.append(self.path)
+        return rotated
+
+    def _refresh(self):
+        """Bring the indexes up to date with the history files.  Errors
+        reading the files are passed through.
+
+        """
+        files = []
+        for path in self._paths():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue  # Rotated away since listing
+            file_id = (st.st_dev, st.st_ino)
+            index = self._indexes.get(file_id)
+            if index is None:
+                index = HistoryFileIndex.load(self.directory, file_id)
+            if index is None or index.size > st.st_size:
+                index = HistoryFileIndex(file_id)
+            if index.size < st.st_size:
+                data = _mapped(path, file_id)
+                if data is not None:
+                    try:
+                        if index.extend(data):
+                            try:
+                                index.save(self.directory)
+                            except (IOError, OSError) as err:
+                                logger.warning("Failed to save history index: %s", err)
+                    finally:
+                        data.close()
+            self._indexes[file_id] = index
+            files.append((path, file_id))
+        # Forget the indexes of files that have been deleted
+        current = set(file_id for _, file_id in files)
+        for file_id in list(self._indexes):
+            if file_id not in current:
+                index = self._indexes.pop(file_id)
+                try:
+                    os.unlink(os.path.join(self.directory, index.filename()))
+                except OSError:
+                    pass
+        files.reverse()
+        self._files = files
+
+    def refresh(self):
+        """Bring the indexes up to date.  Queries only see the history as
+        of the last refresh.  Errors are passed through.
+
+        """
+        with self._lock:
+            self._refresh()
+
+    def _snapshot(self):
+        # type: () -> List[Tuple[str, Tuple[int, int], HistoryFileIndex, int]]
+        """Return the (path, file id, index, indexed size) of the files as
+        of the last refresh, newest first.  The records are read without
+        the lock, only up to the indexed size, since a refresh may extend
+        the indexes meanwhile.
+
+        """
+        with self._lock:
+            return [
+                (path, file_id, self._indexes[file_id], self._indexes[file_id].size)
+                for path, file_id in self._files
+            ]
+
+    def query(self, clusterid, procid, constraint, projection_list=None, limit=-1):
+        # type: (int, Optional[int], str, Optional[List[str]], int) -> List[Dict]
+        """Return the jobs of cluster `clusterid` (and with proc ID
+        `procid`, if given) that match `constraint`, most recently
+        finished first, with only the attributes in `projection_list` if
+        it's non-empty, and at most `limit` of them if it's not negative.
+
+        Raises SyntaxError if the constraint can't be parsed; errors
+        reading the files are passed through.
+
+        """
+        expr = None
+        if constraint and constraint.strip().lower() != "true":
+            expr = utils.parse_expr(constraint)
+        results = []  # type: List[Dict]
+        for path, file_id, index, size in self._snapshot():
+            if clusterid not in index.clusters:
+                continue
+            data = _mapped(path, file_id)
+            if data is None:
+                continue
+            try:
+                for record in index.records(data, clusterid, procid, size):
+                    if limit is not None and 0 <= limit <= len(results):
+                        return results
+                    ad = classad.parseOne(record.decode("utf-8", "replace"), _OLD_PARSER)
+                    if expr is not None and expr.eval(ad) is not True:
+                        continue
+                    ad_dict = utils.classad_to_dict(ad)
+                    if projection_list:
+                        ad_dict = dict(
+                            (k, ad_dict[k]) for k in projection_list if k in ad_dict
+                        )
+                    results.append(ad_dict)
+            finally:
+                data.close()
+        return results
+
+    def scan(self, constraint, projection_list=None, limit=-1, since=None, resume=None):
+        # type: (str, Optional[List[str]], int, Optional[str], Optional[Tuple[int, int, int]]) -> Tuple[List[Dict], Optional[Tuple[int, int, int]]]
+        """Return the jobs that match `constraint`, most recently finished
+        first, like query() but for any cluster, by reading the records
+        one by one.  The scan stops before the first record for which
+        the expression `since` is true, or after `limit` matches.
+
+        Also return None if the scan finished, or if it stopped early (the
+        scan budget ran out, or `limit` was reached with records left),
+        the (device, inode, offset) to `resume` a later scan from.
+
+        Raises SyntaxError if an expression can't be parsed, and
+        ValueError if the `resume` position is no longer in the history;
+        errors reading the files are passed through.
+
+        """
+        expr = None
+        if constraint and constraint.strip().lower() != "true":
+            expr = utils.parse_expr(constraint)
+        since_expr = utils.parse_expr(since) if since else None
+        max_records = scan_limit()
+        budget = scan_time()
+        deadline = time.monotonic() + budget if budget > 0 else None
+        results = []  # type: List[Dict]
+        examined = 0
+        files = self._snapshot()
+        if resume is not None:
+            ids = [file_id for _, file_id, _, _ in files]
+            if tuple(resume[:2]) not in ids:
+                raise ValueError("resume position is no longer in the history")
+            files = files[ids.index(tuple(resume[:2])) :]
+        for path, file_id, index, size in files:
+            data = _mapped(path, file_id)
+            if data is None:
+                continue
+            before = size
+            if resume is not None and file_id == tuple(resume[:2]):
+                before = min(resume[2], size)
+            try:
+                for end, record in index.all_records(data, before):
+                    if (
+                        (limit is not None and 0 <= limit <= len(results))
+                        or 0 < max_records <= examined
+                        or (deadline is not None and time.monotonic() > deadline)
+                    ):
+                        return results, (file_id[0], file_id[1], end)
+                    examined += 1
+                    ad = classad.parseOne(record.decode("utf-8", "replace"), _OLD_PARSER)
+                    if since_expr is not None and since_expr.eval(ad) is True:
+                        return results, None
+                    if expr is not None and expr.eval(ad) is not True:
+                        continue
+                    ad_dict = utils.classad_to_dict(ad)
+                    if projection_list:
+                        ad_dict = dict(
+                            (k, ad_dict[k]) for k in projection_list if k in ad_dict
+                        )
+                    results.append(ad_dict)
+            finally:
+                data.close()
+        return results, None
+
+
+_indexes = {}  # type: Dict[Tuple[str, str], HistoryIndex]
+_indexes_lock = threading.Lock()
+
+
+def get_index(schedd_name):
+    # type: (Optional[str]) -> Optional[HistoryIndex]
+    """Return the up-to-date history index of `schedd_name` (None for the
+    default schedd), building it first if necessary.  Return None if
+    indexes are disabled, the schedd isn't the local one, or the history
+    files can't be read, in which case the caller should query the schedd.
+
+    The index is only refreshed once per request.
+
+    """
+    directory = index_dir()
+    if not directory or not utils.is_local_schedd(schedd_name):
+        return None
+    path = utils.param_table.get("HISTORY")
+    if not path:
+        return None
+    key = (str(path), directory)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            index = _indexes[key] = HistoryIndex(str(path), directory)
+    if has_request_context() and g.get("restd_history_index") is index:
+        return index
+    try:
+        index.refresh()
+    except (IOError, OSError, ValueError) as err:
+        logger.warning("Failed to index history file %s: %s", path, err)
+        return None
+    if has_request_context():
+        g.restd_history_index = index
+    return index
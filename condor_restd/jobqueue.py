@@ -0,0 +1,443 @@
+"""An in-memory replica of a co-located schedd's job queue, kept up to
+date by tailing the schedd's job queue log, used to answer the jobs and
+grouped_jobs endpoints without sending a query to the schedd.
+
+Enabled by setting RESTD_JOB_QUEUE_REPLICA_INTERVAL to the number of
+seconds between reads of the log (JOB_QUEUE_LOG, which must be readable
+by the restd).  The replica is only used for the local schedd: requests
+for DEFAULT or for the schedd named by SCHEDD_NAME (or FULL_HOSTNAME).
+
+The job queue log is a transaction log of classad operations, one per
+line:
+
+    101 <key> <mytype> <targettype>     NewClassAd
+    102 <key>                           DestroyClassAd
+    103 <key> <attr> <value>            SetAttribute
+    104 <key> <attr>                    DeleteAttribute
+    105                                 BeginTransaction
+    106                                 EndTransaction
+
+Operations inside a transaction take effect when it ends.  Keys are
+`cluster.proc`; cluster ads (whose attributes are inherited by the jobs
+of the cluster) have proc -1, and the header ad is 0.0.  When the schedd
+compacts the log it writes a new file and renames it over the old one;
+the replica then rereads it from the start, and queries go to the schedd
+until it has caught up.
+
+Private attributes (claim IDs, transfer keys, `_condor_priv*` secrets,
+and those listed in SECURE_JOB_ATTRS), which the schedd never sends to
+a query, are not kept.
+
+"""
+from __future__ import absolute_import
+
+import logging
+import os
+import threading
+import time
+
+try:
+    from typing import Dict, List, Optional, Set, Tuple
+except ImportError:
+    pass
+
+try:
+    import classad2 as classad
+except ImportError:
+    import classad
+
+from flask import g, has_request_context
+
+from . import utils
+
+
+logger = logging.getLogger(__name__)
+
+NEW_CLASSAD = "101"
+DESTROY_CLASSAD = "102"
+SET_ATTRIBUTE = "103"
+DELETE_ATTRIBUTE = "104"
+BEGIN_TRANSACTION = "105"
+END_TRANSACTION = "106"
+
+# Stop tailing the log if the replica hasn't been used in this many seconds.
+IDLE_TIMEOUT = 600
+
+# Don't use a replica that hasn't caught up with the log in this many
+# intervals (e.g. because the log can't be read); query the schedd instead.
+MAX_AGE_INTERVALS = 3
+
+# Read the log in pieces of this many bytes
+READ_SIZE = 1024 * 1024
+
+# Attributes (lowercased) the schedd doesn't send to queries: the ClassAd
+# library's private attributes, plus any name starting with
+# PRIVATE_PREFIX
+PRIVATE_ATTRS = frozenset(
+    [
+        "capability",
+        "childclaimids",
+        "claimid",
+        "claimidlist",
+        "claimids",
+        "pairedclaimid",
+        "transferkey",
+    ]
+)
+PRIVATE_PREFIX = "_condor_priv"
+
+if hasattr(classad, "ParserType"):
+    _OLD_PARSER = classad.ParserType.Old
+else:
+    _OLD_PARSER = classad.Parser.Old
+
+
+def replica_interval():
+    # type: () -> float
+    return utils.param_float("RESTD_JOB_QUEUE_REPLICA_INTERVAL", 0)
+
+
+def parse_key(key):
+    # type: (str) -> Optional[Tuple[int, int]]
+    """Return the (cluster, proc) of a job queue log key, or None if it
+    isn't one.
+
+    """
+    cluster, _, proc = key.partition(".")
+    try:
+        return int(cluster), int(proc)
+    except ValueError:
+        return None
+
+
+def private_attrs():
+    # type: () -> Set[str]
+    """Return the lowercased names of the private job attributes:
+    PRIVATE_ATTRS plus those in SECURE_JOB_ATTRS.
+
+    """
+    secure = str(utils.param_table.get("SECURE_JOB_ATTRS", "") or "")
+    return set(PRIVATE_ATTRS).union(
+        name.lower() for name in secure.replace(",", " ").split()
+    )
+
+
+def _project(ad_dict, projection_list):
+    # type: (Dict, Optional[List[str]]) -> Dict
+    if projection_list:
+        return dict((k, ad_dict[k]) for k in projection_list if k in ad_dict)
+    return dict(ad_dict)
+
+
+class JobQueueReplica(object):
+    """The job and cluster ads in a job queue log.  Attribute values are
+    kept as the expression text from the log; each job's classad (and
+    its conversion to a dict) is built when it is first queried, and
+    thrown away when the job or its cluster ad changes.  Ads are built
+    and matched without the lock, so a large query doesn't hold up the
+    thread following the log or other queries.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.last_used = time.monotonic()
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None  # type: Optional[threading.Thread]
+        self._private = private_attrs()
+        self._reset()
+
+    def _reset(self):
+        # Changes with each reset, so ads built before one aren't saved
+        self._generation = getattr(self, "_generation", 0) + 1
+        # (cluster, proc) -> {lowercased name: (name, value text)}
+        self._attrs = {}  # type: Dict[Tuple[int, int], Dict[str, Tuple[str, str]]]
+        # cluster -> job keys of the cluster
+        self._procs = {}  # type: Dict[int, Set[Tuple[int, int]]]
+        # job key -> (classad, dict)
+        self._built = {}  # type: Dict[Tuple[int, int], Tuple[classad.ClassAd, Dict]]
+        # job key -> number of the last change to it (or its cluster), so
+        # an ad built from older attributes isn't saved
+        self._changed = {}  # type: Dict[Tuple[int, int], int]
+        self._changes = 0
+        self._transaction = None  # type: Optional[List[List[str]]]
+        self._inode = None  # type: Optional[Tuple[int, int]]
+        self._offset = 0
+        self._partial = b""
+        # monotonic time the log was last read to the end, with no
+        # transaction in progress; None until the whole log has been read
+        self._synced = None  # type: Optional[float]
+
+    def _forget(self, key):
+        # type: (Tuple[int, int]) -> None
+        """Drop the built ads of a job, or of all the jobs of a cluster."""
+        self._changes += 1
+        job_keys = self._procs.get(key[0], ()) if key[1] < 0 else (key,)
+        for job_key in job_keys:
+            self._built.pop(job_key, None)
+            self._changed[job_key] = self._changes
+
+    def apply(self, fields):
+        # type: (List[str]) -> None
+        """Apply one operation (a log line split into op, key, and the
+        rest).  Operations inside a transaction are saved until it ends.
+
+        """
+        op = fields[0]
+        if op == BEGIN_TRANSACTION:
+            self._transaction = []
+            return
+        if op == END_TRANSACTION:
+            transaction, self._transaction = self._transaction or [], None
+            for saved in transaction:
+                self._apply_now(saved)
+            return
+        if self._transaction is not None:
+            self._transaction.append(fields)
+        else:
+            self._apply_now(fields)
+
+    def _apply_now(self, fields):
+        # type: (List[str]) -> None
+        if len(fields) < 2:
+            return
+        key = parse_key(fields[1])
+        # Skip the header ad (0.0) and ads that aren't jobs or clusters
+        # (e.g. job sets)
+        if key is None or key[0] <= 0 or key[1] < -1:
+            return
+        op = fields[0]
+        if op == NEW_CLASSAD:
+            self._forget(key)
+            attrs = self._attrs[key] = {}
+            types = fields[2].split() if len(fields) > 2 else []
+            if len(types) == 2:
+                attrs["mytype"] = ("MyType", classad.quote(types[0]))
+                attrs["targettype"] = ("TargetType", classad.quote(types[1]))
+            if key[1] >= 0:
+                self._procs.setdefault(key[0], set()).add(key)
+        elif op == DESTROY_CLASSAD:
+            self._forget(key)
+            self._attrs.pop(key, None)
+            self._changed.pop(key, None)
+            if key[1] >= 0:
+                procs = self._procs.get(key[0])
+                if procs is not None:
+                    procs.discard(key)
+                    if not procs:
+                        del self._procs[key[0]]
+        elif op in (SET_ATTRIBUTE, DELETE_ATTRIBUTE) and len(fields) > 2:
+            attrs = self._attrs.get(key)
+            if attrs is None:
+                return
+            self._forget(key)
+            if op == SET_ATTRIBUTE:
+                name, _, value = fields[2].partition(" ")
+                lower_name = name.lower()
+                if lower_name in self._private or lower_name.startswith(PRIVATE_PREFIX):
+                    return
+                attrs[lower_name] = (name, value)
+            else:
+                attrs.pop(fields[2].split(" ", 1)[0].lower(), None)
+
+    def _read(self):
+        # type: () -> None
+        """Read and apply what has been added to the log since the last
+        read.  If the log has been replaced (compacted) or truncated,
+        start over from the beginning.
+
+        """
+        with open(self.path, "rb") as f:
+            st = os.fstat(f.fileno())
+            inode = (st.st_dev, st.st_ino)
+            if inode != self._inode or st.st_size < self._offset:
+                if self._inode is not None:
+                    logger.info("Job queue log %s was rotated; rereading it", self.path)
+                with self._lock:
+                    self._reset()
+                self._inode = inode
+            f.seek(self._offset)
+            while True:
+                data = f.read(READ_SIZE)
+                if not data:
+                    break
+                self._offset += len(data)
+                lines = (self._partial + data).split(b"\n")
+                # The last line is incomplete if the schedd is in the
+                # middle of writing it
+                self._partial = lines.pop()
+                with self._lock:
+                    for line in lines:
+                        line = line.rstrip(b"\r").decode("utf-8", "replace")
+                        if line:
+                            self.apply(line.split(" ", 2))
+        if self._transaction is None and not self._partial:
+            self._synced = time.monotonic()
+
+    def refresh(self):
+        """Catch up with the log.  Errors reading it are passed through."""
+        with self._refresh_lock:
+            self._read()
+
+    def age(self):
+        # type: () -> Optional[float]
+        """Seconds since the replica last caught up with the log, or None
+        if it hasn't read the whole log yet.
+
+        """
+        synced = self._synced
+        if synced is None:
+            return None
+        return time.monotonic() - synced
+
+    def _job_text(self, key):
+        # type: (Tuple[int, int]) -> str
+        """Return the text of the classad of a job, with the attributes of
+        its cluster ad.  Must be called with the lock held.
+
+        """
+        attrs = dict(self._attrs.get((key[0], -1), {}))
+        attrs.update(self._attrs[key])
+        attrs["clusterid"] = ("ClusterId", str(key[0]))
+        attrs["procid"] = ("ProcId", str(key[1]))
+        return "".join("%s = %s\n" % pair for pair in attrs.values())
+
+    def _snapshot(self):
+        # type: () -> Tuple[int, List[Tuple[Tuple[int, int], Optional[Tuple[classad.ClassAd, Dict]], Optional[str], Optional[int]]]]
+        """Return the replica's generation, and for each job in order of
+        job ID, its key, its built ad (or None), and if it isn't built,
+        the text to build it from and the number of its last change.
+
+        """
+        with self._lock:
+            jobs = []
+            for key in sorted(key for key in self._attrs if key[1] >= 0):
+                built = self._built.get(key)
+                if built is not None:
+                    jobs.append((key, built, None, None))
+                else:
+                    jobs.append((key, None, self._job_text(key), self._changed.get(key)))
+            return self._generation, jobs
+
+    def query(self, constraint, projection_list=None, limit=-1):
+        # type: (str, Optional[List[str]], int) -> List[Dict]
+        """Return copies of the jobs that match `constraint`, in order of
+        job ID, with only the attributes in `projection_list` if it's
+        non-empty, and at most `limit` of them if it's not negative.
+
+        Raises SyntaxError if the constraint can't be parsed.
+
+        """
+        self.last_used = time.monotonic()
+        expr = None
+        if constraint and constraint.strip().lower() != "true":
+            expr = utils.parse_expr(constraint)
+        results = []  # type: List[Dict]
+        generation, jobs = self._snapshot()
+        built = []
+        try:
+            for key, job, text, changed in jobs:
+                if limit is not None and 0 <= limit <= len(results):
+                    break
+                if job is None:
+                    ad = classad.parseOne(text, _OLD_PARSER)
+                    job = (ad, utils.classad_to_dict(ad))
+                    built.append((key, job, changed))
+                ad, ad_dict = job
+                if expr is not None and expr.eval(ad) is not True:
+                    continue
+                results.append(_project(ad_dict, projection_list))
+        finally:
+            # Keep the ads built for the next query, unless the jobs have
+            # changed since
+            with self._lock:
+                if generation == self._generation:
+                    for key, job, changed in built:
+                        if key in self._attrs and self._changed.get(key) == changed:
+                            self._built[key] = job
+        return results
+
+    def _run(self, interval):
+        while time.monotonic() - self.last_used < IDLE_TIMEOUT:
+            time.sleep(interval)
+            try:
+                self.refresh()
+            except (IOError, OSError) as err:
+                logger.warning("Failed to read job queue log %s: %s", self.path, err)
+        logger.info("Dropping unused job queue replica of %s", self.path)
+        with _replicas_lock:
+            if _replicas.get(self.path) is self:
+                del _replicas[self.path]
+
+    def start(self, interval):
+        """Read the log, if that hasn't been done yet, and start the thread
+        that follows it every `interval` seconds.  Errors from the first
+        read are passed through.
+
+        """
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self.refresh()
+            self._thread = threading.Thread(
+                target=self._run, args=(interval,), name="jobqueue-replica"
+            )
+            self._thread.daemon = True
+            self._thread.start()
+
+
+_replicas = {}  # type: Dict[str, JobQueueReplica]
+_replicas_lock = threading.Lock()
+
+
+def get_replica(schedd_name):
+    # type: (Optional[str]) -> Optional[JobQueueReplica]
+    """Return an up-to-date replica of the queue of `schedd_name` (None
+    for the default schedd), reading the log first if necessary.  Return
+    None if replicas are disabled, the schedd isn't the local one, or the
+    replica is unavailable or too old (e.g. the log was just compacted),
+    in which case the caller should query the schedd.
+
+    The age of the replica is saved for the response's Age header.
+
+    """
+    interval = replica_interval()
+    if interval <= 0:
+        return None
+    if not utils.is_local_schedd(schedd_name):
+        return None
+    path = utils.param_table.get("JOB_QUEUE_LOG")
+    if not path:
+        return None
+    path = str(path)
+    with _replicas_lock:
+        replica = _replicas.get(path)
+        if replica is None:
+            replica = _replicas[path] = JobQueueReplica(path)
+    try:
+        replica.start(interval)
+    except (IOError, OSError) as err:
+        logger.warning("Failed to read job queue log %s: %s", path, err)
+        with _replicas_lock:
+            if _replicas.get(path) is replica:
+                del _replicas[path]
+        return None
+    age = replica.age()
+    if age is None or age > interval * MAX_AGE_INTERVALS:
+        return None
+    if has_request_context():
+        g.restd_replica_age = age
+    return replica
+
+
+def add_age_header(resp):
+    """after_request handler adding an Age header to responses answered
+    from a replica.
+
+    """
+    age = g.pop("restd_replica_age", None)
+    if age is not None and "Age" not in resp.headers:
+        resp.headers["Age"] = "%d" % age
+    return resp
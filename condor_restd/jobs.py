@@ -1,17 +1,26 @@
 from __future__ import absolute_import
 
-from collections import defaultdict
+from collections import defaultdict, deque
+import calendar
+import datetime
+import functools
+import heapq
+import re
+import time
+import zlib
 
 try:
-    from typing import Dict, List, Optional, Union
+    from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple, Union
 
     Scalar = Union[None, bool, int, float, str]
 except ImportError:
     pass
 
 import six
+from six.moves.urllib.parse import urlencode
 
-from flask_restful import Resource, abort, reqparse
+from flask import Response, g, request
+from flask_restful import Resource, abort, inputs, reqparse
 
 try:
     import classad2 as classad
@@ -21,19 +30,23 @@ except ImportError:
     import htcondor
 
 from .errors import (
+    BAD_AGGREGATE,
     BAD_ATTRIBUTE,
     BAD_PROJECTION,
     BAD_GROUPBY,
+    BAD_PROFILE,
     FAIL_QUERY,
     NO_JOBS,
     NO_ATTRIBUTE,
     ScheddNotFound,
 )
-from . import utils
+from . import admission, aggregate, delta, fanout, history, jobqueue, metrics, streaming, utils
 
 
-def _query_common(querytype, schedd_name, constraint, projection, limit=None):
-    # type: (str, Optional[str], str, Optional[str], Optional[int]) -> List[Dict]
+def _query_common(
+    querytype, schedd_name, constraint, projection, limit=None, clusterid=None, procid=None
+):
+    # type: (str, Optional[str], str, Optional[str], Optional[int], Optional[int], Optional[int]) -> List[Dict]
     """Return the result of a schedd or history file query with a
     constraint (classad expression) and a projection (comma-separated
     attributes), as a list of dicts.
@@ -41,33 +54,188 @@ def _query_common(querytype, schedd_name, constraint, projection, limit=None):
     Handles getting the schedd, validating args, calling the query, and
     transforming the classads into plain dicts (which can be serialized).
 
+    If the constraint is limited to one cluster, or one job, `clusterid`
+    (and `procid`) should be given too; history queries for the local
+    schedd can then be answered from the history index.
+
     Aborts with a 400 if the args are bad, and a 503 if the query failed.
 
     """
+    return list(
+        _iter_query_common(
+            querytype,
+            schedd_name,
+            constraint,
+            projection,
+            limit,
+            clusterid=clusterid,
+            procid=procid,
+        )
+    )
+
+
+def _iter_classads(schedd, querytype, constraint, projection_list, limit, since=None):
+    # type: (htcondor.Schedd, str, str, List[str], int, Optional[str]) -> Iterator[classad.ClassAd]
+    """Return an iterator over the job ads from a schedd or history file
+    query.  Uses the bindings' iterator interfaces (`xquery()` and the
+    history iterator) if available, so ads are read from the schedd as
+    they are consumed; version 2 of the bindings only has list-returning
+    queries.  History queries stop at the first job for which the
+    expression `since` is true, if given.
+
+    """
+    # history query uses "match", jobs query uses "limit"
+    if querytype == "history":
+        kwargs = {"since": since} if since else {}
+        return iter(
+            schedd.history(
+                constraint=constraint, projection=projection_list, match=limit, **kwargs
+            )
+        )
+    elif querytype == "query":
+        if hasattr(schedd, "xquery"):
+            return schedd.xquery(constraint, projection_list, limit)
+        return iter(
+            schedd.query(
+                constraint=constraint, projection=projection_list, limit=limit
+            )
+        )
+    else:
+        assert False, "Invalid querytype %r" % querytype
+
+
+def _local_query(querytype, schedd_name, clusterid, procid, since=None, resume=None, partial_ok=False):
+    # type: (str, Optional[str], Optional[int], Optional[int], Optional[str], Optional[Tuple[int, int, int]], bool) -> Optional[Callable[[str, List[str], int], List[Dict]]]
+    """Return a function answering the query from local data instead of
+    the schedd, taking the constraint, projection list and limit, or None
+    if the schedd must be queried.  Queue queries use the job queue
+    replica; history queries for a cluster or job use the history index,
+    and other history queries scan the history files if the caller can
+    handle partial results (see _history_scan()) and the scan is bounded
+    (by `since`, a scan budget, or `resume` from an earlier scan).
+
+    """
+    if querytype == "query":
+        replica = jobqueue.get_replica(schedd_name)
+        if replica is not None:
+            return replica.query
+    elif querytype == "history" and (clusterid is not None or partial_ok):
+        index = history.get_index(schedd_name)
+        if index is None:
+            return None
+        if clusterid is not None and not since and resume is None:
+            return functools.partial(index.query, clusterid, procid)
+        if partial_ok and (since or resume is not None or history.scan_bounded()):
+            return functools.partial(_history_scan, index, since, resume)
+    return None
+
+
+def _history_scan(index, since, resume, constraint, projection_list, limit):
+    # type: (history.HistoryIndex, Optional[str], Optional[Tuple[int, int, int]], str, List[str], int) -> List[Dict]
+    """Scan the history files with HistoryIndex.scan().  If the scan
+    budget runs out, the position to resume from is saved in the request
+    for add_resume_link().
+
+    """
+    ad_dicts, position = index.scan(constraint, projection_list, limit, since, resume)
+    if position is not None:
+        g.restd_history_resume = position
+    return ad_dicts
+
+
+def _redact(ad, attrs, fill):
+    # type: (Dict, List[str], bool) -> None
+    """Replace the values of `attrs` in `ad` with a placeholder.  If
+    `fill` is True, add the placeholder even if `ad` doesn't have them.
+
+    """
+    for attr in attrs:
+        if fill or attr in ad:
+            ad[attr] = "<REDACTED>"
+
+
+def _iter_query_common(
+    querytype,
+    schedd_name,
+    constraint,
+    projection,
+    limit=None,
+    unlimited=False,
+    clusterid=None,
+    procid=None,
+    since=None,
+    resume=None,
+    partial_ok=False,
+):
+    # type: (str, Optional[str], str, Optional[str], Optional[int], bool, Optional[int], Optional[int], Optional[str], Optional[Tuple[int, int, int]], bool) -> Iterator[Dict]
+    """Like _query_common() but return a generator that yields one dict
+    per job as it is converted, so only one dict needs to be held at a
+    time.  The schedd's ads are all read first, while the admission slot
+    is held (see admission.admitted()).
+    If `unlimited` is True, RESTD_MAX_JOBS does not apply; this is for
+    internal queries whose results are not returned directly.
+
+    History queries stop at the first job for which the expression
+    `since` is true.  If `partial_ok` is True, history queries for the
+    local schedd may be answered by a bounded scan of the history files,
+    starting from the `resume` position of an earlier scan, if given.
+
+    Nothing happens until the first item is requested; aborts happen
+    then, or while iterating.
+
+    Queries for the local schedd are answered from the job queue replica
+    or the history index instead if they're enabled (see _local_query()).
+
+    """
+    # Reject a bad constraint before contacting any daemon
     try:
-        schedd = utils.get_schedd(schedd_name=schedd_name)
-    except ScheddNotFound:
-        abort(400, message="Schedd not found: %s" % schedd_name)
-        raise  # quiet warning
-    except IOError as err:
-        abort(503, message=FAIL_QUERY % {"service": "collector", "err": err})
-        raise  # quiet warning
+        utils.parse_expr(constraint)
+    except SyntaxError as err:
+        abort(400, message=str(err))
+
+    local_query = _local_query(
+        querytype, schedd_name, clusterid, procid, since, resume, partial_ok
+    )
+    schedd = None
+    if local_query is None:
+        try:
+            with metrics.timed("locate"):
+                schedd = utils.get_schedd(schedd_name=schedd_name)
+        except ScheddNotFound:
+            abort(400, message="Schedd not found: %s" % schedd_name)
+            raise  # quiet warning
+        except utils.CONDOR_ERRORS as err:
+            metrics.upstream_error("collector")
+            abort(503, message=FAIL_QUERY % {"service": "collector", "err": err})
+            raise  # quiet warning
+
+    restd_hide_job_attrs = utils.param_table.get("RESTD_HIDE_JOB_ATTRS", "")
+    restd_hide_job_attrs_list = utils.str_to_list(str(restd_hide_job_attrs).lower())
 
     projection_list = []  # type: List[str]
+    # The attributes to redact in each ad, and whether to add them to ads
+    # that don't have them
+    redacted_attrs = restd_hide_job_attrs_list
+    fill_redacted = False
     if projection:
         valid, badattrs = utils.validate_projection(projection)
         if not valid:
             abort(400, message="%s: %s" % (BAD_PROJECTION, ", ".join(badattrs)))
+        requested = set(projection.lower().split(","))
+        # Hidden attributes are not queried at all; if they were asked for,
+        # they are shown as redacted
+        redacted_attrs = [attr for attr in restd_hide_job_attrs_list if attr in requested]
+        fill_redacted = True
         # We always need to get clusterid and procid even if the user doesn't
         # ask for it, so we can construct jobid
-        projection_list = list(
-            set(["clusterid", "procid"] + projection.lower().split(","))
+        projection_list = sorted(
+            set(["clusterid", "procid"]) | (requested - set(redacted_attrs))
         )
 
-    restd_max_jobs = htcondor.param.get("RESTD_MAX_JOBS", None)
+    restd_max_jobs = utils.param_table.get("RESTD_MAX_JOBS")
     max_limit = -1
     try:
-        if restd_max_jobs is not None:
+        if restd_max_jobs is not None and not unlimited:
             max_limit = max(int(restd_max_jobs), -1)
     except TypeError:
         abort(503, message="Bad value for RESTD_MAX_JOBS: %s" % restd_max_jobs)
@@ -84,35 +252,211 @@ def _query_common(querytype, schedd_name, constraint, projection, limit=None):
         elif max_limit > -1 and limit > max_limit:
             limit = max_limit
 
-    restd_hide_job_attrs = htcondor.param.get("RESTD_HIDE_JOB_ATTRS", "")
-    restd_hide_job_attrs_list = utils.str_to_list(str(restd_hide_job_attrs).lower())
+    service = "history file" if querytype == "history" else "schedd"
+    if local_query is not None:
+        try:
+            with metrics.timed("query"):
+                ad_dicts = local_query(constraint, projection_list, limit)
+        except SyntaxError as err:
+            abort(400, message=str(err))
+            raise  # quiet warning
+        except (IOError, OSError) as err:
+            abort(503, message=FAIL_QUERY % {"service": service, "err": err})
+            raise  # quiet warning
+        except ValueError as err:
+            abort(400, message="Bad value for resume: %s" % err)
+            raise  # quiet warning
+        with metrics.timed("redact"):
+            for ad in ad_dicts:
+                _redact(ad, redacted_attrs, fill_redacted)
+        if not unlimited:
+            metrics.count_ads(len(ad_dicts))
+        for ad in ad_dicts:
+            yield ad
+        return
 
-    service = ""
+    # Whole-queue dumps wait behind cheaper queries when the schedd is busy.
+    # The ads are all read while the slot is held, so a slow client
+    # reading a stream doesn't keep other queries to the schedd waiting.
+    expensive = not projection and clusterid is None
+    classads = deque()  # type: Deque[classad.ClassAd]
     try:
-        # history query uses "match", jobs query uses "limit"
-        if querytype == "history":
-            service = "history file"
-            classads = schedd.history(
-                constraint=constraint, projection=projection_list, match=limit
-            )  # type: List[classad.ClassAd]
-        elif querytype == "query":
-            service = "schedd"
-            classads = schedd.query(
-                constraint=constraint, projection=projection_list, limit=limit
-            )  # type: List[classad.ClassAd]
-        else:
-            assert False, "Invalid querytype %r" % querytype
-        classad_dicts = utils.classads_to_dicts(classads)
-        for ad in classad_dicts:
-            for attr in restd_hide_job_attrs_list:
-                if attr in ad:
-                    ad[attr] = "<REDACTED>"
-        return classad_dicts
+        with admission.admitted("schedd:%s" % (schedd_name or "DEFAULT"), expensive):
+            with metrics.timed("query"):
+                classads = deque(
+                    _iter_classads(schedd, querytype, constraint, projection_list, limit, since)
+                )
     except SyntaxError as err:
         abort(400, message=str(err))
-    except (IOError, RuntimeError) as err:
+    except utils.CONDOR_ERRORS as err:
+        if schedd_name:
+            # The schedd may have moved; locate it again next time
+            utils.location_cache.invalidate(htcondor.DaemonTypes.Schedd, schedd_name)
+        metrics.upstream_error(service)
         abort(503, message=FAIL_QUERY % {"service": service, "err": err})
 
+    # Time the phases per ad, adding them to the request's metrics at the end
+    convert_time = redact_time = 0.0
+    count = 0
+    try:
+        while classads:
+            # Drop each ad once converted, so they are freed as the dicts
+            # are consumed
+            converting = time.perf_counter()
+            ad = utils.classad_to_dict(classads.popleft())
+            redacting = time.perf_counter()
+            convert_time += redacting - converting
+            _redact(ad, redacted_attrs, fill_redacted)
+            count += 1
+            redact_time += time.perf_counter() - redacting
+            yield ad
+    finally:
+        metrics.add_phase("convert", convert_time)
+        metrics.add_phase("redact", redact_time)
+        if not unlimited:
+            metrics.count_ads(count)
+
+
+def _resolve_projection(projection, profile):
+    # type: (str, str) -> str
+    """Return the projection of a request: the attributes in `projection`
+    plus those of the projection profile named `profile`, defined by the
+    RESTD_PROJECTION_PROFILE_<profile> param.  If neither is given, return
+    the attributes in RESTD_DEFAULT_PROJECTION.  The profile `all` means
+    all attributes, even if there is a default projection.
+
+    Aborts with a 400 if the profile isn't defined.
+
+    """
+    parts = [projection] if projection else []
+    if profile and profile.lower() != "all":
+        value = None
+        if utils.validate_attribute(profile):
+            value = utils.param_table.get("RESTD_PROJECTION_PROFILE_%s" % profile)
+        if not value:
+            abort(400, message="%s: %s" % (BAD_PROFILE, profile))
+        parts.append(",".join(utils.str_to_list(str(value))))
+    elif not projection and not profile:
+        default = utils.param_table.get("RESTD_DEFAULT_PROJECTION") or ""
+        parts.append(",".join(utils.str_to_list(str(default))))
+    return ",".join(part for part in parts if part)
+
+
+def _make_job_object(ad, projection_list):
+    # type: (Dict, Optional[List[str]]) -> Dict
+    """Return a job object (the jobid and the classad) for a job ad.
+    clusterid and procid are removed from the classad if they are not in
+    `projection_list`; they were only queried to construct the jobid.
+
+    """
+    jobid = "%(clusterid)s.%(procid)s" % ad
+    if projection_list:
+        if "clusterid" not in projection_list:
+            del ad["clusterid"]
+        if "procid" not in projection_list:
+            del ad["procid"]
+    return dict(classad=ad, jobid=jobid)
+
+
+def _job_key(ad):
+    # type: (Dict) -> Tuple[int, int]
+    return ad["clusterid"], ad["procid"]
+
+
+def _after_job_constraint(key):
+    # type: (Tuple[int, int]) -> str
+    """Return a constraint matching jobs whose (ClusterId, ProcId) comes
+    after `key`.
+
+    """
+    return "(ClusterId > %d || (ClusterId == %d && ProcId > %d))" % (
+        key[0],
+        key[0],
+        key[1],
+    )
+
+
+def _constraint_hash(querytype, constraint):
+    # type: (str, str) -> int
+    return zlib.crc32(("%s:%s" % (querytype, constraint)).encode("utf-8"))
+
+
+def _next_page_link(cursor, arg="cursor"):
+    # type: (str, str) -> str
+    """Return a Link header value pointing at the request URL with the
+    `cursor` argument (or `arg`) replaced.
+
+    """
+    args = request.args.copy()
+    args[arg] = cursor
+    return '<%s?%s>; rel="next"' % (request.base_url, urlencode(list(args.items(multi=True))))
+
+
+# When a job left the queue: removed jobs have no CompletionDate
+COMPLETION_EXPR = "(CompletionDate > 0 ? CompletionDate : EnteredCurrentStatus)"
+
+_JOB_ID_RE = re.compile(r"^(\d+)(?:\.(\d+))?$")
+
+
+def _parse_time(value):
+    # type: (str) -> int
+    """Return the Unix time of an ISO 8601 date and time (UTC if it has no
+    offset).  Raises ValueError if it isn't one.
+
+    """
+    if value.endswith(("Z", "z")):
+        value = value[:-1] + "+00:00"
+    parsed = datetime.datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return calendar.timegm(parsed.timetuple())
+
+
+def _history_since(value):
+    # type: (str) -> str
+    """Return the expression ending a history scan at `since`: a job ID
+    (`123` or `123.4`, the scan stops before that job, like the bindings'
+    `since`) or a time (the scan stops at the first job that left the
+    queue before it).  Aborts with a 400 if it's neither.
+
+    """
+    match = _JOB_ID_RE.match(value)
+    if match:
+        if match.group(2) is None:
+            return "ClusterId == %s" % match.group(1)
+        return "ClusterId == %s && ProcId == %s" % match.groups()
+    try:
+        return "%s < %d" % (COMPLETION_EXPR, _parse_time(value))
+    except ValueError:
+        abort(400, message="Bad value for since: expected a job ID or a time: %s" % value)
+        raise  # quiet warning
+
+
+def _history_until(value):
+    # type: (str) -> str
+    """Return the constraint for jobs that left the queue at or before the
+    time `until`.  Aborts with a 400 if it isn't a time.
+
+    """
+    try:
+        return "%s <= %d" % (COMPLETION_EXPR, _parse_time(value))
+    except ValueError:
+        abort(400, message="Bad value for until: expected a time: %s" % value)
+        raise  # quiet warning
+
+
+def add_resume_link(resp):
+    """after_request handler adding a Link header to continue a history
+    scan that ran out of budget (see _history_scan()).
+
+    """
+    position = g.pop("restd_history_resume", None)
+    resume_hash = g.pop("restd_history_hash", None)
+    if position is not None and resume_hash is not None and "Link" not in resp.headers:
+        token = utils.encode_token(dict(h=resume_hash, d=position[0], i=position[1], o=position[2]))
+        resp.headers["Link"] = _next_page_link(token, "resume")
+    return resp
+
 
 class JobsBaseResource(Resource):
     """Base class for endpoints for accessing current and historical job
@@ -122,35 +466,437 @@ class JobsBaseResource(Resource):
 
     querytype = ""
 
-    def query_multi(self, schedd, clusterid=None, constraint="true", projection=None):
-        # type: (Optional[str], int, str, str) -> List[Dict]
+    def query_multi(
+        self,
+        schedd,
+        clusterid=None,
+        constraint="true",
+        projection=None,
+        stream=False,
+        since=None,
+        until=None,
+        resume=None,
+    ):
+        # type: (Optional[str], int, str, str, bool, Optional[str], Optional[str], Optional[str]) -> Union[List[Dict], Response]
         """Return multiple jobs, optionally constraining by `clusterid` in
         addition to `constraint`.
 
+        If `stream` is True, return a response that sends the jobs as they
+        are read from the schedd instead of collecting them all first.
+
+        History queries can be bounded by `since` (a job ID or time, see
+        _history_since()) and `until` (a time).  Unless `stream` is True,
+        history queries for the local schedd may be answered by a bounded
+        scan of the history files, which returns partial results with a
+        Link to `resume` the scan if it runs out of budget.
+
         """
         if clusterid is not None:
             constraint += " && clusterid==%d" % clusterid
-        ad_dicts = _query_common(
+        if until:
+            constraint = "(%s) && %s" % (constraint, _history_until(until))
+        since_expr = _history_since(since) if since else None
+        scan_hash = _constraint_hash(self.querytype, "%s:%s" % (constraint, since_expr))
+        resume_position = None
+        if resume:
+            try:
+                data = utils.decode_token(resume)
+                if data.get("h") != scan_hash:
+                    raise ValueError("resume is for a different query")
+                resume_position = (int(data["d"]), int(data["i"]), int(data["o"]))
+            except (KeyError, TypeError, ValueError) as err:
+                abort(400, message="Bad value for resume: %s" % err)
+        if self.querytype == "history":
+            g.restd_history_hash = scan_hash
+        ad_dicts = _iter_query_common(
             self.querytype,
             schedd_name=schedd,
             constraint=constraint,
             projection=projection,
             limit=None,
+            clusterid=clusterid,
+            since=since_expr,
+            resume=resume_position,
+            partial_ok=self.querytype == "history" and not stream,
         )
 
         projection_list = projection.lower().split(",") if projection else None
-        data = []
-        for ad in ad_dicts:
-            jobid = "%(clusterid)s.%(procid)s" % ad
-            if projection_list:
-                if "clusterid" not in projection_list:
-                    del ad["clusterid"]
-                if "procid" not in projection_list:
-                    del ad["procid"]
-            data.append(dict(classad=ad, jobid=jobid))
+        data = (_make_job_object(ad, projection_list) for ad in ad_dicts)
+        if stream:
+            return streaming.stream_response(data)
+        return list(data)
+
+    def schedd_names(self, selector):
+        # type: (str) -> List[str]
+        """Return the schedd names for a multi-schedd selector: `ALL` for
+        every schedd in the pool, or a comma-separated list of names.
+
+        """
+        if selector == "ALL":
+            try:
+                with metrics.timed("locate"):
+                    locations = utils.location_cache.locate_all(htcondor.DaemonTypes.Schedd)
+            except utils.CONDOR_ERRORS as err:
+                metrics.upstream_error("collector")
+                abort(503, message=FAIL_QUERY % {"service": "collector", "err": err})
+                raise  # quiet warning
+            return sorted(set(str(location["Name"]) for location in locations))
+        names = []  # type: List[str]
+        for name in selector.split(","):
+            name = name.strip()
+            if name and name not in names:
+                names.append(name)
+        if not names:
+            abort(400, message="No schedds given")
+        return names
+
+    def query_fanout(
+        self, schedds, clusterid=None, constraint="true", projection=None, stream=False
+    ):
+        # type: (List[str], int, str, str, bool) -> Union[Dict, Response]
+        """Return the jobs from several schedds, querying them in parallel.
+        Each job object is tagged with the name of its schedd.  The result
+        is an object with the jobs, and the errors from the schedds that
+        could not be queried (keyed by schedd name):
+
+            {"jobs": [...], "errors": {"schedd2": "message"}}
+
+        If `stream` is True, each schedd's jobs are sent as soon as its
+        query finishes, and the errors are sent after the last job.
+
+        """
+        if clusterid is not None:
+            constraint += " && clusterid==%d" % clusterid
+        projection_list = projection.lower().split(",") if projection else None
+        # Check the arguments once here instead of getting the same error
+        # from every schedd
+        if projection:
+            valid, badattrs = utils.validate_projection(projection)
+            if not valid:
+                abort(400, message="%s: %s" % (BAD_PROJECTION, ", ".join(badattrs)))
+        try:
+            utils.parse_expr(constraint)
+        except SyntaxError as err:
+            abort(400, message=str(err))
+
+        def query_one(schedd_name):
+            jobs = []
+            for ad in _iter_query_common(
+                self.querytype,
+                schedd_name=None if schedd_name == "DEFAULT" else schedd_name,
+                constraint=constraint,
+                projection=projection,
+                limit=None,
+                clusterid=clusterid,
+            ):
+                job = _make_job_object(ad, projection_list)
+                job["schedd"] = schedd_name
+                jobs.append(job)
+            return jobs
 
+        errors = {}  # type: Dict[str, str]
+
+        def merged():
+            for name, jobs, err in fanout.fan_out(schedds, query_one):
+                if err is not None:
+                    errors[name] = fanout.error_message(err)
+                    continue
+                for job in jobs:
+                    yield job
+
+        if stream:
+            return streaming.stream_response(
+                merged(), envelope=("jobs", lambda: {"errors": errors})
+            )
+        jobs = list(merged())
+        return {"jobs": jobs, "errors": errors}
+
+    def _decode_cursor(self, cursor, constraint):
+        # type: (str, str) -> Dict
+        try:
+            data = utils.decode_token(cursor)
+            if (
+                data.get("q") != self.querytype
+                or data.get("h") != _constraint_hash(self.querytype, constraint)
+            ):
+                raise ValueError("cursor is for a different query")
+            data["c"], data["p"], data["o"] = (
+                int(data["c"]),
+                int(data["p"]),
+                int(data.get("o", 0)),
+            )
+            if "r" in data:
+                data["r"] = tuple(int(n) for n in data["r"])
+                if len(data["r"]) != 3:
+                    raise ValueError("bad history position")
+        except (KeyError, TypeError, ValueError) as err:
+            abort(400, message="Bad value for cursor: %s" % err)
+            raise  # quiet warning
         return data
 
+    def _page_keys(self, schedd, constraint, page_size, cursor):
+        # type: (Optional[str], str, int, Optional[Dict]) -> Tuple[List[Tuple[int, int]], int]
+        """Return the (ClusterId, ProcId) of the jobs on the page after
+        `cursor` (plus one more, if there is a next page), and the number
+        of jobs before the page.
+
+        Queue pages are in (ClusterId, ProcId) order.  History pages are
+        in the order of the history file (most recent first); since that
+        can't be expressed as a constraint, the cursor remembers the last
+        job returned and how far down the history it was.  (This is only
+        for history the restd can't scan itself; see _scan_page().)
+
+        """
+        if self.querytype == "query":
+            if cursor:
+                constraint = "(%s) && %s" % (
+                    constraint,
+                    _after_job_constraint((cursor["c"], cursor["p"])),
+                )
+            keys = heapq.nsmallest(
+                page_size + 1,
+                (
+                    _job_key(ad)
+                    for ad in _iter_query_common(
+                        self.querytype, schedd, constraint, "clusterid,procid", unlimited=True
+                    )
+                ),
+            )
+            return keys, 0
+
+        after = (cursor["c"], cursor["p"]) if cursor else None
+        match = (cursor["o"] if cursor else 0) + page_size + 1
+        while True:
+            keys = [
+                _job_key(ad)
+                for ad in _iter_query_common(
+                    self.querytype,
+                    schedd,
+                    constraint,
+                    "clusterid,procid",
+                    limit=match,
+                    unlimited=True,
+                )
+            ]
+            exhausted = len(keys) < match
+            start = 0
+            if after is not None:
+                try:
+                    start = keys.index(after) + 1
+                except ValueError:
+                    # New jobs have been added to the history since the
+                    # last page; look further back
+                    start = None
+            if start is not None and (exhausted or len(keys) - start > page_size):
+                return keys[start : start + page_size + 1], start
+            if exhausted:
+                abort(400, message="Bad value for cursor: job is no longer in the history")
+            match *= 2
+
+    def query_page(
+        self,
+        schedd,
+        clusterid=None,
+        constraint="true",
+        projection=None,
+        page_size=100,
+        cursor=None,
+        stream=False,
+    ):
+        # type: (Optional[str], int, str, str, int, Optional[str], bool) -> Union[Tuple[List[Dict], int, Dict], Response]
+        """Return one page of at most `page_size` jobs, starting after the
+        position given by `cursor` (or from the start if None), optionally
+        constraining by `clusterid` in addition to `constraint`.
+
+        If there are more jobs, the cursor for the next page is sent in a
+        Link header.  Each page costs a query for just the job IDs, to find
+        the page boundaries, and a query for the jobs on the page; history
+        pages of the local schedd are read from the history files instead
+        if possible (see _scan_page()).
+
+        """
+        if clusterid is not None:
+            constraint += " && clusterid==%d" % clusterid
+        max_jobs = utils.param_float("RESTD_MAX_JOBS", -1)
+        if max_jobs > 0:
+            page_size = min(page_size, int(max_jobs))
+        cursor_data = self._decode_cursor(cursor, constraint) if cursor else None
+        if (
+            self.querytype == "history"
+            and ("r" in cursor_data if cursor_data else history.scan_bounded())
+            and history.get_index(schedd) is not None
+        ):
+            return self._scan_page(schedd, constraint, projection, page_size, cursor_data, stream)
+
+        keys, offset = self._page_keys(schedd, constraint, page_size, cursor_data)
+        headers = {}
+        if len(keys) > page_size:
+            keys = keys[:page_size]
+            next_cursor = utils.encode_token(
+                dict(
+                    q=self.querytype,
+                    h=_constraint_hash(self.querytype, constraint),
+                    c=keys[-1][0],
+                    p=keys[-1][1],
+                    o=offset + page_size,
+                )
+            )
+            headers["Link"] = _next_page_link(next_cursor)
+
+        ad_dicts = []  # type: List[Dict]
+        if keys:
+            if self.querytype == "query":
+                page_constraint = "(%s) && !%s" % (
+                    constraint,
+                    _after_job_constraint(keys[-1]),
+                )
+                if cursor_data:
+                    page_constraint += " && " + _after_job_constraint(
+                        (cursor_data["c"], cursor_data["p"])
+                    )
+            else:
+                page_constraint = "(%s) && (%s)" % (
+                    constraint,
+                    " || ".join(
+                        "(ClusterId == %d && ProcId == %d)" % key for key in keys
+                    ),
+                )
+            positions = dict((key, i) for i, key in enumerate(keys))
+            ad_dicts = sorted(
+                (
+                    ad
+                    for ad in _iter_query_common(
+                        self.querytype,
+                        schedd,
+                        page_constraint,
+                        projection,
+                        limit=len(keys),
+                    )
+                    if _job_key(ad) in positions
+                ),
+                key=lambda ad: positions[_job_key(ad)],
+            )
+        return self._page_response(ad_dicts, projection, headers, stream)
+
+    def _scan_page(self, schedd, constraint, projection, page_size, cursor, stream):
+        # type: (Optional[str], str, str, int, Optional[Dict], bool) -> Union[Tuple[List[Dict], int, Dict], Response]
+        """Return one page of history jobs found by scanning the history
+        files (see HistoryIndex.scan()) from the position in `cursor`.
+        The next page's cursor has the position the scan got to, so each
+        page only reads its own records.  A page can be short if the scan
+        budget runs out, and the last page can be empty.
+
+        The cursor also has the last job and the number of jobs before
+        the next page, so _page_keys() can take over if the history index
+        is disabled.
+
+        """
+        ad_dicts = list(
+            _iter_query_common(
+                self.querytype,
+                schedd,
+                constraint,
+                projection,
+                limit=page_size,
+                resume=cursor["r"] if cursor else None,
+                partial_ok=True,
+            )
+        )
+        position = g.pop("restd_history_resume", None)
+        headers = {}
+        if position is not None:
+            if ad_dicts:
+                last = _job_key(ad_dicts[-1])
+            else:
+                last = (cursor["c"], cursor["p"]) if cursor else (0, 0)
+            next_cursor = utils.encode_token(
+                dict(
+                    q=self.querytype,
+                    h=_constraint_hash(self.querytype, constraint),
+                    c=last[0],
+                    p=last[1],
+                    o=(cursor["o"] if cursor else 0) + len(ad_dicts),
+                    r=list(position),
+                )
+            )
+            headers["Link"] = _next_page_link(next_cursor)
+        return self._page_response(ad_dicts, projection, headers, stream)
+
+    def _page_response(self, ad_dicts, projection, headers, stream):
+        # type: (List[Dict], str, Dict, bool) -> Union[Tuple[List[Dict], int, Dict], Response]
+        projection_list = projection.lower().split(",") if projection else None
+        data = (_make_job_object(ad, projection_list) for ad in ad_dicts)
+        if stream:
+            resp = streaming.stream_response(data)
+            resp.headers.extend(headers)
+            return resp
+        return list(data), 200, headers
+
+    def query_delta(self, schedd, clusterid=None, constraint="true", projection=None, since=""):
+        # type: (Optional[str], int, str, str, str) -> Dict
+        """Return the jobs added or changed since the response that `since`
+        (a token) came from, and the IDs of the jobs that have left the
+        queue since then, optionally constraining by `clusterid` in
+        addition to `constraint`:
+
+            {"jobs": [...], "removed": ["123.0"], "token": "...", "full": false}
+
+        If `since` is empty, or can't be answered with a delta (see the
+        delta module), all the jobs are returned and `full` is true.  If
+        there are more than RESTD_MAX_JOBS, only that many are returned,
+        `truncated` is true, and the token gets a full response again.
+
+        """
+        if clusterid is not None:
+            constraint += " && clusterid==%d" % clusterid
+        query_hash = _constraint_hash(self.querytype, "%s:%s" % (constraint, projection))
+        tracker = delta.get_tracker((schedd, constraint, projection))
+        since_version = None
+        if since:
+            try:
+                data = utils.decode_token(since)
+                if data.get("q") != self.querytype or data.get("h") != query_hash:
+                    raise ValueError("token is for a different query")
+                if data.get("i") == tracker.instance:
+                    since_version = int(data["v"])
+            except (KeyError, TypeError, ValueError) as err:
+                abort(400, message="Bad value for since: %s" % err)
+
+        # The versions are for all the jobs, so RESTD_MAX_JOBS is only
+        # applied to full responses below
+        ad_dicts = list(
+            _iter_query_common(
+                self.querytype,
+                schedd,
+                constraint,
+                projection,
+                unlimited=True,
+                clusterid=clusterid,
+            )
+        )
+        changed, removed, version, full = tracker.update(ad_dicts, since_version)
+        max_jobs = utils.param_float("RESTD_MAX_JOBS", -1)
+        truncated = full and 0 <= max_jobs < len(changed)
+        if truncated:
+            # The client can't have the jobs left out, so its next token
+            # must not be answered with a delta
+            changed = changed[: int(max_jobs)]
+            token_data = dict(q=self.querytype, h=query_hash)
+        else:
+            token_data = dict(q=self.querytype, h=query_hash, i=tracker.instance, v=version)
+        metrics.count_ads(len(changed))
+
+        projection_list = projection.lower().split(",") if projection else None
+        result = {
+            "jobs": [_make_job_object(ad, projection_list) for ad in changed],
+            "removed": ["%d.%d" % key for key in removed],
+            "token": utils.encode_token(token_data),
+            "full": full,
+        }
+        if truncated:
+            result["truncated"] = True
+        return result
+
     def query_single(self, schedd, clusterid, procid, projection=None):
         # type: (Optional[str], int, int, str) -> Dict
         """Return a single job."""
@@ -160,17 +906,12 @@ class JobsBaseResource(Resource):
             "clusterid==%d && procid==%d" % (clusterid, procid),
             projection,
             limit=1,
+            clusterid=clusterid,
+            procid=procid,
         )
         if ad_dicts:
-            ad = ad_dicts[0]
-            jobid = "%(clusterid)s.%(procid)s" % ad
             projection_list = projection.lower().split(",") if projection else None
-            if projection_list:
-                if "clusterid" not in projection_list:
-                    del ad["clusterid"]
-                if "procid" not in projection_list:
-                    del ad["procid"]
-            return dict(classad=ad, jobid=jobid)
+            return _make_job_object(ad_dicts[0], projection_list)
         else:
             abort(404, message=NO_JOBS)
 
@@ -189,17 +930,64 @@ class JobsBaseResource(Resource):
     def get(self, schedd, clusterid=None, procid=None, attribute=None):
         parser = reqparse.RequestParser(trim=True)
         parser.add_argument("projection", location="args", default="")
+        parser.add_argument("profile", location="args", default="")
         parser.add_argument("constraint", location="args", default="true")
+        parser.add_argument("stream", location="args", type=inputs.boolean, default=False)
+        parser.add_argument("page_size", location="args", type=inputs.positive)
+        parser.add_argument("cursor", location="args")
+        parser.add_argument("since", location="args")
+        parser.add_argument("until", location="args")
+        parser.add_argument("resume", location="args")
         args = parser.parse_args()
         try:
             schedd = six.ensure_str(schedd, errors="replace")
             projection = six.ensure_str(args.projection, errors="replace")
+            profile = six.ensure_str(args.profile, errors="replace")
             constraint = six.ensure_str(args.constraint, errors="replace")
+            cursor = six.ensure_str(args.cursor, errors="replace") if args.cursor else None
+            since = six.ensure_str(args.since, errors="replace") if args.since is not None else None
         except UnicodeError as err:
             abort(400, message=str(err))
             return  # quiet warning
+        projection = _resolve_projection(projection, profile)
+        if self.querytype == "query" and since is not None:
+            if (
+                schedd == "ALL"
+                or "," in schedd
+                or procid is not None
+                or args.page_size
+                or cursor
+                or args.stream
+            ):
+                abort(
+                    400,
+                    message="since is not supported with multiple schedds, single jobs, paging, or streaming",
+                )
+        if self.querytype == "history" and (since or args.until or args.resume):
+            if schedd == "ALL" or "," in schedd or procid is not None or args.page_size or cursor:
+                abort(
+                    400,
+                    message="since, until, and resume are not supported with multiple schedds, single jobs, or paging",
+                )
+        if schedd == "ALL" or "," in schedd:
+            if procid is not None or args.page_size or cursor:
+                abort(
+                    400,
+                    message="Single jobs and paging are not supported with multiple schedds",
+                )
+            return self.query_fanout(
+                self.schedd_names(schedd),
+                clusterid,
+                constraint=constraint,
+                projection=projection,
+                stream=args.stream,
+            )
         if schedd == "DEFAULT":
             schedd = None
+        if args.stream and self.querytype == "query":
+            # A streamed response's headers are sent before the query runs;
+            # this sets its Age header if the replica will answer it
+            jobqueue.get_replica(schedd)
         if attribute:
             try:
                 attribute = six.ensure_str(attribute, errors="replace")
@@ -208,8 +996,41 @@ class JobsBaseResource(Resource):
             return self.query_attribute(schedd, clusterid, procid, attribute)
         if procid is not None:
             return self.query_single(schedd, clusterid, procid, projection=projection)
+        if args.page_size or cursor:
+            return self.query_page(
+                schedd,
+                clusterid,
+                constraint=constraint,
+                projection=projection,
+                page_size=args.page_size or 100,
+                cursor=cursor,
+                stream=args.stream,
+            )
+        if self.querytype == "query" and since is not None:
+            return self.query_delta(
+                schedd,
+                clusterid,
+                constraint=constraint,
+                projection=projection,
+                since=since,
+            )
+        if self.querytype == "history":
+            return self.query_multi(
+                schedd,
+                clusterid,
+                constraint=constraint,
+                projection=projection,
+                stream=args.stream,
+                since=since,
+                until=args.until,
+                resume=args.resume,
+            )
         return self.query_multi(
-            schedd, clusterid, constraint=constraint, projection=projection
+            schedd,
+            clusterid,
+            constraint=constraint,
+            projection=projection,
+            stream=args.stream,
         )
 
 
@@ -263,6 +1084,7 @@ class GroupedJobsBaseResource(Resource):
             constraint=constraint,
             projection=projection,
             limit=None,
+            clusterid=clusterid,
         )
 
         projection_list = projection.lower().split(",") if projection else None
@@ -281,21 +1103,64 @@ class GroupedJobsBaseResource(Resource):
 
         return grouped_data
 
+    def grouped_aggregate(
+        self, schedd, groupby, aggregate_spec, clusterid=None, constraint="true"
+    ):
+        # type: (Optional[str], str, str, int, str) -> Dict[str, Dict]
+        """Return aggregates (e.g. counts and sums of attributes) of the
+        jobs in each group instead of the jobs themselves.  Only the
+        attributes needed for the aggregates are queried, and jobs are
+        folded into the aggregates as they are read.  RESTD_MAX_JOBS does
+        not apply, since only the aggregates are returned.
+
+        """
+        if not utils.validate_attribute(groupby):
+            abort(400, message=BAD_GROUPBY)
+        try:
+            terms = aggregate.parse_aggregate(aggregate_spec)
+        except ValueError as err:
+            abort(400, message="%s: %s" % (BAD_AGGREGATE, err))
+            raise  # quiet warning
+        if clusterid is not None:
+            constraint += " && clusterid==%d" % clusterid
+        groupby = groupby.lower()
+        projection = ",".join(
+            sorted(aggregate.required_attributes(terms) | set([groupby]))
+        )
+        ad_dicts = _iter_query_common(
+            self.querytype,
+            schedd_name=schedd,
+            constraint=constraint,
+            projection=projection,
+            unlimited=True,
+            clusterid=clusterid,
+        )
+        return aggregate.aggregate(ad_dicts, groupby, terms)
+
     def get(self, schedd, groupby, clusterid=None):
         parser = reqparse.RequestParser(trim=True)
         parser.add_argument("projection", location="args", default="")
+        parser.add_argument("profile", location="args", default="")
         parser.add_argument("constraint", location="args", default="true")
+        parser.add_argument("aggregate", location="args", default="")
         args = parser.parse_args()
         try:
             schedd = six.ensure_str(schedd, errors="replace")
             groupby = six.ensure_str(groupby, errors="replace")
             projection = six.ensure_str(args.projection, errors="replace")
+            profile = six.ensure_str(args.profile, errors="replace")
             constraint = six.ensure_str(args.constraint, errors="replace")
+            aggregate_spec = six.ensure_str(args.aggregate, errors="replace")
         except UnicodeError as err:
             abort(400, message=str(err))
             return  # quiet warning
+        projection = _resolve_projection(projection, profile)
         if schedd == "DEFAULT":
             schedd = None
+        if aggregate_spec:
+            return self.grouped_aggregate(
+                schedd, groupby, aggregate_spec, clusterid, constraint=constraint
+            )
         return self.grouped_query_multi(
             schedd, groupby, clusterid, constraint=constraint, projection=projection
         )
@@ -0,0 +1,436 @@
+"""Request metrics, served in the Prometheus text format at /metrics.
+
+Each request's time is split into phases: waiting for a slot to query
+a daemon (see the admission module), locating the daemon, querying
+it, converting the classads to dicts, redacting hidden attributes, and
+serializing the response.  Code does this by wrapping the work in
+`with metrics.timed(phase):` (or calling add_phase()); outside of a
+request this does nothing.  The phases of a buffered response are also
+reported in its Server-Timing header.
+
+Every sample has a `worker` label with the process ID.  Under a server
+with several worker processes (e.g. `gunicorn -w4`), set
+RESTD_METRICS_DIR to a directory writable by all of them: each worker
+saves its metrics there every few seconds, and /metrics returns the
+metrics of all live workers, whichever worker gets the scrape.
+Otherwise /metrics only has the metrics of the worker that answered.
+
+"""
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+try:
+    from typing import Any, Dict, List, Optional, Tuple
+except ImportError:
+    pass
+
+from flask import Response, g, has_request_context, request
+
+from . import compression, utils
+
+
+logger = logging.getLogger(__name__)
+
+PHASES = ("admission", "locate", "query", "convert", "redact", "serialize")
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# name -> (type, help)
+METRICS = {
+    "restd_requests_total": ("counter", "Requests handled, by route, method, and status code"),
+    "restd_request_duration_seconds": ("histogram", "Time to handle a request, including sending a streamed body"),
+    "restd_request_phase_seconds": ("histogram", "Time spent in each phase of a request"),
+    "restd_requests_in_flight": ("gauge", "Requests being handled"),
+    "restd_ads_returned_total": ("counter", "Job or daemon ads returned"),
+    "restd_response_bytes_total": ("counter", "Response body bytes sent (after compression)"),
+    "restd_upstream_errors_total": ("counter", "Failed queries to HTCondor daemons, by service"),
+    "restd_location_cache_total": ("counter", "Daemon location cache lookups, by result"),
+    "restd_location_cache_entries": ("gauge", "Entries in the daemon location cache"),
+    "restd_constraint_cache_total": ("counter", "Parsed constraint cache lookups, by result"),
+    "restd_constraint_cache_entries": ("gauge", "Entries in the parsed constraint cache"),
+    "restd_admission_queue_depth": ("gauge", "Queries waiting for a slot to query a daemon, by upstream"),
+    "restd_admission_rejections_total": ("counter", "Requests rejected by admission control, by upstream and reason"),
+    "restd_result_cache_total": ("counter", "Shared result cache lookups, by result (hit, coalesced, or miss)"),
+    "restd_compression_bytes_total": ("counter", "Bytes before (in) and after (out) compression"),
+    "restd_compression_cpu_seconds_total": ("counter", "CPU time spent compressing responses"),
+}
+
+# Save this worker's metrics to RESTD_METRICS_DIR this often
+WRITE_INTERVAL = 5.0
+
+
+def _label_key(labels):
+    # type: (Dict[str, Any]) -> Tuple[Tuple[str, str], ...]
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Registry(object):
+    """Counters, gauges, and histograms of one process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}  # type: Dict[Tuple[str, Tuple], float]
+        # (name, labels) -> [count per bucket..., count, sum]
+        self._histograms = {}  # type: Dict[Tuple[str, Tuple], List[float]]
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, _label_key(labels or {}))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, labels=None, value=0):
+        key = (name, _label_key(labels or {}))
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name, labels, value):
+        key = (name, _label_key(labels))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [0] * (len(DURATION_BUCKETS) + 2)
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += 1
+            hist[-1] += value
+
+    def snapshot(self):
+        # type: () -> Dict[str, List]
+        """Return the metrics as JSON-serializable data."""
+        with self._lock:
+            return dict(
+                values=[[name, list(labels), value] for (name, labels), value in self._values.items()],
+                histograms=[
+                    [name, list(labels), list(hist)]
+                    for (name, labels), hist in self._histograms.items()
+                ],
+            )
+
+
+registry = Registry()
+
+
+# Fan-out queries add to the same request's metrics from several threads
+_request_lock = threading.Lock()
+
+
+def add_phase(phase, seconds):
+    # type: (str, float) -> None
+    """Add `seconds` to the time of `phase` in the current request.  When
+    a request queries several daemons in parallel, their times are added
+    up, so the phases can add up to more than the request's duration.
+
+    """
+    if has_request_context():
+        with _request_lock:
+            phases = g.setdefault("restd_phases", {})
+            phases[phase] = phases.get(phase, 0.0) + seconds
+
+
+class timed(object):
+    """Context manager adding the time spent in its block to a phase of
+    the current request.
+
+    """
+
+    __slots__ = ("phase", "start")
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        add_phase(self.phase, time.perf_counter() - self.start)
+        return False
+
+
+def count_ads(count):
+    # type: (int) -> None
+    """Add `count` to the number of ads returned by the current request."""
+    if has_request_context():
+        with _request_lock:
+            g.restd_ads = g.get("restd_ads", 0) + count
+
+
+def upstream_error(service):
+    # type: (str) -> None
+    """Count a failed query to a daemon."""
+    registry.inc("restd_upstream_errors_total", {"service": service})
+
+
+def _route():
+    # type: () -> str
+    rule = request.url_rule
+    return rule.rule if rule is not None else "unmatched"
+
+
+def _before_request():
+    g.restd_start = time.perf_counter()
+    registry.inc("restd_requests_in_flight")
+    _start_writer()
+
+
+def _count_bytes(chunks, route):
+    total = 0
+    try:
+        for chunk in chunks:
+            total += len(chunk)
+            yield chunk
+    finally:
+        registry.inc("restd_response_bytes_total", {"route": route}, total)
+
+
+def _after_request(resp):
+    # type: (Response) -> Response
+    route = _route()
+    registry.inc(
+        "restd_requests_total",
+        {"route": route, "method": request.method, "code": resp.status_code},
+    )
+    if resp.is_streamed:
+        resp.response = _count_bytes(resp.iter_encoded(), route)
+    else:
+        registry.inc(
+            "restd_response_bytes_total", {"route": route}, resp.content_length or 0
+        )
+        phases = g.get("restd_phases")
+        if phases:
+            resp.headers.add(
+                "Server-Timing",
+                ", ".join(
+                    "%s;dur=%.3f" % (phase, phases[phase] * 1000)
+                    for phase in PHASES
+                    if phase in phases
+                ),
+            )
+    return resp
+
+
+def _teardown_request(exc=None):
+    # For streamed responses, this runs after the body has been sent
+    start = g.pop("restd_start", None)
+    if start is None:
+        return
+    route = _route()
+    registry.inc("restd_requests_in_flight", value=-1)
+    registry.observe(
+        "restd_request_duration_seconds", {"route": route}, time.perf_counter() - start
+    )
+    for phase, seconds in g.get("restd_phases", {}).items():
+        registry.observe(
+            "restd_request_phase_seconds", {"route": route, "phase": phase}, seconds
+        )
+    ads = g.get("restd_ads", 0)
+    if ads:
+        registry.inc("restd_ads_returned_total", {"route": route}, ads)
+
+
+def install(app):
+    """Register the request hooks and the /metrics endpoint on `app`.
+    Call this before registering other after_request handlers that
+    change the body (e.g. compression), so the bytes counted are the
+    bytes sent.
+
+    """
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
+
+
+def _collect_stats():
+    """Copy the counters kept by other modules into the registry."""
+    stats = utils.location_cache.stats()
+    for result in ("hits", "negative_hits", "misses", "evictions"):
+        registry.set("restd_location_cache_total", {"result": result}, stats[result])
+    registry.set("restd_location_cache_entries", None, stats["entries"])
+    stats = utils.constraint_cache.stats()
+    for result in ("hits", "misses", "evictions"):
+        registry.set("restd_constraint_cache_total", {"result": result}, stats[result])
+    registry.set("restd_constraint_cache_entries", None, stats["entries"])
+    for encoding, totals in compression.stats().items():
+        registry.set(
+            "restd_compression_bytes_total",
+            {"encoding": encoding, "direction": "in"},
+            totals["bytes_in"],
+        )
+        registry.set(
+            "restd_compression_bytes_total",
+            {"encoding": encoding, "direction": "out"},
+            totals["bytes_out"],
+        )
+        registry.set(
+            "restd_compression_cpu_seconds_total",
+            {"encoding": encoding},
+            totals["cpu_seconds"],
+        )
+
+
+def metrics_dir():
+    # type: () -> Optional[str]
+    return utils.param_table.get("RESTD_METRICS_DIR") or None
+
+
+def _write_own(directory):
+    """Save this worker's metrics in `directory`, atomically."""
+    _collect_stats()
+    data = json.dumps(registry.snapshot())
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.rename(tmp_path, os.path.join(directory, "%d.json" % os.getpid()))
+    except OSError:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _pid_alive(pid):
+    # type: (int) -> bool
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read_all(directory):
+    # type: (str) -> Dict[int, Dict[str, List]]
+    """Return the saved metrics of the live workers, by PID, and remove
+    the files of workers that have exited.
+
+    """
+    workers = {}
+    for filename in os.listdir(directory):
+        if not filename.endswith(".json"):
+            continue
+        try:
+            pid = int(filename[: -len(".json")])
+        except ValueError:
+            continue
+        path = os.path.join(directory, filename)
+        if not _pid_alive(pid):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(path) as f:
+                workers[pid] = json.load(f)
+        except (OSError, ValueError):
+            continue
+    return workers
+
+
+_writer_lock = threading.Lock()
+_writer_pid = None  # type: Optional[int]
+
+
+def _writer_loop(directory):
+    while True:
+        time.sleep(WRITE_INTERVAL)
+        try:
+            _write_own(directory)
+        except OSError as err:
+            logger.warning("Failed to save metrics to %s: %s", directory, err)
+
+
+def _start_writer():
+    """Start the thread saving this worker's metrics, if RESTD_METRICS_DIR
+    is set and it isn't running in this process yet (workers are forked,
+    so check the PID).
+
+    """
+    global _writer_pid
+    if _writer_pid == os.getpid():
+        return
+    directory = metrics_dir()
+    if not directory:
+        return
+    with _writer_lock:
+        if _writer_pid == os.getpid():
+            return
+        _writer_pid = os.getpid()
+        thread = threading.Thread(target=_writer_loop, args=(directory,), name="metrics-writer")
+        thread.daemon = True
+        thread.start()
+
+
+def _escape(value):
+    # type: (str) -> str
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    # type: (List[Tuple[str, str]]) -> str
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (k, _escape(v)) for k, v in labels)
+
+
+def render(workers):
+    # type: (Dict[int, Dict[str, List]]) -> str
+    """Return the metrics of `workers` (PID -> Registry.snapshot()) in the
+    Prometheus text format.
+
+    """
+    samples = {}  # type: Dict[str, List[str]]
+    for pid, data in sorted(workers.items()):
+        worker = [("worker", str(pid))]
+        for name, labels, value in data.get("values", []):
+            labels = [tuple(label) for label in labels] + worker
+            samples.setdefault(name, []).append(
+                "%s%s %s" % (name, _format_labels(labels), repr(float(value)))
+            )
+        for name, labels, hist in data.get("histograms", []):
+            labels = [tuple(label) for label in labels] + worker
+            lines = samples.setdefault(name, [])
+            for bound, count in zip(DURATION_BUCKETS, hist):
+                lines.append(
+                    "%s_bucket%s %d"
+                    % (name, _format_labels(labels + [("le", repr(float(bound)))]), count)
+                )
+            lines.append(
+                "%s_bucket%s %d" % (name, _format_labels(labels + [("le", "+Inf")]), hist[-2])
+            )
+            lines.append("%s_count%s %d" % (name, _format_labels(labels), hist[-2]))
+            lines.append("%s_sum%s %s" % (name, _format_labels(labels), repr(float(hist[-1]))))
+
+    out = []
+    for name in sorted(samples):
+        metric_type, help_text = METRICS.get(name, ("untyped", ""))
+        out.append("# HELP %s %s" % (name, help_text))
+        out.append("# TYPE %s %s" % (name, metric_type))
+        out.extend(samples[name])
+    return "\n".join(out) + "\n"
+
+
+def metrics_view():
+    directory = metrics_dir()
+    workers = None
+    if directory:
+        try:
+            _write_own(directory)
+            workers = _read_all(directory)
+        except OSError as err:
+            logger.warning("Failed to read metrics from %s: %s", directory, err)
+    if not workers:
+        _collect_stats()
+        workers = {os.getpid(): registry.snapshot()}
+    return Response(render(workers), mimetype="text/plain; version=0.0.4")
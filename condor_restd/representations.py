@@ -0,0 +1,236 @@
+"""Output formats other than JSON, chosen with the Accept header:
+
+- NDJSON (`application/x-ndjson`): one JSON document per line, one line
+  per job or ad.
+- MessagePack (`application/msgpack`): the same structure as the JSON
+  output, in binary; needs the `msgpack` module.
+- CSV (`text/csv`) and Arrow IPC stream
+  (`application/vnd.apache.arrow.stream`): one row per job or ad and one
+  column per attribute; Arrow needs the `pyarrow` module.
+
+For the row-based formats, each job or ad is flattened into one row: the
+keys of the object (e.g. `jobid`, or `name` and `type`) followed by the
+attributes of its classad.  Attributes that are lists or nested ads are
+encoded as JSON.  Grouped results get a `group` column with the value of
+the groupby attribute.
+
+"""
+from __future__ import absolute_import
+
+import csv
+import io
+import json
+
+try:
+    from typing import Any, Dict, Iterable, List, Optional, Tuple
+except ImportError:
+    pass
+
+from flask import make_response, request
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+from . import conditional, metrics
+from .streaming import NDJSON_MIMETYPE
+
+
+MSGPACK_MIMETYPES = ["application/msgpack", "application/x-msgpack"]
+CSV_MIMETYPE = "text/csv"
+ARROW_MIMETYPE = "application/vnd.apache.arrow.stream"
+
+
+def finish(resp, headers=None):
+    """Add the headers common to all representations."""
+    resp.headers.extend(headers or {})
+    resp.headers["Access-Control-Allow-Origin"] = "*"
+    resp.vary.add("Accept")
+    return conditional.finish_response(resp)
+
+
+def _is_envelope(data):
+    # type: (Any) -> bool
+    """Is `data` a multi-schedd result: {"jobs": [...], "errors": {...}}?"""
+    return isinstance(data, dict) and set(data) == {"jobs", "errors"}
+
+
+def _items(data):
+    # type: (Any) -> Iterable[Tuple[Any, Any]]
+    """Return (group, object) pairs for the jobs or ads in `data`; group
+    is None if the result isn't grouped.  Errors from a multi-schedd
+    result are returned as objects with "schedd" and "error" keys.
+
+    """
+    if _is_envelope(data):
+        for item in data["jobs"]:
+            yield None, item
+        for schedd, message in sorted(data["errors"].items()):
+            yield None, {"schedd": schedd, "error": message}
+    elif isinstance(data, list):
+        for item in data:
+            yield None, item
+    elif isinstance(data, dict) and data and all(
+        isinstance(value, list) for value in data.values()
+    ):
+        for group, items in data.items():
+            for item in items:
+                yield group, item
+    elif isinstance(data, dict):
+        yield None, data
+    else:
+        yield None, {"value": data}
+
+
+def _flatten(group, item):
+    # type: (Any, Any) -> Dict[str, Any]
+    row = {}  # type: Dict[str, Any]
+    if group is not None:
+        row["group"] = group
+    if not isinstance(item, dict):
+        row["value"] = item
+        return row
+    for key, value in item.items():
+        if key == "classad" and isinstance(value, dict):
+            for attr, attr_value in value.items():
+                row.setdefault(attr, attr_value)
+        else:
+            row[key] = value
+    return row
+
+
+def rows_and_columns(data):
+    # type: (Any) -> Tuple[List[Dict[str, Any]], List[str]]
+    """Return the flattened rows of `data` and the column names.  The
+    columns are the top-level keys, then the attributes in the order of
+    the `projection` argument, if any, then the other attributes sorted.
+
+    """
+    rows = [_flatten(group, item) for group, item in _items(data)]
+    columns = []  # type: List[str]
+    seen = set()
+    leading = ["group", "schedd", "jobid", "name", "type", "error", "message", "value"]
+    projection = request.args.get("projection", "").lower().split(",")
+    all_keys = set()
+    for row in rows:
+        all_keys.update(row)
+    for key in leading + [p.strip() for p in projection] + sorted(all_keys):
+        if key and key in all_keys and key not in seen:
+            seen.add(key)
+            columns.append(key)
+    return rows, columns
+
+
+def _cell(value):
+    # type: (Any) -> str
+    if value is None:
+        return ""
+    if isinstance(value, str):
+        return value
+    return json.dumps(value)
+
+
+def _ndjson_body(data):
+    # type: (Any) -> str
+    if _is_envelope(data):
+        lines = [json.dumps(item) for item in data["jobs"]]
+        lines.append(json.dumps({"errors": data["errors"]}))
+    elif isinstance(data, list):
+        lines = [json.dumps(item) for item in data]
+    else:
+        lines = [json.dumps(data)]
+    return "".join(line + "\n" for line in lines)
+
+
+def _msgpack_body(data):
+    # type: (Any) -> bytes
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def _csv_body(data):
+    # type: (Any) -> str
+    rows, columns = rows_and_columns(data)
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([_cell(row.get(column)) for column in columns])
+    return buf.getvalue()
+
+
+def _arrow_column(values):
+    # type: (List[Any]) -> pyarrow.Array
+    """Return an Arrow array for a column; columns whose values can't be
+    given one type (e.g. an attribute that is an int in some ads and a
+    string in others) are converted to strings.
+
+    """
+    if any(isinstance(value, (list, dict)) for value in values):
+        return pyarrow.array(
+            [None if value is None else _cell(value) for value in values], pyarrow.string()
+        )
+    try:
+        return pyarrow.array(values)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+        return pyarrow.array(
+            [None if value is None else _cell(value) for value in values], pyarrow.string()
+        )
+
+
+def _arrow_body(data):
+    # type: (Any) -> bytes
+    rows, columns = rows_and_columns(data)
+    table = pyarrow.table(
+        dict(
+            (column, _arrow_column([row.get(column) for row in rows]))
+            for column in columns
+        )
+    )
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def _output(serialize):
+    """Return a representation function that serializes the data with
+    `serialize`.
+
+    """
+
+    def output(data, code, headers=None):
+        if code == 304:
+            # The resource found that the client's copy is current
+            return finish(make_response("", code), headers)
+        with metrics.timed("serialize"):
+            body = serialize(data)
+        return finish(make_response(body, code), headers)
+
+    return output
+
+
+output_ndjson = _output(_ndjson_body)
+output_msgpack = _output(_msgpack_body)
+output_csv = _output(_csv_body)
+output_arrow = _output(_arrow_body)
+
+
+def register(api):
+    """Register the representations whose dependencies are installed, after
+    the default JSON representation.
+
+    """
+    api.representation(NDJSON_MIMETYPE)(output_ndjson)
+    if msgpack is not None:
+        for mimetype in MSGPACK_MIMETYPES:
+            api.representation(mimetype)(output_msgpack)
+    api.representation(CSV_MIMETYPE)(output_csv)
+    if pyarrow is not None:
+        api.representation(ARROW_MIMETYPE)(output_arrow)
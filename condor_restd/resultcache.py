@@ -0,0 +1,328 @@
+"""A cache of responses shared by all the worker processes of a server
+(e.g. `gunicorn -w4`), so clients polling the same URL don't each cause
+a query to a daemon.
+
+Enabled by setting RESTD_RESULT_CACHE_DIR to a directory writable by all
+the workers, and RESTD_RESULT_CACHE_TTL (or RESTD_RESULT_CACHE_TTL_<ROUTE>
+for one route, e.g. RESTD_RESULT_CACHE_TTL_GROUPED_STATUS) to the number
+of seconds responses are reused.  Responses are keyed by path, sorted
+query arguments, and Accept header, and stored uncompressed, one file per
+response; they are compressed for each client as usual.
+
+Requests for the same key are coalesced: while one worker (or thread)
+is computing a response, the others wait for it (for at most
+RESTD_RESULT_CACHE_WAIT seconds) instead of sending the same query.  The
+locks are flock()s on a lock file for each key, removed once the
+response is stored, so a crashed worker never leaves a key locked and
+requests for different keys never wait for each other.  Error responses
+are stored too, but only for ERROR_TTL seconds, so the requests waiting
+for one fail fast instead of each sending the failing query in turn.
+
+Cached responses have an `X-Cache: HIT` header (`MISS` otherwise) and
+an Age header.
+
+"""
+from __future__ import absolute_import
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+try:
+    from typing import Dict, Optional, Tuple
+except ImportError:
+    pass
+
+from flask import Response, g, request
+
+from . import metrics, representations, utils
+
+
+logger = logging.getLogger(__name__)
+
+# The routes (first path component after /v1/) whose responses can be
+# cached; watch streams, delta queries, streamed responses and refreshes
+# never are
+ROUTES = (
+    "jobs",
+    "history",
+    "grouped_jobs",
+    "grouped_history",
+    "status",
+    "grouped_status",
+    "config",
+)
+
+# Headers stored with a response
+STORED_HEADERS = ("Content-Type", "ETag", "Link", "Retry-After")
+
+# How long (in seconds) error responses are stored, at most
+ERROR_TTL = 1.0
+
+# Prefix of the names of lock files; the rest is the key
+LOCK_PREFIX = "lock-"
+
+# How often (in seconds) each worker deletes expired responses
+PRUNE_INTERVAL = 60.0
+
+# How often (in seconds) a waiting request checks whether the response
+# it is waiting for is ready
+POLL_INTERVAL = 0.02
+
+_last_prune = 0.0
+
+
+def cache_dir():
+    # type: () -> str
+    return str(utils.param_table.get("RESTD_RESULT_CACHE_DIR", "") or "")
+
+
+def ttl(route):
+    # type: (str) -> float
+    default = utils.param_float("RESTD_RESULT_CACHE_TTL", 0)
+    return utils.param_float("RESTD_RESULT_CACHE_TTL_%s" % route.upper(), default)
+
+
+def wait_timeout():
+    # type: () -> float
+    return utils.param_float("RESTD_RESULT_CACHE_WAIT", 30)
+
+
+def _route():
+    # type: () -> Optional[str]
+    """Return the route of the current request if its response can be
+    cached, otherwise None.
+
+    """
+    if request.method != "GET" or not request.path.startswith("/v1/"):
+        return None
+    route = request.path[len("/v1/") :].split("/", 1)[0]
+    if route not in ROUTES or request.path.endswith("/watch"):
+        return None
+    if "since" in request.args or "stream" in request.args or "refresh" in request.args:
+        return None
+    return route
+
+
+def _key():
+    # type: () -> str
+    args = sorted(request.args.items(multi=True))
+    accept = request.headers.get("Accept", "").replace(" ", "")
+    return hashlib.sha1(
+        json.dumps([request.path, args, accept]).encode("utf-8")
+    ).hexdigest()
+
+
+def _read(directory, key, max_age):
+    # type: (str, str, float) -> Optional[Tuple[Dict, bytes]]
+    """Return the header and body of the stored response for `key`, or
+    None if there is none younger than `max_age` seconds (or the `ttl`
+    stored with it, if shorter).
+
+    """
+    try:
+        with open(os.path.join(directory, key), "rb") as f:
+            header = json.loads(f.readline().decode("utf-8"))
+            if time.time() - header["time"] >= min(max_age, header.get("ttl", max_age)):
+                return None
+            return header, f.read()
+    except (IOError, OSError, KeyError, TypeError, ValueError):
+        return None
+
+
+def _write(directory, key, header, body):
+    # type: (str, str, Dict, bytes) -> None
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(json.dumps(header).encode("utf-8") + b"\n")
+            f.write(body)
+        os.rename(tmp_path, os.path.join(directory, key))
+    except (IOError, OSError):
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _prune(directory):
+    """Delete the stored responses (and unused lock files) older than the
+    longest TTL.
+
+    """
+    global _last_prune
+    now = time.time()
+    if now - _last_prune < PRUNE_INTERVAL:
+        return
+    _last_prune = now
+    max_age = max(ttl(route) for route in ROUTES)
+    for name in os.listdir(directory):
+        if name.startswith("."):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if now - os.stat(path).st_mtime <= max_age:
+                continue
+            if name.startswith(LOCK_PREFIX):
+                # Left by a crashed worker, unless someone holds it
+                fd = _lock(directory, name[len(LOCK_PREFIX) :])
+                if fd is not None:
+                    _release(directory, name[len(LOCK_PREFIX) :], fd)
+            else:
+                os.unlink(path)
+        except OSError:
+            pass
+
+
+def _lock(directory, key):
+    # type: (str, str) -> Optional[int]
+    """Try to lock `key`; return the file descriptor holding the lock,
+    or None if someone else has it.
+
+    """
+    path = os.path.join(directory, LOCK_PREFIX + key)
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            os.close(fd)
+            return None
+        # The previous holder may have removed the file between our open
+        # and flock; a lock on a removed file locks nothing
+        try:
+            held = os.fstat(fd).st_ino == os.stat(path).st_ino
+        except OSError:
+            held = False
+        if held:
+            return fd
+        os.close(fd)
+
+
+def _release(directory, key, fd):
+    # type: (str, str, int) -> None
+    """Unlock `key` and remove its lock file.  The file is removed while
+    still locked, so nobody else can be holding it.
+
+    """
+    try:
+        os.unlink(os.path.join(directory, LOCK_PREFIX + key))
+    except OSError:
+        pass
+    os.close(fd)
+
+
+def _unlock():
+    lock = g.pop("restd_cache_lock", None)
+    if lock is not None:
+        _release(*lock)
+
+
+def _cached_response(header, body):
+    # type: (Dict, bytes) -> Response
+    resp = Response(body, status=header["status"])
+    for name, value in header["headers"].items():
+        resp.headers[name] = value
+    resp.headers["Age"] = "%d" % (header.get("age", 0) + time.time() - header["time"])
+    resp.headers["X-Cache"] = "HIT"
+    return representations.finish(resp)
+
+
+def before_request():
+    """before_request hook: answer the request from the cache if possible.
+    Otherwise wait for another worker computing the same response, or
+    lock the key so others wait for this one.
+
+    """
+    directory = cache_dir()
+    route = _route() if directory else None
+    max_age = ttl(route) if route else 0
+    if max_age <= 0:
+        return None
+    key = _key()
+    g.restd_cache = (directory, key)
+    deadline = time.monotonic() + wait_timeout()
+    waited = False
+    try:
+        while True:
+            cached = _read(directory, key, max_age)
+            if cached is not None:
+                metrics.registry.inc(
+                    "restd_result_cache_total", {"result": "coalesced" if waited else "hit"}
+                )
+                g.pop("restd_cache", None)
+                return _cached_response(*cached)
+            fd = _lock(directory, key)
+            if fd is not None:
+                # Someone may have stored it between the read and the lock
+                cached = _read(directory, key, max_age)
+                if cached is not None:
+                    _release(directory, key, fd)
+                    continue
+                g.restd_cache_lock = (directory, key, fd)
+                break
+            if time.monotonic() > deadline:
+                break  # Compute it without the lock
+            waited = True
+            time.sleep(POLL_INTERVAL)
+    except (IOError, OSError) as err:
+        logger.warning("Failed to use result cache in %s: %s", directory, err)
+        g.pop("restd_cache", None)
+        return None
+    metrics.registry.inc("restd_result_cache_total", {"result": "miss"})
+    return None
+
+
+def after_request(resp):
+    # type: (Response) -> Response
+    """after_request hook: store a successful or error response for the
+    other requests for it.  Register this after the handlers that change
+    the body (e.g. compression), so it runs before them.
+
+    """
+    cache = g.pop("restd_cache", None)
+    if cache is None:
+        return resp
+    directory, key = cache
+    try:
+        # Not a 304 or other response that depends on the request's headers
+        if (resp.status_code == 200 or resp.status_code >= 400) and not resp.is_streamed:
+            header = dict(
+                status=resp.status_code,
+                time=time.time(),
+                # From a snapshot or replica; the replica's Age header is
+                # only added after this
+                age=int(resp.headers.get("Age") or g.get("restd_replica_age") or 0),
+                headers=dict(
+                    (name, resp.headers[name])
+                    for name in STORED_HEADERS
+                    if name in resp.headers
+                ),
+            )
+            if resp.status_code != 200:
+                header["ttl"] = ERROR_TTL
+            try:
+                _write(directory, key, header, resp.get_data())
+                _prune(directory)
+            except (IOError, OSError) as err:
+                logger.warning("Failed to store response in %s: %s", directory, err)
+    finally:
+        _unlock()
+    resp.headers["X-Cache"] = "MISS"
+    return resp
+
+
+def teardown_request(exc=None):
+    _unlock()
+
+
+def install(app):
+    """Register the cache's request hooks on `app`."""
+    app.before_request(before_request)
+    app.after_request(after_request)
+    app.teardown_request(teardown_request)
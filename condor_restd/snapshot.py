@@ -0,0 +1,327 @@
+"""In-memory snapshots of the ads in the collector, used to answer the
+status endpoints without sending a query to the collector for every
+request.
+
+Enabled by setting RESTD_STATUS_SNAPSHOT_INTERVAL to the number of
+seconds between refreshes.  A snapshot of an ad type is taken the first
+time that type is requested, and then refreshed by a background thread
+until it has not been used for a while.
+
+"""
+from __future__ import absolute_import
+
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+
+try:
+    from typing import Dict, List, Optional, Tuple
+except ImportError:
+    pass
+
+try:
+    from htcondor2 import Collector
+    from classad2 import ClassAd
+except ImportError:
+    from htcondor import Collector
+    from classad import ClassAd
+
+from . import metrics, utils
+
+
+logger = logging.getLogger(__name__)
+
+# Attributes that have an index; lookups use the lowercased value.
+INDEXED_ATTRS = ("name", "machine", "mytype")
+
+# Stop refreshing a snapshot that hasn't been used in this many seconds.
+IDLE_TIMEOUT = 600
+
+# Don't use a snapshot older than this many refresh intervals (i.e. if
+# refreshes have been failing); query the collector instead.
+MAX_AGE_INTERVALS = 3
+
+# Attributes identifying an ad and the version of it in the collector
+FINGERPRINT_ATTRS = ("name", "updatesequencenumber", "lastheardfrom", "daemonstarttime")
+
+_EQUALITY_RE = re.compile(
+    r'^(?:my\.)?(name|machine|mytype)\s*(?:==|=\?=)\s*"([^"\\]*)"$', re.IGNORECASE
+)
+
+
+def _ad_fingerprint(ad_dict):
+    # type: (Dict) -> str
+    """Return a string that changes when the ad changes.  Daemons bump
+    UpdateSequenceNumber (and the collector sets LastHeardFrom) on every
+    update, so those identify the version of an ad without looking at
+    the rest of it.
+
+    """
+    versions = [ad_dict.get(attr) for attr in FINGERPRINT_ATTRS]
+    if versions[1] is None and versions[2] is None:
+        return json.dumps(ad_dict, sort_keys=True)
+    return json.dumps(versions)
+
+
+def snapshot_interval():
+    # type: () -> float
+    return utils.param_float("RESTD_STATUS_SNAPSHOT_INTERVAL", 0)
+
+
+def _scan(constraint):
+    """Yield (position, character, depth) for each character of
+    `constraint` outside of string literals, where depth is the nesting
+    level of parens/brackets/braces before the character.
+
+    """
+    depth = 0
+    in_string = False
+    escaped = False
+    for i, c in enumerate(constraint):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+            continue
+        if c == '"':
+            in_string = True
+        elif c in "([{":
+            yield i, c, depth
+            depth += 1
+            continue
+        elif c in ")]}":
+            depth -= 1
+        yield i, c, depth
+
+
+def _split_conjuncts(constraint):
+    # type: (str) -> Optional[List[str]]
+    """Split a constraint into its top-level `&&` terms.  Return None if
+    the constraint has a top-level `||` or `?:`, in which case the terms
+    are not all required to be true.
+
+    """
+    terms = []
+    start = 0
+    skip = False
+    for i, c, depth in _scan(constraint):
+        if skip:
+            skip = False
+            continue
+        if depth != 0:
+            continue
+        two = constraint[i : i + 2]
+        if two == "||":
+            return None
+        if c == "?" and constraint[i - 1 : i + 2] != "=?=":
+            return None
+        if two == "&&":
+            terms.append(constraint[start:i])
+            start = i + 2
+            skip = True
+    terms.append(constraint[start:])
+    return terms
+
+
+def _strip_parens(term):
+    # type: (str) -> str
+    """Remove parens around the whole of `term`."""
+    term = term.strip()
+    while term.startswith("("):
+        closing = None
+        for i, c, depth in _scan(term):
+            if c == ")" and depth == 0:
+                closing = i
+                break
+        if closing != len(term) - 1:
+            break
+        term = term[1:-1].strip()
+    return term
+
+
+def index_lookups(constraint):
+    # type: (str) -> List[Tuple[str, str]]
+    """Return (attribute, lowercased value) pairs for the terms of the
+    form `attr == "value"` on an indexed attribute that must be true for
+    `constraint` to be true.
+
+    """
+    terms = _split_conjuncts(constraint) if constraint else None
+    if not terms:
+        return []
+    lookups = []
+    for term in terms:
+        match = _EQUALITY_RE.match(_strip_parens(term))
+        if match:
+            lookups.append((match.group(1).lower(), match.group(2).lower()))
+    return lookups
+
+
+class PoolSnapshot(object):
+    """All the ads of one type in the collector, converted to dicts and
+    indexed by name, machine, and mytype.
+
+    """
+
+    def __init__(self, ad_type):
+        self.ad_type = ad_type
+        self.last_used = time.monotonic()
+        self._refresh_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread = None  # type: Optional[threading.Thread]
+        # (time taken, [(classad, dict)], {attr: {value: [index into list]}},
+        #  fingerprint)
+        self._state = None  # type: Optional[Tuple[float, List[Tuple[ClassAd, Dict]], Dict[str, Dict[str, List[int]]], str]]
+
+    def refresh(self):
+        """Query the collector for all ads of this type and replace the
+        snapshot.  Errors from the query are passed through.
+
+        """
+        with self._refresh_lock:
+            taken = time.monotonic()
+            classads = Collector().query(self.ad_type, constraint="true")
+            entries = []  # type: List[Tuple[ClassAd, Dict]]
+            indexes = dict((attr, {}) for attr in INDEXED_ATTRS)  # type: Dict[str, Dict[str, List[int]]]
+            fingerprint = hashlib.sha1()
+            for ad in classads:
+                ad_dict = utils.classad_to_dict(ad)
+                for attr in INDEXED_ATTRS:
+                    value = ad_dict.get(attr)
+                    if isinstance(value, str):
+                        indexes[attr].setdefault(value.lower(), []).append(len(entries))
+                entries.append((ad, ad_dict))
+                fingerprint.update(_ad_fingerprint(ad_dict).encode("utf-8"))
+            self._state = (taken, entries, indexes, fingerprint.hexdigest())
+
+    def age(self):
+        # type: () -> Optional[float]
+        """Seconds since the current snapshot was taken, or None if there
+        is no snapshot.
+
+        """
+        state = self._state
+        if state is None:
+            return None
+        return time.monotonic() - state[0]
+
+    def fingerprint(self):
+        # type: () -> Optional[str]
+        """A value that changes when the ads in the snapshot change, or
+        None if there is no snapshot.
+
+        """
+        state = self._state
+        if state is None:
+            return None
+        return state[3]
+
+    def query(self, constraint, name=None, projection_list=None):
+        # type: (str, Optional[str], Optional[List[str]]) -> List[Dict]
+        """Return copies of the ads in the snapshot that match `constraint`
+        (and have the name `name`, if given), with only the attributes in
+        `projection_list` if it's non-empty.
+
+        Raises SyntaxError if the constraint can't be parsed.
+
+        """
+        self.last_used = time.monotonic()
+        _, entries, indexes, _ = self._state
+        expr = None
+        if constraint and constraint.strip().lower() != "true":
+            expr = utils.parse_expr(constraint)
+
+        lookups = index_lookups(constraint)
+        if name:
+            lookups.append(("name", name.lower()))
+        candidates = None  # type: Optional[List[int]]
+        for attr, value in lookups:
+            positions = indexes[attr].get(value, [])
+            if candidates is None or len(positions) < len(candidates):
+                candidates = positions
+        if candidates is None:
+            candidates = range(len(entries))
+
+        results = []
+        for pos in candidates:
+            ad, ad_dict = entries[pos]
+            if name and str(ad_dict.get("name", "")).lower() != name.lower():
+                continue
+            if expr is not None and expr.eval(ad) is not True:
+                continue
+            if projection_list:
+                results.append(
+                    dict((k, ad_dict[k]) for k in projection_list if k in ad_dict)
+                )
+            else:
+                results.append(dict(ad_dict))
+        return results
+
+    def _run(self, interval):
+        while time.monotonic() - self.last_used < IDLE_TIMEOUT:
+            time.sleep(interval)
+            try:
+                self.refresh()
+            except utils.CONDOR_ERRORS as err:
+                metrics.upstream_error("collector")
+                logger.warning("Failed to refresh %s snapshot: %s", self.ad_type, err)
+        logger.info("Dropping unused %s snapshot", self.ad_type)
+        with _snapshots_lock:
+            if _snapshots.get(str(self.ad_type)) is self:
+                del _snapshots[str(self.ad_type)]
+
+    def start(self, interval):
+        """Take the first snapshot, if that hasn't been done yet, and start
+        the thread that refreshes it every `interval` seconds.  Errors
+        from the first query are passed through.
+
+        """
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self.refresh()
+            self._thread = threading.Thread(
+                target=self._run, args=(interval,), name="snapshot-%s" % self.ad_type
+            )
+            self._thread.daemon = True
+            self._thread.start()
+
+
+_snapshots = {}  # type: Dict[str, PoolSnapshot]
+_snapshots_lock = threading.Lock()
+
+
+def get_snapshot(ad_type):
+    # type: (...) -> Optional[PoolSnapshot]
+    """Return an up-to-date snapshot of the ads of `ad_type`, taking it
+    first if necessary.  Return None if snapshots are disabled, or if the
+    snapshot is unavailable or too old (e.g. because the collector is
+    down), in which case the caller should query the collector directly.
+
+    """
+    interval = snapshot_interval()
+    if interval <= 0:
+        return None
+    with _snapshots_lock:
+        snapshot = _snapshots.get(str(ad_type))
+        if snapshot is None:
+            snapshot = _snapshots[str(ad_type)] = PoolSnapshot(ad_type)
+    try:
+        snapshot.start(interval)
+    except utils.CONDOR_ERRORS as err:
+        metrics.upstream_error("collector")
+        logger.warning("Failed to take %s snapshot: %s", ad_type, err)
+        with _snapshots_lock:
+            if _snapshots.get(str(ad_type)) is snapshot:
+                del _snapshots[str(ad_type)]
+        return None
+    age = snapshot.age()
+    if age is None or age > interval * MAX_AGE_INTERVALS:
+        return None
+    return snapshot
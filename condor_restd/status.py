@@ -3,12 +3,14 @@ from __future__ import absolute_import
 from collections import defaultdict
 
 try:
-    from typing import Dict, List, Optional
+    from typing import Dict, List, Optional, Tuple
 except ImportError:
     pass
 
+from flask import request
 from flask_restful import Resource, reqparse, abort
 import six
+from werkzeug.http import quote_etag
 
 try:
     from htcondor2 import AdTypes, Collector
@@ -18,7 +20,7 @@ except ImportError:
     from classad import ClassAd
 
 from .errors import BAD_GROUPBY, BAD_PROJECTION, FAIL_QUERY, NO_CLASSADS
-from . import utils
+from . import admission, conditional, metrics, snapshot, utils
 
 
 AD_TYPES_MAP = {
@@ -39,6 +41,74 @@ AD_TYPES_MAP = {
 }
 
 
+def _query_status(query, constraint, name, query_projection_list):
+    # type: (str, str, Optional[str], List[str]) -> Tuple[List[Dict], Dict[str, str]]
+    """Return the ads of the type given by `query` that match `constraint`
+    (and have the name `name`, if given) as dicts, with only the
+    attributes in `query_projection_list` if it's non-empty; also return
+    the headers to add to the response.
+
+    The ads come from the pool snapshot if snapshots are enabled, in which
+    case the age of the snapshot is returned in the Age header, and the
+    ETag is made from the snapshot's fingerprint, the request URL, and the
+    Accept header.  If that matches the request's If-None-Match, the ads
+    are None: the client's copy is current and the response should be a
+    304.
+    Otherwise, the collector is queried.
+
+    Aborts with a 400 if the constraint is bad (which is checked before
+    querying), and a 503 if the query failed.
+
+    """
+    if constraint:
+        # Reject a bad constraint before contacting the collector
+        try:
+            utils.parse_expr(constraint)
+        except SyntaxError as err:
+            abort(400, message=str(err))
+
+    ad_type = AD_TYPES_MAP[query]
+    pool_snapshot = snapshot.get_snapshot(ad_type)
+    if pool_snapshot is not None:
+        etag = conditional.make_etag(
+            pool_snapshot.fingerprint(),
+            request.full_path,
+            request.headers.get("Accept", ""),
+        )
+        headers = {"Age": "%d" % pool_snapshot.age(), "ETag": quote_etag(etag)}
+        if conditional.not_modified(etag):
+            return None, headers
+        try:
+            with metrics.timed("query"):
+                ad_dicts = pool_snapshot.query(constraint, name, query_projection_list)
+        except SyntaxError as err:
+            abort(400, message=str(err))
+            raise  # quiet warning
+        metrics.count_ads(len(ad_dicts))
+        return ad_dicts, headers
+
+    constraint = constraint or "true"
+    if name:
+        constraint += ' && (name == "%s")' % name
+
+    classads = []  # type: List[ClassAd]
+    try:
+        with admission.admitted("collector", expensive=not (query_projection_list or name)):
+            with metrics.timed("query"):
+                classads = Collector().query(
+                    ad_type, constraint=constraint, projection=query_projection_list
+                )
+    except SyntaxError as err:
+        abort(400, message=str(err))
+    except utils.CONDOR_ERRORS as err:
+        metrics.upstream_error("collector")
+        abort(503, message=FAIL_QUERY % {"service": "collector", "err": err})
+    with metrics.timed("convert"):
+        ad_dicts = utils.classads_to_dicts(classads)
+    metrics.count_ads(len(ad_dicts))
+    return ad_dicts, {}
+
+
 class V1StatusResource(Resource):
     """Endpoints for accessing condor_status information; implements the
     /v1/status endpoints.
@@ -61,8 +131,6 @@ class V1StatusResource(Resource):
             abort(400, message=str(err))
             return  # quiet warning
 
-        collector = Collector()
-        ad_type = AD_TYPES_MAP[args.query]
         projection_list = query_projection_list = []
 
         if projection:
@@ -71,25 +139,16 @@ class V1StatusResource(Resource):
                 abort(400, message="%s: %s" % (BAD_PROJECTION, ", ".join(badattrs)))
             projection_list = projection.lower().split(",")
             # We need 'name' and 'mytype' in the projection to extract it from the classad
-            query_projection_list = list(set(["name", "mytype"] + projection_list))
-
-        constraint = constraint or "true"
-        if name:
-            constraint += ' && (name == "%s")' % name
-
-        classads = []  # type: List[ClassAd]
-        try:
-            classads = collector.query(
-                ad_type, constraint=constraint, projection=query_projection_list
-            )
-        except SyntaxError as err:
-            abort(400, message=str(err))
-        except (IOError, RuntimeError) as err:
-            abort(503, message=FAIL_QUERY % {"service": "collector", "err": err})
-        if not classads:
-            return []
+            query_projection_list = sorted(set(["name", "mytype"] + projection_list))
+
+        ad_dicts, headers = _query_status(
+            args.query, constraint, name, query_projection_list
+        )
+        if ad_dicts is None:
+            return None, 304, headers
+        if not ad_dicts:
+            return [], 200, headers
         data = []
-        ad_dicts = utils.classads_to_dicts(classads)
         for ad in ad_dicts:
             name = ad["name"]
             type_ = ad["mytype"]
@@ -100,7 +159,7 @@ class V1StatusResource(Resource):
                     del ad["mytype"]
             data.append(dict(classad=ad, name=name, type=type_))
 
-        return data
+        return data, 200, headers
 
 
 class V1GroupedStatusResource(Resource):
@@ -134,8 +193,6 @@ class V1GroupedStatusResource(Resource):
         if not utils.validate_attribute(groupby):
             abort(400, message=BAD_GROUPBY)
 
-        collector = Collector()
-        ad_type = AD_TYPES_MAP[args.query]
         projection_list = query_projection_list = []
 
         if projection:
@@ -144,27 +201,18 @@ class V1GroupedStatusResource(Resource):
                 abort(400, message="%s: %s" % (BAD_PROJECTION, ", ".join(badattrs)))
             projection_list = projection.lower().split(",")
             # We need 'name' and 'mytype' in the projection to extract it from the classad
-            query_projection_list = list(
-                set(["name", "mytype", groupby] + projection_list)
+            query_projection_list = sorted(
+                set(["name", "mytype", groupby.lower()] + projection_list)
             )
 
-        constraint = constraint or "true"
-        if name:
-            constraint += ' && (name == "%s")' % name
-
-        classads = []  # type: List[ClassAd]
-        try:
-            classads = collector.query(
-                ad_type, constraint=constraint, projection=query_projection_list
-            )
-        except SyntaxError as err:
-            abort(400, message=str(err))
-        except (IOError, RuntimeError) as err:
-            abort(503, message=FAIL_QUERY % {"service": "collector", "err": err})
-        if not classads:
-            return {}
+        ad_dicts, headers = _query_status(
+            args.query, constraint, name, query_projection_list
+        )
+        if ad_dicts is None:
+            return None, 304, headers
+        if not ad_dicts:
+            return {}, 200, headers
         grouped_data = defaultdict(list)
-        ad_dicts = utils.classads_to_dicts(classads)
         groupby = groupby.lower()
         for ad in ad_dicts:
             name = ad["name"]
@@ -183,4 +231,4 @@ class V1GroupedStatusResource(Resource):
             except KeyError:
                 pass
 
-        return grouped_data
+        return grouped_data, 200, headers
@@ -0,0 +1,167 @@
+"""Helpers for sending large results as a stream of JSON documents
+instead of serializing the whole result in memory first.
+
+"""
+from __future__ import absolute_import
+
+import itertools
+import json
+
+try:
+    from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+except ImportError:
+    pass
+
+from flask import Response, current_app, request, stream_with_context
+
+
+JSON_MIMETYPE = "application/json"
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# Collect serialized items into chunks of about this many bytes before
+# handing them to the WSGI server, so we don't do one write per item.
+CHUNK_SIZE = 64 * 1024
+
+
+def wants_ndjson():
+    # type: () -> bool
+    """Return True if the client prefers newline-delimited JSON over
+    a JSON array, according to the Accept header.
+
+    """
+    return (
+        request.accept_mimetypes.best_match([JSON_MIMETYPE, NDJSON_MIMETYPE])
+        == NDJSON_MIMETYPE
+    )
+
+
+def _chunked(pieces):
+    # type: (Iterable[str]) -> Iterator[str]
+    buf = []
+    size = 0
+    for piece in pieces:
+        buf.append(piece)
+        size += len(piece)
+        if size >= CHUNK_SIZE:
+            yield "".join(buf)
+            buf = []
+            size = 0
+    if buf:
+        yield "".join(buf)
+
+
+class _Guarded(object):
+    """Iterable passing through `items`, logging (instead of raising) any
+    error, and remembering it in `error`.
+
+    Once the first chunk has been sent we can no longer change the
+    status code, so the best we can do is end the output early, in a way
+    the client can tell from a complete document: JSON output is left
+    unterminated, and NDJSON output ends with an `error` line instead of
+    its trailer.
+
+    """
+
+    def __init__(self, items):
+        # type: (Iterable[Dict]) -> None
+        self._items = items
+        self.error = None  # type: Optional[Exception]
+
+    def __iter__(self):
+        # type: () -> Iterator[Dict]
+        try:
+            for item in self._items:
+                yield item
+        except Exception as err:
+            current_app.logger.exception("Error while streaming response; output truncated")
+            self.error = err
+
+
+def _error_line(items):
+    # type: (_Guarded) -> str
+    return json.dumps({"error": "Output truncated: %s" % items.error}) + "\n"
+
+
+def _json_array_pieces(items):
+    # type: (_Guarded) -> Iterator[str]
+    yield "["
+    sep = ""
+    for item in items:
+        yield sep + json.dumps(item)
+        sep = ", "
+    if items.error is None:
+        yield "]\n"
+
+
+def _json_envelope_pieces(items, key, trailer):
+    # type: (_Guarded, str, Callable[[], Dict]) -> Iterator[str]
+    yield "{%s: " % json.dumps(key)
+    for piece in _json_array_pieces(items):
+        yield piece.rstrip("\n")
+    if items.error is not None:
+        return
+    for name, value in trailer().items():
+        yield ", %s: %s" % (json.dumps(name), json.dumps(value))
+    yield "}\n"
+
+
+def _ndjson_pieces(items):
+    # type: (_Guarded) -> Iterator[str]
+    for item in items:
+        yield json.dumps(item) + "\n"
+    if items.error is not None:
+        yield _error_line(items)
+
+
+def _ndjson_envelope_pieces(items, trailer):
+    # type: (_Guarded, Callable[[], Dict]) -> Iterator[str]
+    for item in items:
+        yield json.dumps(item) + "\n"
+    if items.error is not None:
+        yield _error_line(items)
+    else:
+        yield json.dumps(trailer()) + "\n"
+
+
+def stream_response(items, ndjson=None, envelope=None):
+    # type: (Iterable[Dict], bool, Optional[Tuple[str, Callable[[], Dict]]]) -> Response
+    """Return a response that sends `items` as they are produced, either
+    as a JSON array or as newline-delimited JSON (one item per line).
+    If `ndjson` is None, pick the format based on the Accept header.
+
+    If `envelope` is given, it is a (key, trailer) pair: the JSON output
+    is an object with the items under `key`, plus the entries of the dict
+    returned by calling `trailer` after the last item; the NDJSON output
+    has that dict as its last line.
+
+    The first item is fetched before the response is created, so errors
+    in setting up the query (e.g. a bad constraint or an unreachable
+    daemon) still result in a proper error response.  Later errors end
+    the output early (see `_Guarded`).
+
+    """
+    if ndjson is None:
+        ndjson = wants_ndjson()
+    items = iter(items)
+    try:
+        first = next(items)
+    except StopIteration:
+        items = iter(())
+    else:
+        items = itertools.chain([first], items)
+
+    if ndjson:
+        if envelope:
+            pieces = _ndjson_envelope_pieces(_Guarded(items), envelope[1])
+        else:
+            pieces = _ndjson_pieces(_Guarded(items))
+        mimetype = NDJSON_MIMETYPE
+    else:
+        if envelope:
+            pieces = _json_envelope_pieces(_Guarded(items), envelope[0], envelope[1])
+        else:
+            pieces = _json_array_pieces(_Guarded(items))
+        mimetype = JSON_MIMETYPE
+    resp = Response(stream_with_context(_chunked(pieces)), mimetype=mimetype)
+    resp.headers["Access-Control-Allow-Origin"] = "*"
+    return resp
@@ -7,32 +7,360 @@ except ImportError:
     import classad
     import htcondor
 
+import base64
+import collections
+import contextvars
 import json
+import os
+import threading
+import time
+
 import six
 
 try:
-    from typing import Dict, Any, Union, List, Tuple, Set
+    from typing import Dict, Any, Optional, Union, List, Tuple, Set
 except ImportError:
     pass
 
-from .errors import ScheddNotFound
+from .errors import DaemonNotFound, ScheddNotFound
 
 
-def get_schedd(pool=None, schedd_name=None):
+# Errors raised by the bindings when talking to a daemon fails.  Version 2
+# of the bindings raises HTCondorException instead of RuntimeError.
+CONDOR_ERRORS = (IOError, RuntimeError)  # type: Tuple[type, ...]
+if hasattr(htcondor, "HTCondorException"):
+    CONDOR_ERRORS += (htcondor.HTCondorException,)
+
+
+# Errors raised by the bindings for a classad expression that can't be
+# parsed.  Version 1 of the bindings raises a subclass of SyntaxError.
+CLASSAD_PARSE_ERRORS = (SyntaxError, ValueError)  # type: Tuple[type, ...]
+if hasattr(classad, "ClassAdException"):
+    CLASSAD_PARSE_ERRORS += (classad.ClassAdException,)
+
+
+def normalize_expr(text):
+    # type: (str) -> str
+    """Return `text` with leading and trailing whitespace removed and other
+    runs of whitespace outside of string literals and quoted attribute
+    names (`'my attr'`) replaced by one space, so trivially different
+    spellings of an expression compare equal.
+
+    """
+    out = []
+    quote = None  # The quote character of the literal or name we're in
+    escaped = space = False
+    for c in text.strip():
+        if quote is not None:
+            out.append(c)
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == quote:
+                quote = None
+        elif c.isspace():
+            space = True
+        else:
+            if space:
+                out.append(" ")
+                space = False
+            out.append(c)
+            if c in "\"'":
+                quote = c
+    return "".join(out)
+
+
+class ConstraintCache(object):
+    """A process-wide LRU cache of parsed classad expressions (i.e. the
+    constraints of requests), keyed by their normalized text, so the same
+    constraint sent by many clients is only parsed once.  Expressions
+    that fail to parse are cached too, with their error.
+
+    Holds up to RESTD_CONSTRAINT_CACHE_SIZE (default 1000) expressions;
+    0 disables caching.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # normalized text -> ExprTree, or the error message if it's invalid
+        self._entries = collections.OrderedDict()  # type: collections.OrderedDict
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def parse(self, text):
+        # type: (str) -> classad.ExprTree
+        """Return `text` parsed into a classad expression.  Raises
+        SyntaxError if it can't be parsed.
+
+        """
+        key = normalize_expr(text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if entry is None:
+            try:
+                entry = classad.ExprTree(key)
+            except CLASSAD_PARSE_ERRORS as err:
+                entry = "Invalid expression %r: %s" % (text, err)
+            self._store(key, entry)
+        if isinstance(entry, str):
+            raise SyntaxError(entry)
+        return entry
+
+    def _store(self, key, entry):
+        max_entries = int(param_float("RESTD_CONSTRAINT_CACHE_SIZE", 1000))
+        with self._lock:
+            self._entries[key] = entry
+            while len(self._entries) > max(max_entries, 0):
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        # type: () -> Dict[str, int]
+        """Return the cache counters and the current number of entries."""
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                entries=len(self._entries),
+            )
+
+
+constraint_cache = ConstraintCache()
+
+
+def parse_expr(text):
+    # type: (str) -> classad.ExprTree
+    """Return `text` parsed into a classad expression, from the constraint
+    cache if it has been parsed before.  Raises SyntaxError if it can't be
+    parsed.  The expression is shared, and must not be modified.
+
+    """
+    return constraint_cache.parse(text)
+
+
+def _is_not_found_error(err):
+    # type: (Exception) -> bool
+    """Return True if `err` is the bindings saying a daemon could not be located."""
+    message = str(err).lower()
+    return "unable to locate" in message or "unable to find" in message
+
+
+def param_float(name, default):
+    # type: (str, float) -> float
+    """Return the value of the config param `name` as a float, or
+    `default` if it is unset or not a number.
+
+    """
+    value = param_table.get(name)
+    if value is None:
+        return default
     try:
-        if schedd_name:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+class LocationCache(object):
+    """A process-wide cache of daemon location ads, so we don't ask the
+    collector to locate the same daemon on every request.
+
+    Location ads are kept for RESTD_LOCATION_CACHE_TTL seconds (default
+    60); failures to find a daemon are remembered for
+    RESTD_LOCATION_CACHE_NEGATIVE_TTL seconds (default 5).  Setting
+    a TTL to 0 disables that kind of caching.  Entries should be evicted
+    with invalidate() if talking to the cached address fails.
+
+    """
+
+    MAX_ENTRIES = 1024
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> (expiration time, location ad or None if not found)
+        self._entries = {}  # type: Dict[Tuple, Tuple[float, Optional[classad.ClassAd]]]
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(daemon_type, name, pool):
+        return (str(pool) if pool else None, str(daemon_type), name.lower() if name else None)
+
+    @staticmethod
+    def _not_found_message(daemon_type, name):
+        return "Unable to locate %s daemon%s" % (
+            str(daemon_type).split(".")[-1].lower(),
+            " %s" % name if name else "",
+        )
+
+    def locate(self, daemon_type, name=None, pool=None):
+        # type: (htcondor.DaemonTypes, Optional[str], Optional[str]) -> classad.ClassAd
+        """Return the location ad of a daemon; `name` None means the local
+        daemon of that type.  Raises DaemonNotFound if the daemon is
+        unknown; other errors from the collector are passed through and
+        not cached.
+
+        """
+        key = self._key(daemon_type, name, pool)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                if entry[1] is None:
+                    self.negative_hits += 1
+                    raise DaemonNotFound(self._not_found_message(daemon_type, name))
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        try:
             collector = htcondor.Collector(pool)
-            return htcondor.Schedd(
-                collector.locate(htcondor.DaemonTypes.Schedd, schedd_name)
+            if name:
+                location = collector.locate(daemon_type, name)
+            else:
+                location = collector.locate(daemon_type)
+        except (ValueError,) + CONDOR_ERRORS as err:
+            if not _is_not_found_error(err):
+                raise
+            self._store(key, None, param_float("RESTD_LOCATION_CACHE_NEGATIVE_TTL", 5))
+            six.raise_from(
+                DaemonNotFound(self._not_found_message(daemon_type, name)), err
             )
-        else:
-            return htcondor.Schedd()
-    except RuntimeError as err:
-        if "unable to locate" in str(err).lower():
-            six.raise_from(ScheddNotFound, err)
-    except ValueError as err:
-        if "unable to find" in str(err).lower():
-            six.raise_from(ScheddNotFound, err)
+
+        self._store(key, location, param_float("RESTD_LOCATION_CACHE_TTL", 60))
+        return location
+
+    def locate_all(self, daemon_type, pool=None):
+        # type: (htcondor.DaemonTypes, Optional[str]) -> List[classad.ClassAd]
+        """Return the location ads of all daemons of a type.  The ads are
+        also cached individually, so locating one of them by name right
+        after this does not need another query.  Errors from the collector
+        are passed through and not cached.
+
+        """
+        # Names can't contain "*", so this can't clash with a daemon's key
+        key = self._key(daemon_type, "*", pool)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        locations = list(htcondor.Collector(pool).locateAll(daemon_type))
+        ttl = param_float("RESTD_LOCATION_CACHE_TTL", 60)
+        for location in locations:
+            name = location.get("Name")
+            if name:
+                self._store(self._key(daemon_type, str(name), pool), location, ttl)
+        self._store(key, locations, ttl)
+        return locations
+
+    def _store(self, key, location, ttl):
+        if ttl <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if len(self._entries) >= self.MAX_ENTRIES:
+                for old_key, (expires, _) in list(self._entries.items()):
+                    if expires <= now:
+                        del self._entries[old_key]
+                if len(self._entries) >= self.MAX_ENTRIES:
+                    self._entries.clear()
+            self._entries[key] = (now + ttl, location)
+
+    def invalidate(self, daemon_type, name=None, pool=None):
+        """Forget the location of a daemon, e.g. because querying it failed."""
+        with self._lock:
+            if self._entries.pop(self._key(daemon_type, name, pool), None) is not None:
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        # type: () -> Dict[str, int]
+        """Return the cache counters and the current number of entries."""
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                negative_hits=self.negative_hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                entries=len(self._entries),
+            )
+
+
+location_cache = LocationCache()
+
+
+# Set to a dict by code running several queries together (e.g. a batch
+# request), so they share the daemon objects they create; copies of the
+# context made for their threads refer to the same dict.
+shared_daemons = contextvars.ContextVar("shared_daemons", default=None)
+
+
+def get_schedd(pool=None, schedd_name=None):
+    shared = shared_daemons.get()
+    key = ("schedd", str(pool) if pool else None, schedd_name.lower() if schedd_name else None)
+    if shared is not None and key in shared:
+        return shared[key]
+    if schedd_name:
+        try:
+            location = location_cache.locate(
+                htcondor.DaemonTypes.Schedd, schedd_name, pool
+            )
+        except DaemonNotFound as err:
+            six.raise_from(ScheddNotFound(schedd_name), err)
+        schedd = htcondor.Schedd(location)
+    else:
+        try:
+            schedd = htcondor.Schedd()
+        except (ValueError,) + CONDOR_ERRORS as err:
+            if _is_not_found_error(err):
+                six.raise_from(ScheddNotFound, err)
+            raise
+    if shared is not None:
+        shared.setdefault(key, schedd)
+    return schedd
+
+
+# Version 2 of the bindings has no htcondor._Param; use the type of
+# htcondor.param itself.
+_MAPPING_TYPES = (dict, type(htcondor.param), htcondor.RemoteParam)
+
+
+def is_local_schedd(schedd_name):
+    # type: (Optional[str]) -> bool
+    """Return True if `schedd_name` (None for the default schedd) is the
+    schedd on this host, according to SCHEDD_NAME or FULL_HOSTNAME.
+
+    """
+    if schedd_name is None:
+        return True
+    full_hostname = str(param_table.get("FULL_HOSTNAME", ""))
+    name = str(param_table.get("SCHEDD_NAME", "") or "")
+    if not name:
+        name = full_hostname
+    elif "@" not in name:
+        name = "%s@%s" % (name, full_hostname)
+    return schedd_name.lower() == name.lower()
 
 
 def deep_lcasekeys(in_value):
@@ -40,7 +368,7 @@ def deep_lcasekeys(in_value):
     in dictionaries are lowercased.
 
     """
-    if isinstance(in_value, (dict, htcondor._Param, htcondor.RemoteParam)):
+    if isinstance(in_value, _MAPPING_TYPES):
         out_value = dict()
         for k, v in in_value.items():
             k = k.lower()
@@ -53,10 +381,171 @@ def deep_lcasekeys(in_value):
         return in_value
 
 
+def _split_config_list(value):
+    # type: (Optional[str]) -> List[str]
+    return [item for item in re.split(r"[\s,]+", value or "") if item]
+
+
+class ParamTable(object):
+    """A copy of the local config with lowercased names, so reading it
+    doesn't mean re-parsing the config files and copying every param.
+
+    The config is reloaded and the copy rebuilt when the config sources
+    change: the files named by CONDOR_CONFIG (or the default locations),
+    LOCAL_CONFIG_FILE, LOCAL_CONFIG_DIR, and USER_CONFIG_FILE, and the
+    _CONDOR_* environment variables.  The sources are checked at most
+    once every CHECK_INTERVAL seconds.
+
+    """
+
+    CHECK_INTERVAL = 1.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._table = None  # type: Optional[Dict[str, Any]]
+        self._signature = None  # type: Optional[Tuple]
+        self._checked = 0.0
+        self.rebuilds = 0
+
+    @staticmethod
+    def _config_paths():
+        # type: () -> List[str]
+        condor_config = os.environ.get("CONDOR_CONFIG")
+        if condor_config:
+            paths = [condor_config]
+        else:
+            paths = [
+                "/etc/condor/condor_config",
+                "/usr/local/etc/condor_config",
+                os.path.expanduser("~condor/condor_config"),
+            ]
+        for path in _split_config_list(htcondor.param.get("LOCAL_CONFIG_FILE")):
+            if not path.endswith("|"):
+                paths.append(path)
+        for directory in _split_config_list(htcondor.param.get("LOCAL_CONFIG_DIR")):
+            paths.append(directory)
+            try:
+                names = sorted(os.listdir(directory))
+            except OSError:
+                continue
+            paths.extend(os.path.join(directory, name) for name in names)
+        user_config = htcondor.param.get("USER_CONFIG_FILE", "user_config")
+        if user_config:
+            paths.append(os.path.join(os.path.expanduser("~/.condor"), user_config))
+        paths.append(os.path.expanduser("~/.config/user_config"))
+        return paths
+
+    @classmethod
+    def _sources_signature(cls):
+        # type: () -> Tuple
+        """Return a value that changes when the config sources change."""
+        files = []
+        for path in cls._config_paths():
+            try:
+                st = os.stat(path)
+                files.append((path, st.st_mtime_ns, st.st_size))
+            except OSError:
+                files.append((path, None, None))
+        env = sorted(
+            (key, value)
+            for key, value in os.environ.items()
+            if key.upper().startswith("_CONDOR_") or key == "CONDOR_CONFIG"
+        )
+        return tuple(files), tuple(env)
+
+    def table(self, refresh=False):
+        # type: (bool) -> Dict[str, Any]
+        """Return the config with lowercased names.  If `refresh` is True,
+        reload the config even if the sources don't seem to have changed.
+        The returned dict must not be modified.
+
+        """
+        now = time.monotonic()
+        table = self._table
+        if table is not None and not refresh and now - self._checked < self.CHECK_INTERVAL:
+            return table
+        with self._lock:
+            if self._table is not None and not refresh and now - self._checked < self.CHECK_INTERVAL:
+                return self._table
+            signature = self._sources_signature()
+            if refresh or self._table is None or signature != self._signature:
+                if refresh or self._table is not None:
+                    # The config was read when the bindings were imported
+                    htcondor.reload_config()
+                self._table = deep_lcasekeys(htcondor.param)
+                # Reloading may change LOCAL_CONFIG_DIR etc.
+                self._signature = self._sources_signature()
+                self.rebuilds += 1
+            self._checked = time.monotonic()
+            return self._table
+
+    def get(self, name, default=None):
+        # type: (str, Any) -> Any
+        """Return the value of the config param `name` (case-insensitive)."""
+        return self.table().get(name.lower(), default)
+
+
+param_table = ParamTable()
+
+
+def _lcase_object(pairs):
+    # type: (List[Tuple[str, Any]]) -> Dict
+    return {k.lower(): v for k, v in pairs}
+
+
+# Builds dicts with lowercased keys as it parses, so the result doesn't
+# need another pass through deep_lcasekeys().
+_lcase_decoder = json.JSONDecoder(object_pairs_hook=_lcase_object)
+
+
+def classad_to_dict_via_json(ad):
+    # type: (classad.ClassAd) -> Dict
+    """Return a copy of a classad as a dict, with all the keys lowercased,
+    recursively, by parsing printJson() output and then lowercasing the
+    keys.  This is the reference for classad_to_dict().
+
+    """
+    return deep_lcasekeys(json.loads(ad.printJson()))
+
+
+def classad_to_dict(ad):
+    # type: (classad.ClassAd) -> Dict
+    """Return a copy of a classad as a dict, with all the keys lowercased, recursively.
+
+    The keys are lowercased while the printJson() output is parsed, so
+    there is only one copy of the data made on the Python side.
+
+    """
+    return _lcase_decoder.decode(ad.printJson())
+
+
 def classads_to_dicts(classads):
     # type: (List[classad.ClassAd]) -> List[Dict]
     """Return a copy of a list of classads as a list of dicts, with all the keys lowercased, recursively."""
-    return [deep_lcasekeys(json.loads(ad.printJson())) for ad in classads]
+    return [classad_to_dict(ad) for ad in classads]
+
+
+def encode_token(data):
+    # type: (Dict) -> str
+    """Return an opaque, URL-safe string encoding `data` (e.g. a cursor)."""
+    text = json.dumps(data, separators=(",", ":"), sort_keys=True)
+    return base64.urlsafe_b64encode(text.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_token(token):
+    # type: (str) -> Dict
+    """Return the data encoded in a token by encode_token().  Raises
+    ValueError if the token is malformed.
+
+    """
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8"))
+    except (TypeError, ValueError, UnicodeError) as err:
+        six.raise_from(ValueError("Malformed token"), err)
+    if not isinstance(data, dict):
+        raise ValueError("Malformed token")
+    return data
 
 
 def str_to_list(the_str):
@@ -0,0 +1,476 @@
+"""The watch endpoint: a Server-Sent Events stream of the status changes
+of the jobs of a cluster, read from the cluster's job event log, so
+clients don't have to poll the jobs endpoint.
+
+Each event log is followed by one thread, whatever the number of clients
+watching it.  The thread keeps the last status of every job in the log
+and the last RESTD_WATCH_BUFFER_SIZE status changes, so a client that
+reconnects with the id of the last event it got (in the standard
+`Last-Event-ID` header, or the `since` argument) only gets the changes
+it missed.  A client that is too far behind, or that has no id, first
+gets the current status of every job of the cluster.  Only the last
+RESTD_WATCH_MAX_FINISHED jobs to finish (complete or be removed) are
+remembered, so following a busy EVENT_LOG doesn't grow without bound.
+
+Only the local schedd's jobs can be watched, since the event log is read
+from the restd's host.  The event log is the one named by the cluster's
+UserLog attribute, or EVENT_LOG if the jobs have none; it must be
+readable by the restd.  Since UserLog is chosen by the job's owner, it
+is only followed if it is under one of the directories in
+RESTD_WATCH_LOG_DIRS, so the restd can't be made to read other files.
+
+Each stream holds a thread (and with sync workers, a whole worker) for
+as long as it is open, so each process serves at most
+RESTD_WATCH_MAX_STREAMS of them at a time; more get a 503.
+
+"""
+from __future__ import absolute_import
+
+import collections
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+try:
+    from typing import Deque, Dict, Iterator, List, Optional, Tuple
+except ImportError:
+    pass
+
+from flask import Response, request, stream_with_context
+from flask_restful import Resource, abort, reqparse
+import six
+from werkzeug.exceptions import ServiceUnavailable
+
+try:
+    import htcondor2 as htcondor
+except ImportError:
+    import htcondor
+
+from .errors import FAIL_QUERY, NO_JOBS
+from . import jobs, utils
+
+
+logger = logging.getLogger(__name__)
+
+SSE_MIMETYPE = "text/event-stream"
+
+# The JobStatus a job has after each kind of event; other events don't
+# change the status and are not reported.
+EVENT_STATUS = {
+    "SUBMIT": 1,
+    "EXECUTE": 2,
+    "JOB_EVICTED": 1,
+    "SHADOW_EXCEPTION": 1,
+    "JOB_RECONNECT_FAILED": 1,
+    "JOB_ABORTED": 3,
+    "JOB_TERMINATED": 4,
+    "JOB_HELD": 5,
+    "JOB_RELEASED": 1,
+    "JOB_SUSPENDED": 7,
+    "JOB_UNSUSPENDED": 2,
+}
+
+# JobStatus values of jobs that have left the queue
+FINISHED_STATUSES = (3, 4)
+
+# Seconds (a whole number) the follower thread waits for new events
+# before checking whether anyone is still watching
+POLL_INTERVAL = 1
+
+# Stop following a log nobody has watched for this many seconds
+IDLE_TIMEOUT = 60
+
+# Seconds clients are told to wait before retrying when there are too
+# many streams
+RETRY_AFTER = 15
+
+# Send a comment line this often when there are no events, so proxies
+# don't close the connection
+HEARTBEAT_INTERVAL = 15.0
+
+
+def buffer_size():
+    # type: () -> int
+    return max(1, int(utils.param_float("RESTD_WATCH_BUFFER_SIZE", 1000)))
+
+
+def max_finished():
+    # type: () -> int
+    return max(1, int(utils.param_float("RESTD_WATCH_MAX_FINISHED", 10000)))
+
+
+def log_dirs():
+    # type: () -> List[str]
+    return utils.str_to_list(str(utils.param_table.get("RESTD_WATCH_LOG_DIRS", "") or ""))
+
+
+def max_streams():
+    # type: () -> int
+    return int(utils.param_float("RESTD_WATCH_MAX_STREAMS", 16))
+
+
+def max_duration():
+    # type: () -> float
+    return utils.param_float("RESTD_WATCH_TIMEOUT", 300)
+
+
+def _log_hash(path):
+    # type: (str) -> int
+    return zlib.crc32(path.encode("utf-8"))
+
+
+def _status_change(event):
+    """Return the status change of an event as a dict, or None if the
+    event doesn't change the status of its job.
+
+    """
+    name = event.type.name
+    status = EVENT_STATUS.get(name)
+    if status is None:
+        return None
+    change = dict(
+        jobid="%d.%d" % (event.cluster, event.proc),
+        event=name,
+        status=status,
+        time=event.timestamp,
+    )
+    if name == "JOB_HELD" and "HoldReason" in event:
+        change["holdreason"] = event["HoldReason"]
+    return change
+
+
+class EventLogFollower(object):
+    """Reads an event log as it grows, keeping the last status of each
+    job and a buffer of recent status changes, and wakes up the
+    subscribers when there are new ones.  Changes are numbered by their
+    position in the log, so the numbers stay the same across restarts.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._cond = threading.Condition()
+        self._log = None
+        self._thread = None  # type: Optional[threading.Thread]
+        # Number of events read from the log
+        self._count = 0
+        # (event number, cluster, change)
+        self._changes = collections.deque(maxlen=buffer_size())  # type: Deque[Tuple[int, int, Dict]]
+        # (cluster, proc) -> (event number, change), of the jobs in the
+        # queue, and of the most recently finished jobs, oldest first
+        self._states = {}  # type: Dict[Tuple[int, int], Tuple[int, Dict]]
+        self._finished = collections.OrderedDict()  # type: collections.OrderedDict
+        self._subscribers = 0
+        self._last_used = time.monotonic()
+        self.error = None  # type: Optional[Exception]
+
+    def _read(self, stop_after):
+        added = False
+        for event in self._log.events(stop_after=stop_after):
+            self._count += 1
+            change = _status_change(event)
+            if change is None:
+                continue
+            key = (event.cluster, event.proc)
+            with self._cond:
+                self._changes.append((self._count, event.cluster, change))
+                if change["status"] in FINISHED_STATUSES:
+                    self._states.pop(key, None)
+                    self._finished.pop(key, None)
+                    self._finished[key] = (self._count, change)
+                    limit = max_finished()
+                    while len(self._finished) > limit:
+                        self._finished.popitem(last=False)
+                else:
+                    self._finished.pop(key, None)
+                    self._states[key] = (self._count, change)
+            added = True
+        if added:
+            with self._cond:
+                self._cond.notify_all()
+
+    def start(self):
+        """Open the log and read what is already in it, then start the
+        thread that follows it.  Errors opening or reading the log are
+        passed through.
+
+        """
+        self._log = htcondor.JobEventLog(self.path)
+        self._read(0)
+        self._thread = threading.Thread(target=self._run, name="watch-%s" % os.path.basename(self.path))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def touch(self):
+        """Note that the follower is being used, so it doesn't stop before
+        its new subscriber subscribes.
+
+        """
+        with self._cond:
+            self._last_used = time.monotonic()
+
+    def _run(self):
+        try:
+            while True:
+                self._read(POLL_INTERVAL)
+                # Stop and leave the map at once, so get_follower() can't
+                # return a follower that is stopping
+                with _followers_lock, self._cond:
+                    if (
+                        self._subscribers == 0
+                        and time.monotonic() - self._last_used > IDLE_TIMEOUT
+                    ):
+                        if _followers.get(self.path) is self:
+                            del _followers[self.path]
+                        break
+        except Exception as err:
+            logger.warning("Failed to read event log %s: %s", self.path, err)
+            self.error = err
+        finally:
+            with _followers_lock:
+                if _followers.get(self.path) is self:
+                    del _followers[self.path]
+            with self._cond:
+                self._cond.notify_all()
+            self._log.close()
+
+    def token(self, number):
+        # type: (int) -> str
+        return utils.encode_token(dict(h=_log_hash(self.path), n=number))
+
+    def position(self, token):
+        # type: (Optional[str]) -> Optional[int]
+        """Return the event number a resume token is for, or None if it
+        isn't a token for this log.
+
+        """
+        if not token:
+            return None
+        try:
+            data = utils.decode_token(token)
+            if data.get("h") != _log_hash(self.path):
+                return None
+            return int(data["n"])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def subscribe(self, cluster, after, duration):
+        # type: (int, Optional[int], float) -> Iterator[Tuple[Optional[int], Optional[Dict]]]
+        """Yield (event number, change) for the status changes of the jobs
+        of `cluster` after event number `after`, as they happen, for
+        `duration` seconds.  If the changes since `after` are no longer
+        buffered (or `after` is None), first yield the current status of
+        each job.  (None, None) is yielded when there has been nothing to
+        send for a while.
+
+        """
+        deadline = time.monotonic() + duration
+        with self._cond:
+            self._subscribers += 1
+        try:
+            with self._cond:
+                oldest = self._changes[0][0] if self._changes else self._count + 1
+                if after is None or after > self._count or after < oldest - 1:
+                    states = sorted(
+                        (number, change)
+                        for (job_cluster, _), (number, change) in itertools.chain(
+                            self._states.items(), self._finished.items()
+                        )
+                        if job_cluster == cluster
+                    )
+                    after = self._count
+                else:
+                    states = []
+            for number, change in states:
+                yield number, change
+            while True:
+                with self._cond:
+                    pending = [
+                        (number, change)
+                        for number, job_cluster, change in self._changes
+                        if number > after and job_cluster == cluster
+                    ]
+                    if not pending:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0 or self.error is not None:
+                            return
+                        self._cond.wait(min(remaining, HEARTBEAT_INTERVAL))
+                        pending = [
+                            (number, change)
+                            for number, job_cluster, change in self._changes
+                            if number > after and job_cluster == cluster
+                        ]
+                    after = max(after, self._count)
+                for number, change in pending:
+                    yield number, change
+                if not pending and time.monotonic() < deadline:
+                    yield None, None
+        finally:
+            with self._cond:
+                self._subscribers -= 1
+                self._last_used = time.monotonic()
+
+
+_followers = {}  # type: Dict[str, EventLogFollower]
+_followers_lock = threading.Lock()
+
+
+def get_follower(path):
+    # type: (str) -> EventLogFollower
+    """Return the follower of the event log at `path`, starting it if
+    necessary.  Errors opening the log are passed through.
+
+    """
+    with _followers_lock:
+        follower = _followers.get(path)
+        if follower is not None and follower.error is None:
+            follower.touch()
+            return follower
+        follower = _followers[path] = EventLogFollower(path)
+    try:
+        follower.start()
+    except Exception:
+        with _followers_lock:
+            if _followers.get(path) is follower:
+                del _followers[path]
+        raise
+    return follower
+
+
+def _allowed_path(path):
+    # type: (str) -> Optional[str]
+    """Return the real path of the event log at `path` if the restd may
+    follow it: EVENT_LOG, or a file under one of RESTD_WATCH_LOG_DIRS.
+    Otherwise return None.
+
+    """
+    real = os.path.realpath(path)
+    if not os.path.isfile(real):
+        return None
+    event_log = utils.param_table.get("EVENT_LOG")
+    if event_log and real == os.path.realpath(str(event_log)):
+        return real
+    for directory in log_dirs():
+        prefix = os.path.join(os.path.realpath(directory), "")
+        if real.startswith(prefix):
+            return real
+    return None
+
+
+def _event_log_path(schedd, clusterid):
+    # type: (Optional[str], int) -> Optional[str]
+    """Return the path of the event log of the jobs of a cluster of the
+    local schedd, from a job's UserLog (relative to its Iwd), or
+    EVENT_LOG, or None if it has none the restd may follow (see
+    _allowed_path()).  Aborts with a 404 if the cluster has no jobs.
+
+    """
+    ads = jobs._query_common(
+        "query",
+        schedd,
+        "clusterid==%d" % clusterid,
+        "userlog,iwd",
+        limit=1,
+        clusterid=clusterid,
+    ) or jobs._query_common(
+        "history",
+        schedd,
+        "clusterid==%d" % clusterid,
+        "userlog,iwd",
+        limit=1,
+        clusterid=clusterid,
+    )
+    if not ads:
+        abort(404, message=NO_JOBS)
+    user_log = ads[0].get("userlog")
+    if isinstance(user_log, six.string_types) and user_log:
+        path = os.path.join(str(ads[0].get("iwd") or ""), user_log)
+    else:
+        path = str(utils.param_table.get("EVENT_LOG") or "")
+    return _allowed_path(path) if path else None
+
+
+def _sse_pieces(follower, events):
+    # type: (EventLogFollower, Iterator[Tuple[Optional[int], Optional[Dict]]]) -> Iterator[str]
+    yield "retry: 1000\n\n"
+    for number, change in events:
+        if change is None:
+            yield ": keepalive\n\n"
+        else:
+            yield "id: %s\nevent: status\ndata: %s\n\n" % (
+                follower.token(number),
+                json.dumps(change),
+            )
+
+
+_streams = 0
+_streams_lock = threading.Lock()
+
+
+def _open_stream():
+    """Count a new stream, aborting with a 503 if there are already
+    RESTD_WATCH_MAX_STREAMS.
+
+    """
+    global _streams
+    with _streams_lock:
+        if _streams >= max_streams():
+            exc = ServiceUnavailable(retry_after=RETRY_AFTER)
+            exc.data = {"message": "Too many watch streams"}
+            raise exc
+        _streams += 1
+
+
+def _close_stream():
+    global _streams
+    with _streams_lock:
+        _streams -= 1
+
+
+class V1JobsWatchResource(Resource):
+    """Endpoint for following the status of the jobs of a cluster;
+    implements the /v1/jobs/<schedd>/<clusterid>/watch endpoint.
+
+    """
+
+    def get(self, schedd, clusterid):
+        parser = reqparse.RequestParser(trim=True)
+        parser.add_argument("since", location="args")
+        parser.add_argument("timeout", location="args", type=float)
+        args = parser.parse_args()
+        try:
+            schedd = six.ensure_str(schedd, errors="replace")
+        except UnicodeError as err:
+            abort(400, message=str(err))
+            return  # quiet warning
+        if schedd == "DEFAULT":
+            schedd = None
+        if not utils.is_local_schedd(schedd):
+            abort(404, message="Only the jobs of the local schedd can be watched")
+
+        path = _event_log_path(schedd, clusterid)
+        if not path:
+            abort(404, message="The jobs of cluster %d have no event log" % clusterid)
+        try:
+            follower = get_follower(path)
+        except Exception as err:
+            abort(503, message=FAIL_QUERY % {"service": "event log", "err": err})
+            raise  # quiet warning
+
+        duration = max_duration()
+        if args.timeout is not None and args.timeout > 0:
+            duration = min(duration, args.timeout) if duration > 0 else args.timeout
+        after = follower.position(args.since or request.headers.get("Last-Event-ID"))
+        _open_stream()
+        events = follower.subscribe(clusterid, after, duration)
+        resp = Response(
+            stream_with_context(_sse_pieces(follower, events)),
+            mimetype=SSE_MIMETYPE,
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+        resp.call_on_close(_close_stream)
+        return resp
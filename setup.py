@@ -19,4 +19,9 @@ setup(
         "flask-restful==0.3.10",
         "htcondor>=10.0.0",
     ],
+    extras_require={
+        "compression": ["zstandard", "brotli"],
+        "msgpack": ["msgpack"],
+        "arrow": ["pyarrow"],
+    },
 )
@@ -0,0 +1,113 @@
+import threading
+import time
+
+import pytest
+from werkzeug.exceptions import ServiceUnavailable
+
+from condor_restd import admission
+
+
+def test_limiter_admits_cheap_queries_first():
+    limiter = admission.UpstreamLimiter("schedd:test")
+    limiter.acquire(admission.CHEAP, 1, 2, 5)
+    admitted = []
+
+    def wait(name, priority):
+        limiter.acquire(priority, 1, 2, 5)
+        admitted.append(name)
+        limiter.release()
+
+    threads = [
+        threading.Thread(target=wait, args=("dump", admission.EXPENSIVE)),
+        threading.Thread(target=wait, args=("cheap", admission.CHEAP)),
+    ]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.1)
+    # The queue is full
+    with pytest.raises(ServiceUnavailable) as excinfo:
+        limiter.acquire(admission.CHEAP, 1, 2, 5)
+    assert excinfo.value.retry_after == admission.RETRY_AFTER
+
+    limiter.release()
+    for thread in threads:
+        thread.join()
+    assert admitted == ["cheap", "dump"]
+    assert limiter.active == 0
+
+
+def test_limiter_times_out():
+    limiter = admission.UpstreamLimiter("schedd:test")
+    limiter.acquire(admission.CHEAP, 1, 2, 5)
+    with pytest.raises(ServiceUnavailable):
+        limiter.acquire(admission.CHEAP, 1, 2, 0.1)
+    limiter.release()
+    limiter.acquire(admission.CHEAP, 1, 2, 0.1)
+
+
+def test_token_buckets():
+    buckets = admission.TokenBuckets()
+    assert buckets.take("a", 1, 2) == 0
+    assert buckets.take("a", 1, 2) == 0
+    assert 0 < buckets.take("a", 1, 2) <= 1
+    assert buckets.take("b", 1, 2) == 0
+
+
+@pytest.fixture
+def rate_limited_client(monkeypatch):
+    """A test client of the app with a rate limit of 1 request per second."""
+    from condor_restd import app, utils
+
+    config = {"RESTD_RATE_LIMIT": "1", "RESTD_RATE_LIMIT_BURST": "1"}
+    table_get = utils.param_table.get
+    monkeypatch.setattr(
+        utils.param_table, "get", lambda name, default=None: config.get(name, table_get(name, default))
+    )
+    monkeypatch.setattr(admission, "rate_limits", admission.TokenBuckets())
+    return app.test_client()
+
+
+def test_batch_is_rate_limited_per_client(rate_limited_client):
+    client = rate_limited_client
+    # Invalid constraints, so the sub-requests don't query a schedd
+    batch = [{"path": "/v1/history/DEFAULT?constraint=("}, {"path": "/v1/jobs/DEFAULT?constraint=("}]
+
+    def post(addr):
+        return client.post("/v1/batch", json=batch, environ_base={"REMOTE_ADDR": addr})
+
+    resp = post("10.0.0.1")
+    assert resp.status_code == 200
+    assert [item["status"] for item in resp.get_json().values()] == [400, 400]
+    assert post("10.0.0.1").status_code == 429
+    # Another client's sub-requests are not charged to the first client
+    resp = post("10.0.0.2")
+    assert resp.status_code == 200
+    assert [item["status"] for item in resp.get_json().values()] == [400, 400]
+
+
+def test_config_refresh_is_rate_limited(rate_limited_client):
+    client = rate_limited_client
+    for _ in range(3):
+        assert client.get("/v1/config/FULL_HOSTNAME").status_code != 429
+    assert client.get("/v1/config/FULL_HOSTNAME?refresh=true").status_code != 429
+    assert client.get("/v1/config/FULL_HOSTNAME?refresh=true").status_code == 429
+
+
+def test_stream_releases_slot_before_sending(monkeypatch):
+    from condor_restd import app, jobs, jobqueue, utils
+
+    classad = pytest.importorskip("classad2")
+
+    class FakeSchedd(object):
+        def query(self, constraint, projection, limit):
+            return [classad.ClassAd({"ClusterId": 1, "ProcId": proc}) for proc in range(3)]
+
+    monkeypatch.setattr(jobqueue, "get_replica", lambda schedd_name: None)
+    monkeypatch.setattr(utils, "get_schedd", lambda schedd_name=None: FakeSchedd())
+    limiter = admission._limiter("schedd:DEFAULT")
+    with app.test_request_context("/v1/jobs/DEFAULT?stream=true"):
+        ads = jobs._iter_query_common("query", None, "true", "")
+        assert next(ads)["procid"] == 0
+        # The client hasn't read the rest, but the schedd is free
+        assert limiter.active == 0
+        assert [ad["procid"] for ad in ads] == [1, 2]
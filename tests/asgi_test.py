@@ -0,0 +1,58 @@
+import asyncio
+import threading
+
+from condor_restd import asgi
+
+
+def request(app, path):
+    """Return a coroutine sending a GET of `path` to the ASGI `app` and
+    returning the response status.
+
+    """
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    async def run():
+        scope = {"type": "http", "method": "GET", "path": path, "headers": []}
+        await app(scope, receive, send)
+        return messages[0]["status"]
+
+    return run()
+
+
+def test_blocked_pool_does_not_stall_others():
+    schedd_answers = threading.Event()
+
+    def wsgi_app(environ, start_response):
+        if environ["PATH_INFO"].startswith("/v1/jobs/"):
+            schedd_answers.wait(10)
+        start_response("200 OK", [("Content-Length", "0")])
+        return [b""]
+
+    app = asgi.WSGIToASGI(wsgi_app, upstream_threads=1, local_threads=1, collector_threads=1)
+    assert app.pool_for("/v1/status") is app.collector_pool
+    assert app.pool_for("/v1/grouped_status/Machine") is app.collector_pool
+    assert app.pool_for("/v1/config") is app.local_pool
+    assert app.pool_for("/v1/jobs/DEFAULT/12/watch") is app.watch_pool
+
+    async def main():
+        blocked = asyncio.ensure_future(request(app, "/v1/jobs/DEFAULT"))
+        await asyncio.sleep(0.1)
+        # The upstream pool's only thread is busy; the other pools aren't
+        statuses = await asyncio.wait_for(
+            asyncio.gather(request(app, "/v1/status"), request(app, "/v1/config")), 5
+        )
+        assert not blocked.done()
+        schedd_answers.set()
+        return statuses, await asyncio.wait_for(blocked, 5)
+
+    try:
+        assert asyncio.run(main()) == ([200, 200], 200)
+    finally:
+        schedd_answers.set()
+        app.shutdown()
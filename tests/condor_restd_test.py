@@ -197,3 +197,17 @@ def test_config(fixtures):
             checked_get("v1/config/full_hostname%s" % arg).content.strip().decode()
             == '"%s"' % socket.getfqdn()
         )
+
+
+def _test_jobs_stream(cluster_id, endpoint):
+    uri = "v1/%s/DEFAULT/%d" % (endpoint, cluster_id)
+    j = checked_get_json(uri)
+    js = checked_get_json(uri, params={"stream": "true"})
+    assert j == js, "%s: streamed result does not match" % endpoint
+
+
+def test_jobs_stream(fixtures):
+    cluster_id = submit_sleep_job()
+    _test_jobs_stream(cluster_id, "jobs")
+    rm_cluster(cluster_id)
+    _test_jobs_stream(cluster_id, "history")
@@ -0,0 +1,54 @@
+from condor_restd import delta
+
+
+def job(cluster, proc, status=1):
+    return {"clusterid": cluster, "procid": proc, "jobstatus": status}
+
+
+def test_tracker():
+    tracker = delta.DeltaTracker()
+    jobs, removed, version, full = tracker.update([job(1, 0), job(1, 1)], None)
+    assert (len(jobs), removed, full) == (2, [], True)
+
+    # Nothing changed
+    assert tracker.update([job(1, 0), job(1, 1)], version) == ([], [], version, False)
+
+    jobs, removed, new_version, full = tracker.update([job(1, 0, 2), job(2, 0)], version)
+    assert jobs == [job(1, 0, 2), job(2, 0)]
+    assert (removed, full) == ([(1, 1)], False)
+    assert new_version > version
+
+    # An unknown version gets everything
+    assert tracker.update([job(1, 0, 2), job(2, 0)], new_version + 1)[3] is True
+
+
+def test_tracker_forgets_removals(monkeypatch):
+    monkeypatch.setattr(delta, "max_removed", lambda: 1)
+    tracker = delta.DeltaTracker()
+    version = tracker.update([job(1, 0), job(1, 1), job(1, 2)], None)[2]
+    tracker.update([job(1, 0), job(1, 1)], version)
+    later = tracker.update([job(1, 0)], version)
+    # The removal of 1.2 has been forgotten, so the delta would be wrong
+    assert later[3] is True
+    assert tracker.update([job(1, 0)], later[2])[:2] == ([], [])
+
+
+def test_tracker_job_returns():
+    tracker = delta.DeltaTracker()
+    version = tracker.update([job(1, 0), job(1, 1)], None)[2]
+    tracker.update([job(1, 0)], version)
+    tracker.update([job(1, 0), job(1, 1, 5)], version)
+    tracker.update([job(1, 0)], version)
+    jobs, removed, _, full = tracker.update([job(1, 0), job(1, 1, 2)], version)
+    assert (jobs, removed, full) == ([job(1, 1, 2)], [], False)
+    assert tracker.update([job(1, 0)], version)[:2] == ([], [(1, 1)])
+
+
+def test_tracker_ignores_volatile_attrs():
+    tracker = delta.DeltaTracker()
+    ad = dict(job(1, 0), servertime=100, lastjobleaserenewal=90)
+    version = tracker.update([ad], None)[2]
+    ad = dict(job(1, 0), servertime=160, lastjobleaserenewal=150)
+    assert tracker.update([ad], version) == ([], [], version, False)
+    ad = dict(job(1, 0, 2), servertime=220, lastjobleaserenewal=210)
+    assert tracker.update([ad], version)[0] == [ad]
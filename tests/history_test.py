@@ -0,0 +1,135 @@
+import os
+
+from condor_restd import history
+
+
+def record(cluster, proc, owner="alice"):
+    return (
+        'Owner = "%s"\nClusterId = %d\nProcId = %d\nCmd = "/bin/sleep"\n'
+        "RemoteWallClockTime = 10.0\n"
+        '*** ProcId = %d ClusterId = %d Owner = "%s" CompletionDate = 1700000000\n'
+        % (owner, cluster, proc, proc, cluster, owner)
+    )
+
+
+def write(path, text, mode="w"):
+    with open(path, mode) as f:
+        f.write(text)
+
+
+def test_history_index(tmp_path):
+    path = str(tmp_path / "history")
+    index_dir = str(tmp_path / "index")
+    os.mkdir(index_dir)
+    write(path, record(1, 0) + record(1, 1) + record(2, 0, "bob") + record(1, 2))
+
+    index = history.HistoryIndex(path, index_dir)
+    index.refresh()
+    jobs = index.query(1, None, "true")
+    assert [job["procid"] for job in jobs] == [2, 1, 0]
+    assert index.query(2, 0, "true", ["owner"]) == [{"owner": "bob"}]
+    assert index.query(1, 1, "Owner == \"bob\"") == []
+    assert index.query(3, None, "true") == []
+    assert len(index.query(1, None, "true", limit=2)) == 2
+
+    # Records are indexed as they are added, and the index is saved
+    write(path, record(3, 0), "a")
+    index.refresh()
+    assert [job["clusterid"] for job in index.query(3, None, "true")] == [3]
+    saved = history.HistoryIndex(path, index_dir)
+    saved.refresh()
+    assert len(saved.query(1, None, "true")) == 3
+
+
+def test_history_index_rotation(tmp_path):
+    path = str(tmp_path / "history")
+    index_dir = str(tmp_path / "index")
+    os.mkdir(index_dir)
+    write(path, record(1, 0))
+    index = history.HistoryIndex(path, index_dir)
+    index.refresh()
+
+    os.rename(path, path + ".20240101T000000")
+    write(path, record(1, 1) + record(2, 0))
+    index.refresh()
+    assert [job["procid"] for job in index.query(1, None, "true")] == [1, 0]
+
+
+def test_history_scan(tmp_path, monkeypatch):
+    path = str(tmp_path / "history")
+    index_dir = str(tmp_path / "index")
+    os.mkdir(index_dir)
+    write(path + ".20240101T000000", record(1, 0) + record(2, 0))
+    write(path, record(3, 0) + record(3, 1, "bob") + record(4, 0))
+    index = history.HistoryIndex(path, index_dir)
+    index.refresh()
+
+    jobs, position = index.scan("true", ["clusterid", "procid"])
+    assert [(j["clusterid"], j["procid"]) for j in jobs] == [(4, 0), (3, 1), (3, 0), (2, 0), (1, 0)]
+    assert position is None
+    jobs, _ = index.scan('Owner == "alice"', ["clusterid"], since="ClusterId == 2")
+    assert [j["clusterid"] for j in jobs] == [4, 3]
+
+    # The scan stops when the budget runs out, and can be resumed
+    monkeypatch.setattr(history, "scan_limit", lambda: 2)
+    seen = []
+    position = None
+    while True:
+        jobs, position = index.scan("true", ["clusterid"], resume=position)
+        seen.extend(j["clusterid"] for j in jobs)
+        if position is None:
+            break
+    assert seen == [4, 3, 3, 2, 1]
+
+    # The same, from the saved indexes
+    saved = history.HistoryIndex(path, index_dir)
+    saved.refresh()
+    seen = []
+    while True:
+        jobs, position = saved.scan("true", ["clusterid"], resume=position)
+        seen.extend(j["clusterid"] for j in jobs)
+        if position is None:
+            break
+    assert seen == [4, 3, 3, 2, 1]
+
+
+def test_history_pages(tmp_path, monkeypatch):
+    from condor_restd import app, jobs, utils
+
+    path = str(tmp_path / "history")
+    index_dir = str(tmp_path / "index")
+    os.mkdir(index_dir)
+    write(path + ".20240101T000000", record(1, 0) + record(2, 0))
+    write(path, record(3, 0) + record(3, 1, "bob") + record(4, 0))
+    config = {"HISTORY": path, "RESTD_HISTORY_INDEX_DIR": index_dir}
+    table_get = utils.param_table.get
+    monkeypatch.setattr(
+        utils.param_table, "get", lambda name, default=None: config.get(name, table_get(name, default))
+    )
+    # Unbounded scans are left to the schedd
+    with app.test_request_context("/"):
+        assert jobs._local_query("history", None, None, None, partial_ok=True) is None
+        assert jobs._local_query("history", None, None, None, "ClusterId == 2", partial_ok=True)
+    config["RESTD_HISTORY_SCAN_LIMIT"] = "1000"
+    scanned = []
+    scan = history.HistoryIndex.scan
+
+    def counting_scan(self, *args, **kwargs):
+        results, position = scan(self, *args, **kwargs)
+        scanned.append(len(results))
+        return results, position
+
+    monkeypatch.setattr(history.HistoryIndex, "scan", counting_scan)
+    client = app.test_client()
+
+    seen = []
+    url = "/v1/history/DEFAULT?page_size=2&projection=owner"
+    while url:
+        resp = client.get(url)
+        assert resp.status_code == 200
+        seen.extend(job["jobid"] for job in resp.get_json())
+        link = resp.headers.get("Link")
+        url = link[link.index("/v1/") : link.index(">")] if link else None
+    assert seen == ["4.0", "3.1", "3.0", "2.0", "1.0"]
+    # Each page continues where the last one stopped
+    assert scanned == [2, 2, 1]
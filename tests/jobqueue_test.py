@@ -0,0 +1,120 @@
+import os
+
+from condor_restd import jobqueue
+
+
+LOG = """\
+107 1 CreationTimestamp 1700000000
+101 0.0 Job Machine
+103 0.0 NextClusterNum 3
+105
+101 01.-1 Job Machine
+103 01.-1 Owner "alice"
+103 01.-1 Cmd "/bin/sleep"
+101 1.0 Job Machine
+103 1.0 JobStatus 1
+103 1.0 Args "60 seconds"
+101 1.1 Job Machine
+103 1.1 JobStatus 2
+103 1.1 Requirements TARGET.Memory > 1024 && TARGET.Arch == "X86_64"
+106
+"""
+
+
+def write(path, text, mode="w"):
+    with open(path, mode) as f:
+        f.write(text)
+
+
+def test_replica_reads_log(tmp_path):
+    path = str(tmp_path / "job_queue.log")
+    write(path, LOG)
+    replica = jobqueue.JobQueueReplica(path)
+    replica.refresh()
+    assert replica.age() is not None
+
+    jobs = replica.query("true")
+    assert [(j["clusterid"], j["procid"]) for j in jobs] == [(1, 0), (1, 1)]
+    assert jobs[0]["owner"] == "alice"
+    assert jobs[0]["args"] == "60 seconds"
+    assert jobs[1]["requirements"] == (
+        '/Expr(TARGET.Memory > 1024 && TARGET.Arch == "X86_64")/'
+    )
+    assert replica.query("JobStatus == 2", ["procid", "owner"]) == [
+        {"procid": 1, "owner": "alice"}
+    ]
+    assert len(replica.query("true", limit=1)) == 1
+
+
+def test_replica_follows_log(tmp_path):
+    path = str(tmp_path / "job_queue.log")
+    write(path, LOG)
+    replica = jobqueue.JobQueueReplica(path)
+    replica.refresh()
+    replica.query("true")
+
+    # An unfinished transaction is not applied
+    write(path, "105\n103 01.-1 Owner \"bob\"\n102 1.0\n", "a")
+    replica.refresh()
+    assert replica.age() is not None
+    assert [j["owner"] for j in replica.query("true")] == ["alice", "alice"]
+
+    write(path, "106\n", "a")
+    replica.refresh()
+    assert [(j["procid"], j["owner"]) for j in replica.query("true")] == [(1, "bob")]
+
+
+def test_replica_keeps_built_ads(tmp_path):
+    path = str(tmp_path / "job_queue.log")
+    write(path, LOG)
+    replica = jobqueue.JobQueueReplica(path)
+    replica.refresh()
+    replica.query("true")
+    assert sorted(replica._built) == [(1, 0), (1, 1)]
+
+    # An ad built while its job changes isn't kept
+    replica.apply(["103", "1.0", "JobStatus 2"])
+    snapshot = replica._snapshot
+
+    def changing_snapshot():
+        taken = snapshot()
+        replica.apply(["103", "1.0", "JobStatus 3"])
+        return taken
+
+    replica._snapshot = changing_snapshot
+    assert [j["jobstatus"] for j in replica.query("true")] == [2, 2]
+    assert sorted(replica._built) == [(1, 1)]
+    del replica._snapshot
+    assert [j["jobstatus"] for j in replica.query("true")] == [3, 2]
+
+
+def test_replica_rereads_rotated_log(tmp_path):
+    path = str(tmp_path / "job_queue.log")
+    write(path, LOG)
+    replica = jobqueue.JobQueueReplica(path)
+    replica.refresh()
+
+    # The schedd compacts the log by writing a new file and renaming it
+    write(path + ".tmp", "101 02.-1 Job Machine\n101 2.0 Job Machine\n")
+    os.rename(path + ".tmp", path)
+    replica.refresh()
+    assert [(j["clusterid"], j["procid"]) for j in replica.query("true")] == [(2, 0)]
+
+
+def test_replica_hides_private_attrs(tmp_path):
+    path = str(tmp_path / "job_queue.log")
+    write(
+        path,
+        LOG
+        + '103 1.1 ClaimId "<10.0.0.1:9618>#1700000000#1#secret"\n'
+        + '103 01.-1 TransferKey "secret"\n'
+        + '103 1.0 _condor_priv_token "secret"\n',
+    )
+    replica = jobqueue.JobQueueReplica(path)
+    replica.refresh()
+
+    jobs = replica.query("true")
+    assert "secret" not in repr(jobs)
+    assert not {"claimid", "transferkey", "_condor_priv_token"} & (set(jobs[0]) | set(jobs[1]))
+    assert replica.query("ClaimId isnt undefined") == []
+    assert (jobs[0]["mytype"], jobs[0]["targettype"]) == ("Job", "Machine")
@@ -0,0 +1,108 @@
+import os
+import threading
+import time
+
+from flask import Flask, Response, request
+import pytest
+
+from condor_restd import resultcache, utils
+
+
+def test_store_and_read(tmp_path):
+    directory = str(tmp_path)
+    header = {"status": 200, "time": 1000.0, "headers": {"Content-Type": "application/json"}}
+    resultcache._write(directory, "key", header, b"[1, 2]\n")
+    assert resultcache._read(directory, "key", 1e12) == (header, b"[1, 2]\n")
+    # Too old
+    assert resultcache._read(directory, "key", 10) is None
+    assert resultcache._read(directory, "other", 1e12) is None
+    assert [name for name in os.listdir(directory) if name.startswith(".")] == []
+
+
+def test_lock_is_exclusive(tmp_path):
+    directory = str(tmp_path)
+    fd = resultcache._lock(directory, "abcdef12")
+    assert fd is not None
+    assert resultcache._lock(directory, "abcdef12") is None
+    # Other keys are not blocked
+    other = resultcache._lock(directory, "abcdef13")
+    assert other is not None
+    resultcache._release(directory, "abcdef13", other)
+    resultcache._release(directory, "abcdef12", fd)
+    assert os.listdir(directory) == []
+    fd = resultcache._lock(directory, "abcdef12")
+    assert fd is not None
+    resultcache._release(directory, "abcdef12", fd)
+
+
+@pytest.fixture
+def cached_app(tmp_path, monkeypatch):
+    """An app with the cache enabled for `status` only, whose handlers
+    count the requests they get in `app.calls`.
+
+    """
+    config = {"RESTD_RESULT_CACHE_DIR": str(tmp_path), "RESTD_RESULT_CACHE_TTL_STATUS": "60"}
+    monkeypatch.setattr(
+        utils.param_table, "get", lambda name, default=None: config.get(name, default)
+    )
+    app = Flask(__name__)
+    app.calls = []
+    resultcache.install(app)
+
+    @app.route("/v1/status")
+    @app.route("/v1/config")
+    def handler():
+        app.calls.append(1)
+        time.sleep(0.2)
+        if request.args.get("fail"):
+            return Response('{"message": "Failed"}\n', status=503, mimetype="application/json")
+        return Response("[]\n", mimetype="application/json")
+
+    return app
+
+
+def concurrent_gets(app, path, count):
+    statuses = []
+
+    def get():
+        resp = app.test_client().get(path)
+        statuses.append((resp.status_code, resp.headers["X-Cache"]))
+
+    threads = [threading.Thread(target=get) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(statuses)
+
+
+def test_concurrent_requests_coalesce(cached_app, tmp_path):
+    assert concurrent_gets(cached_app, "/v1/status", 5) == [(200, "HIT")] * 4 + [(200, "MISS")]
+    assert len(cached_app.calls) == 1
+    # The lock file is gone once the response is stored
+    assert [name for name in os.listdir(str(tmp_path)) if name.startswith("lock-")] == []
+
+
+def test_waiters_get_error(cached_app):
+    statuses = concurrent_gets(cached_app, "/v1/status?fail=1", 5)
+    assert statuses == [(503, "HIT")] * 4 + [(503, "MISS")]
+    assert len(cached_app.calls) == 1
+    # Errors are only kept briefly
+    time.sleep(resultcache.ERROR_TTL)
+    assert cached_app.test_client().get("/v1/status?fail=1").headers["X-Cache"] == "MISS"
+    assert len(cached_app.calls) == 2
+
+
+def test_route_ttl(cached_app):
+    client = cached_app.test_client()
+    for _ in range(2):
+        assert client.get("/v1/status").status_code == 200
+    assert len(cached_app.calls) == 1
+    # No TTL for config
+    for _ in range(2):
+        assert "X-Cache" not in client.get("/v1/config").headers
+    assert len(cached_app.calls) == 3
+    # Refreshes always get a new response
+    for _ in range(2):
+        assert "X-Cache" not in client.get("/v1/status?refresh=true").headers
+    assert len(cached_app.calls) == 5
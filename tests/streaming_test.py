@@ -0,0 +1,40 @@
+import json
+
+import pytest
+
+from condor_restd import app, streaming
+
+
+def _failing_items():
+    yield {"a": 1}
+    yield {"a": 2}
+    raise RuntimeError("schedd went away")
+
+
+def _body(ndjson, envelope=None):
+    with app.test_request_context("/"):
+        resp = streaming.stream_response(_failing_items(), ndjson=ndjson, envelope=envelope)
+        return resp.get_data(as_text=True)
+
+
+@pytest.mark.parametrize("envelope", [None, ("jobs", lambda: {"complete": True})])
+def test_truncated_json_does_not_parse(envelope):
+    body = _body(False, envelope)
+    assert '{"a": 2}' in body
+    with pytest.raises(ValueError):
+        json.loads(body)
+
+
+@pytest.mark.parametrize("envelope", [None, ("jobs", lambda: {"complete": True})])
+def test_truncated_ndjson_ends_with_error(envelope):
+    lines = [json.loads(line) for line in _body(True, envelope).splitlines()]
+    assert lines[:2] == [{"a": 1}, {"a": 2}]
+    assert lines[2:] == [{"error": "Output truncated: schedd went away"}]
+
+
+def test_complete_output():
+    with app.test_request_context("/"):
+        resp = streaming.stream_response(
+            iter([{"a": 1}]), ndjson=False, envelope=("jobs", lambda: {"complete": True})
+        )
+        assert json.loads(resp.get_data(as_text=True)) == {"jobs": [{"a": 1}], "complete": True}
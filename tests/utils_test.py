@@ -0,0 +1,71 @@
+import json
+import random
+
+try:
+    import classad2 as classad
+except ImportError:
+    import classad
+
+from condor_restd import utils
+
+
+AD_TEXTS = [
+    "[]",
+    '[ClusterId = 1; ProcId = 0; Owner = "matyas"; Cmd = "/usr/bin/sleep"]',
+    "[A = 1; B = A + 1; C = undefined; D = error; E = true; F = false]",
+    "[Real1 = 0.1; Real2 = 1.0 / 3; Real3 = 1e300; Real4 = -0.0; Real5 = 3.0; Real6 = 1e-7]",
+    '[L = {1, 2, "x", A + 1, [x = 1], undefined, error, {}}; M = {}; N = []]',
+    '[Nested = [x = 1; y = x + 1; z = [deeper = "yes"; Expr = MY.x]]]',
+    '[Str = "a/b\\tc \\"quoted\\" \\\\ backslash"; Empty = ""]',
+    '[T1 = absTime("2020-01-01T00:00:00"); T2 = relTime("1:00")]',
+    '[TL = {absTime("2020-01-01T00:00:00+05:00")}; TN = [t = absTime("2021-01-01T00:00:00")]]',
+    '[MixedCase = 1; mIxEdCaSe2 = 2; lower = 3; UPPER = 4]',
+    '[Requirements = (TARGET.Arch == "X86_64") && (TARGET.OpSys == "LINUX") && (TARGET.Disk >= RequestDisk)]',
+    '[Nan = real("NaN"); Inf = real("INF")]',
+]
+
+
+def check_same(ad):
+    expected = json.dumps(utils.classad_to_dict_via_json(ad))
+    got = json.dumps(utils.classad_to_dict(ad))
+    assert got == expected, "mismatch for %s" % ad
+
+
+def test_classad_to_dict_matches_printjson():
+    for text in AD_TEXTS:
+        check_same(classad.ClassAd(text))
+
+
+def test_classad_to_dict_reals():
+    rng = random.Random(1)
+    for _ in range(2000):
+        value = rng.random() * 10 ** rng.randint(-20, 20) * rng.choice([1, -1])
+        check_same(classad.ClassAd({"x": value}))
+
+
+def test_classads_to_dicts():
+    ads = [classad.ClassAd(text) for text in AD_TEXTS]
+    assert utils.classads_to_dicts(ads) == [
+        utils.classad_to_dict_via_json(ad) for ad in ads
+    ]
+
+
+def test_normalize_expr():
+    assert utils.normalize_expr(' Owner  ==\t"a  b"\n&&  x ') == 'Owner == "a  b" && x'
+    assert utils.normalize_expr('s == "q\\"  "  ') == 's == "q\\"  "'
+    assert utils.normalize_expr("'my  attr'  == \"x\"") == "'my  attr' == \"x\""
+    assert utils.normalize_expr("'a\\'  b' ==  1") == "'a\\'  b' == 1"
+
+
+def test_constraint_cache():
+    cache = utils.ConstraintCache()
+    expr = cache.parse("JobStatus == 2")
+    assert cache.parse("  JobStatus  ==  2") is expr
+    for _ in range(2):
+        try:
+            cache.parse("JobStatus ==")
+            assert False, "no SyntaxError"
+        except SyntaxError:
+            pass
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (2, 2, 2)
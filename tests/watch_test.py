@@ -0,0 +1,143 @@
+import os
+
+import pytest
+
+from condor_restd import watch
+
+
+LOG = """\
+000 (012.000.000) 2024-01-01 10:00:00 Job submitted from host: <10.0.0.1:9618>
+...
+000 (012.001.000) 2024-01-01 10:00:00 Job submitted from host: <10.0.0.1:9618>
+...
+000 (013.000.000) 2024-01-01 10:00:01 Job submitted from host: <10.0.0.1:9618>
+...
+001 (012.000.000) 2024-01-01 10:00:05 Job executing on host: <10.0.0.2:9618>
+...
+006 (012.000.000) 2024-01-01 10:00:10 Image size of job updated: 100
+\t1  -  MemoryUsage of job (MB)
+\t100  -  ResidentSetSize of job (KB)
+...
+012 (012.001.000) 2024-01-01 10:00:11 Job was held.
+\tNot enough disk
+\tCode 1 Subcode 0
+...
+"""
+
+RELEASED = """\
+013 (012.001.000) 2024-01-01 10:00:20 Job was released.
+\tok
+...
+"""
+
+
+def changes(follower, cluster, after):
+    return [
+        (number, change)
+        for number, change in follower.subscribe(cluster, after, 0)
+        if change is not None
+    ]
+
+
+def test_follower(tmp_path):
+    path = str(tmp_path / "job.log")
+    with open(path, "w") as f:
+        f.write(LOG)
+    follower = watch.get_follower(path)
+
+    # A new subscriber gets the current status of each job of the cluster
+    current = changes(follower, 12, None)
+    assert [(c["jobid"], c["status"]) for _, c in current] == [("12.0", 2), ("12.1", 5)]
+    assert current[1][1]["holdreason"] == "Not enough disk"
+    token = follower.token(current[-1][0])
+    assert follower.position(token) == current[-1][0]
+    assert follower.position("garbage") is None
+
+    # A resumed one only gets the changes after its token
+    with open(path, "a") as f:
+        f.write(RELEASED)
+    resumed = follower.subscribe(12, follower.position(token), 10)
+    change = next(c for _, c in resumed if c is not None)
+    resumed.close()
+    assert (change["jobid"], change["event"], change["status"]) == ("12.1", "JOB_RELEASED", 1)
+    assert watch.get_follower(path) is follower
+
+
+FINISHED = """\
+005 (012.000.000) 2024-01-01 10:00:30 Job terminated.
+\t(1) Normal termination (return value 0)
+\t\tUsr 0 00:00:00, Sys 0 00:00:00  -  Run Remote Usage
+\t\tUsr 0 00:00:00, Sys 0 00:00:00  -  Run Local Usage
+\t\tUsr 0 00:00:00, Sys 0 00:00:00  -  Total Remote Usage
+\t\tUsr 0 00:00:00, Sys 0 00:00:00  -  Total Local Usage
+\t0  -  Run Bytes Sent By Job
+\t0  -  Run Bytes Received By Job
+\t0  -  Total Bytes Sent By Job
+\t0  -  Total Bytes Received By Job
+...
+009 (012.001.000) 2024-01-01 10:00:31 Job was aborted.
+\tvia condor_rm (by user alice)
+...
+"""
+
+
+def test_follower_forgets_old_finished_jobs(tmp_path, monkeypatch):
+    monkeypatch.setattr(watch, "max_finished", lambda: 1)
+    path = str(tmp_path / "job.log")
+    with open(path, "w") as f:
+        f.write(LOG + FINISHED)
+    follower = watch.EventLogFollower(path)
+    follower._log = watch.htcondor.JobEventLog(path)
+    follower._read(0)
+    follower._log.close()
+    # 12.0 finished first, and is forgotten
+    assert [(c["jobid"], c["status"]) for _, c in changes(follower, 12, None)] == [("12.1", 3)]
+    assert [c["jobid"] for _, c in changes(follower, 13, None)] == ["13.0"]
+
+
+def test_idle_follower_stops(tmp_path, monkeypatch):
+    monkeypatch.setattr(watch, "IDLE_TIMEOUT", 0)
+    path = str(tmp_path / "job.log")
+    with open(path, "w") as f:
+        f.write(LOG)
+    follower = watch.get_follower(path)
+    follower._thread.join(5)
+    assert not follower._thread.is_alive()
+    # A stopped follower is never handed out
+    assert watch.get_follower(path) is not follower
+
+
+def test_allowed_path(tmp_path, monkeypatch):
+    from condor_restd import utils
+
+    logs = tmp_path / "logs"
+    logs.mkdir()
+    (logs / "job.log").write_text(LOG)
+    (tmp_path / "event.log").write_text(LOG)
+    (tmp_path / "secret").write_text("secret")
+    link = logs / "link.log"
+    link.symlink_to(tmp_path / "secret")
+    config = {"RESTD_WATCH_LOG_DIRS": str(logs), "EVENT_LOG": str(tmp_path / "event.log")}
+    monkeypatch.setattr(
+        utils.param_table, "get", lambda name, default=None: config.get(name, default)
+    )
+    assert watch._allowed_path(str(logs / "job.log")) == os.path.realpath(str(logs / "job.log"))
+    assert watch._allowed_path(str(tmp_path / "event.log")) == os.path.realpath(str(tmp_path / "event.log"))
+    assert watch._allowed_path(str(tmp_path / "secret")) is None
+    assert watch._allowed_path(str(logs / ".." / "secret")) is None
+    assert watch._allowed_path(str(link)) is None
+    assert watch._allowed_path(str(logs)) is None
+
+
+def test_stream_limit(monkeypatch):
+    from werkzeug.exceptions import ServiceUnavailable
+
+    monkeypatch.setattr(watch, "max_streams", lambda: 1)
+    watch._open_stream()
+    try:
+        with pytest.raises(ServiceUnavailable):
+            watch._open_stream()
+    finally:
+        watch._close_stream()
+    watch._open_stream()
+    watch._close_stream()